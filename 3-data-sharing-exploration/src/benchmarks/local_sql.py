@@ -0,0 +1,97 @@
+"""
+Creates the views described by the local metadata files in an embedded DuckDB
+database and times view creation and a few query patterns, without Synapse.
+
+Run from the src folder:
+    python -m benchmarks.local_sql [path/to/sample_data]
+"""
+import glob
+import logging
+import os
+import statistics
+import sys
+import time
+
+from helpers.config import Configuration
+from helpers.metadata import Metadata
+from helpers.sql_local import LocalSqlHelper
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+DEFAULT_DATA_ROOT = os.path.join(
+    os.path.dirname(__file__), "..", "..", "sample_data"
+)
+
+
+def timed(function, repeat: int = 5) -> float:
+    """Median duration of a function call, in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    data_root = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DATA_ROOT
+    config = Configuration()
+    schema = config.synapse_database_schema or "SalesLT"
+    sql_helper = LocalSqlHelper(config, data_root=data_root)
+
+    metadata_paths = sorted(glob.glob(os.path.join(data_root, "_meta", "*.json")))
+    print(f"Found {len(metadata_paths)} metadata files in {data_root}")
+
+    results = []
+    for metadata_path in metadata_paths:
+        with open(metadata_path) as file:
+            metadata_json = file.read()
+        metadata = Metadata.from_json(metadata_json)  # type: ignore
+        results.append(
+            (
+                f"create views {os.path.basename(metadata_path)}",
+                timed(
+                    lambda: sql_helper.create_views_from_metadata(
+                        metadata_as_json=metadata_json, schema=schema
+                    ),
+                    repeat=1,
+                ),
+            )
+        )
+
+        full_schema = f"{metadata.major_version_identifier}_{schema}"
+        for table in metadata.tables:
+            view = f"{full_schema}.{table.name}"
+            results.append(
+                (
+                    f"count {view}",
+                    timed(lambda: sql_helper.execute_sql_result(
+                        f"SELECT COUNT(*) FROM {view}"
+                    )),
+                )
+            )
+            if table.key_columns:
+                results.append(
+                    (
+                        f"keyset scan {view}",
+                        timed(lambda: sum(
+                            1
+                            for _ in sql_helper.iter_view(
+                                full_schema, table, page_size=100
+                            )
+                        )),
+                    )
+                )
+
+    print(f"Views created: {len(sql_helper.list_views())}")
+    width = max(len(name) for name, _ in results)
+    for name, duration in results:
+        print(f"{name:<{width}}  {duration:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Times parsing of a synthetic metadata file with 10k tables and 500k columns.
+
+Run from the src folder:
+    python -m benchmarks.metadata_parsing [tables] [columns_per_table] [--memory]
+
+--memory also reports the peak memory of each parser (tracemalloc slows the
+parsing down several times). The dataclasses_json model used before is much
+slower, so it is only timed on the first 1000 tables.
+"""
+import json
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from helpers import metadata as metadata_module
+from helpers.metadata import Metadata, MetadataStream, clear_metadata_cache
+
+SENSITIVITIES = ["low", "medium", "high"]
+TYPES = ["Integer", "Bit", "Varchar(12)", "Varchar(50)", "Decimal(19,4)", "Datetime"]
+
+
+def synthetic_metadata_json(tables: int, columns_per_table: int) -> str:
+    random.seed(42)
+    return json.dumps(
+        {
+            "version": "1.0.0",
+            "path": "v1",
+            "tables": [
+                {
+                    "name": f"Table{table}",
+                    "description": f"Description of table {table}",
+                    "sensitivity": random.choice(SENSITIVITIES + [""]),
+                    "columns": [
+                        {
+                            "name": f"Column{column}",
+                            "description": f"Description of column {column}",
+                            "sensitivity": random.choice(SENSITIVITIES),
+                            "type": random.choice(TYPES),
+                            "key": column == 0,
+                        }
+                        for column in range(columns_per_table)
+                    ],
+                }
+                for table in range(tables)
+            ],
+        }
+    )
+
+
+def measure(name: str, parse, metadata_json: str, memory: bool = False):
+    clear_metadata_cache()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = parse(metadata_json)
+    duration = time.perf_counter() - start
+    peak = ""
+    if memory:
+        peak = f"peak {tracemalloc.get_traced_memory()[1] / 2**20:8.1f} MiB  "
+        tracemalloc.stop()
+    columns = sum(len(table.columns) for table in result.tables)
+    print(
+        f"{name:<32} {duration:8.2f} s  {peak}"
+        f"({len(result.tables)} tables, {columns} columns)"
+    )
+    return result
+
+
+def legacy_parser():
+    """The dataclasses_json model used before, if the library is installed"""
+    try:
+        from dataclasses_json import config, dataclass_json
+    except ImportError:
+        return None
+
+    @dataclass_json
+    @dataclass
+    class LegacyColumn:
+        name: str
+        description: Optional[str] = None
+        sensitivity: Optional[str] = ""
+        data_type: str = field(metadata=config(field_name="type"), default="")
+        is_key: bool = field(metadata=config(field_name="key"), default=False)
+
+    @dataclass_json
+    @dataclass
+    class LegacyTable:
+        name: str
+        columns: List[LegacyColumn]
+        description: Optional[str] = None
+        sensitivity: Optional[str] = ""
+
+    @dataclass_json
+    @dataclass
+    class LegacyMetadata:
+        version: str
+        path: str
+        tables: List[LegacyTable]
+
+    return LegacyMetadata.from_json
+
+
+def main():
+    memory = "--memory" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--memory"]
+    tables = int(args[0]) if len(args) > 0 else 10_000
+    columns_per_table = int(args[1]) if len(args) > 1 else 50
+    metadata_json = synthetic_metadata_json(tables, columns_per_table)
+    print(f"Metadata file: {len(metadata_json) / 2**20:.1f} MiB")
+
+    legacy = legacy_parser()
+    if legacy is not None:
+        legacy_tables = min(tables, 1000)
+        legacy_json = synthetic_metadata_json(legacy_tables, columns_per_table)
+        measure("dataclasses_json", legacy, legacy_json, memory)
+        measure("slots (same file)", Metadata.from_json, legacy_json, memory)
+
+    orjson = metadata_module.orjson
+    metadata_module.orjson = None
+    measure("slots + json", Metadata.from_json, metadata_json, memory)
+    metadata_module.orjson = orjson
+    if orjson is not None:
+        measure("slots + orjson", Metadata.from_json, metadata_json, memory)
+
+    Metadata.from_json(metadata_json)
+    start = time.perf_counter()
+    Metadata.from_json(metadata_json)
+    print(f"{'memoized re-parse':<32} {time.perf_counter() - start:8.2f} s")
+
+    measure_stream(metadata_json.encode("utf-8"), memory)
+
+
+def _split(data: bytes, chunk_size: int):
+    for start in range(0, len(data), chunk_size):
+        end = start + chunk_size
+        yield data[start:end]
+
+
+def measure_stream(data: bytes, memory: bool, chunk_size: int = 4 * 1024 * 1024):
+    """
+    Streams the tables from 4 MiB chunks, the way a blob download is read
+    """
+    chunks = _split(data, chunk_size)
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    tables = columns = 0
+    for table in MetadataStream(chunks):
+        tables += 1
+        columns += len(table.columns)
+    duration = time.perf_counter() - start
+    peak = ""
+    if memory:
+        peak = f"peak {tracemalloc.get_traced_memory()[1] / 2**20:8.1f} MiB  "
+        tracemalloc.stop()
+    print(
+        f"{'streaming (4 MiB chunks)':<32} {duration:8.2f} s  {peak}"
+        f"({tables} tables, {columns} columns)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Times the metadata reads of the ingest, catalog and security stages against
+the local storage backend, so that results do not depend on the network.
+
+Run from the src folder:
+    python -m benchmarks.storage_local [path/to/sample_data]
+"""
+import logging
+import os
+import sys
+import tempfile
+
+from benchmarks.local_sql import DEFAULT_DATA_ROOT, timed
+from helpers.config import Configuration
+from helpers.metadata_index import MetadataIndex
+from helpers.storage import MetadataWatermark, StorageHelper
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    data_root = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DATA_ROOT
+    config = Configuration()
+    container = config.adls_container_name or "local"
+    storage_helper = StorageHelper.local(data_root)
+    metadata_files = storage_helper.get_metadata_files(container)
+    print(f"Found {len(metadata_files)} metadata files in {data_root}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # a watermark already at the current state: nothing to process
+        watermark = MetadataWatermark(os.path.join(temp_dir, "stage.json"))
+        watermark.commit(storage_helper.get_metadata_changes(container, watermark))
+
+        results = [
+            (
+                "get_metadata_files (ingest, security)",
+                timed(lambda: storage_helper.get_metadata_files(container)),
+            ),
+            (
+                "get_metadata_changes, first run",
+                timed(
+                    lambda: storage_helper.get_metadata_changes(
+                        container,
+                        MetadataWatermark(os.path.join(temp_dir, "empty.json")),
+                    )
+                ),
+            ),
+            (
+                "get_metadata_changes, no change (incremental)",
+                timed(
+                    lambda: storage_helper.get_metadata_changes(container, watermark)
+                ),
+            ),
+            (
+                "stream_metadata_tables",
+                timed(
+                    lambda: [
+                        list(storage_helper.stream_metadata_tables(container, name))
+                        for name in (file.name for file in metadata_files)
+                    ]
+                ),
+            ),
+            (
+                "MetadataIndex (catalog, security)",
+                timed(
+                    lambda: MetadataIndex(
+                        [file.metadata for file in metadata_files],
+                        server_name="local-ondemand.sql.azuresynapse.net",
+                        database_name=config.synapse_database or "local",
+                        schema=config.synapse_database_schema or "SalesLT",
+                    )
+                ),
+            ),
+        ]
+
+    width = max(len(name) for name, _ in results)
+    for name, milliseconds in results:
+        print(f"{name:<{width}}  {milliseconds:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import logging
+
+from azure.identity import DefaultAzureCredential
+from azure.storage.filedatalake import DataLakeServiceClient
+
+from helpers.config import Configuration
+from helpers.inventory import ContainerInventory
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Build or refresh the local inventory of the paths of the container, "
+            "from a listing of the storage account or a blob inventory report"
+        )
+    )
+    parser.add_argument(
+        "--prefix", default="", help="folder to refresh, e.g. v2 (default all)"
+    )
+    parser.add_argument(
+        "--report", help="blob inventory report (csv or parquet) to load instead"
+    )
+    parser.add_argument(
+        "--no-acl", action="store_true", help="do not read the ACLs of the paths"
+    )
+    parser.add_argument(
+        "--full-acl",
+        action="store_true",
+        help="read the ACLs of all the paths, not only of the changed ones",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    config = Configuration()
+    container = config.adls_container_name
+    inventory = ContainerInventory.for_container(config.storage_account_name, container)
+    if args.report:
+        refresh = inventory.refresh_from_report(args.report, args.prefix)
+    else:
+        service_client = DataLakeServiceClient(
+            account_url=f"https://{config.storage_account_name}.dfs.core.windows.net",
+            credential=DefaultAzureCredential(),
+        )
+        refresh = inventory.refresh_from_adls(
+            service_client.get_file_system_client(container),
+            args.prefix,
+            fetch_acl=not args.no_acl,
+            full_acl=args.full_acl,
+            max_workers=args.workers,
+        )
+    print(f"Inventory of {container} refreshed {refresh}")
+    print(
+        f"{len(inventory.list(args.prefix))} paths, "
+        f"{inventory.size(args.prefix) / 1024 / 1024:.1f} MB, "
+        f"{len(inventory.delta_tables(args.prefix))} delta tables"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import logging
 
 from helpers.datacatalog.data_catalog_steps import (
@@ -9,6 +10,8 @@ from helpers.datacatalog.data_catalog_steps import (
     update_purview_asset_metadata,
 )
 from helpers.config import Configuration
+from helpers.purview.entity_cache import get_entity_cache
+from helpers.storage import MetadataWatermark, StorageHelper
 
 # setup logging
 log_level = logging.WARNING
@@ -18,6 +21,13 @@ logging.basicConfig(
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only update assets of metadata files new or changed since the last run",
+    )
+    args = parser.parse_args()
 
     # Initialize config
     config = Configuration()
@@ -38,10 +48,40 @@ def main():
     trigger_scan(data_source_name, scan_name, config)
 
     # Update Purview assets with metadata
-    update_purview_asset_metadata(config)
+    if args.incremental:
+        container = config.adls_container_name
+        storage_helper = StorageHelper.from_configuration(config)
+        watermark = MetadataWatermark.for_stage(
+            storage_helper.account_name, container, "data_catalog"
+        )
+        changes = storage_helper.get_metadata_changes(container, watermark)
+        print(f"Updating assets for {len(changes.changed)} changed metadata files")
+        diffs = {}
+        for metadata_file in changes.changed:
+            diff = watermark.diff(metadata_file)
+            print(diff.summary())
+            diffs[diff.new_version] = diff
+        result = update_purview_asset_metadata(
+            config, metadata_files=changes.changed, diffs=diffs
+        )
+        print(f"Purview assets: {result}")
+        # files with views or columns skipped or not updated are processed again
+        # by the next run
+        failed_versions = result.failed_versions
+        retried = [
+            metadata_file.name
+            for metadata_file in changes.changed
+            if metadata_file.metadata.version in failed_versions
+        ]
+        if retried:
+            print(f"Metadata files to update again on the next run: {retried}")
+        watermark.commit(changes, exclude=retried)
+    else:
+        update_purview_asset_metadata(config)
 
     # organize collection - creates sub collections for each schema
     organize_collection(collection_name, config)
+    print(f"Purview entity cache: {get_entity_cache().stats()}")
     print("All Done!")
 
 
@@ -1,8 +1,10 @@
+import argparse
 import logging
 
 from helpers.config import Configuration
 from helpers.sql import SqlHelper
-from helpers.storage import StorageHelper
+from helpers.sql_local import LocalSqlHelper
+from helpers.storage import MetadataWatermark, StorageHelper
 
 # setup logging
 log_level = logging.WARNING
@@ -12,25 +14,64 @@ logging.basicConfig(
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process metadata files new or changed since the last run",
+    )
+    args = parser.parse_args()
+
     # setting up storage access
     config = Configuration()
-    storage = StorageHelper(config.storage_account_name)
-    # setting up synapse access
-    synapse = SqlHelper(config)
+    storage = StorageHelper.from_configuration(config)
+    # setting up synapse access, or DuckDB over the local folder
+    if config.local_data_root:
+        synapse = LocalSqlHelper(config, data_root=config.local_data_root)
+    else:
+        synapse = SqlHelper(config)
 
     container = config.adls_container_name
     # listing metadata files
-    metadata_files = storage.get_metadata_files(container)
-    found = len(metadata_files)
-    print(f"Found {found} metadata files")
+    if args.incremental:
+        watermark = MetadataWatermark.for_stage(
+            storage.account_name, container, "data_ingest"
+        )
+        changes = storage.get_metadata_changes(container, watermark)
+        metadata_files = changes.changed
+        print(
+            f"Found {len(metadata_files)} new or changed metadata files, "
+            f"deleted: {changes.deleted}"
+        )
+    else:
+        metadata_files = storage.get_metadata_files(container)
+        found = len(metadata_files)
+        print(f"Found {found} metadata files")
 
     # create all views
     for metadata_file in metadata_files:
+        tables = None
+        if args.incremental:
+            # only the views of new tables or tables with different columns
+            diff = watermark.diff(metadata_file)
+            print(diff.summary())
+            tables = diff.view_tables
+            if not tables:
+                continue
         synapse.create_views_from_metadata(
             metadata_as_json=metadata_file.metadata_json,
             schema=config.synapse_database_schema,
+            tables=tables,
         )
 
+    if args.incremental:
+        if config.local_data_root:
+            # the DuckDB database is in memory and its views are lost at the end
+            # of the run: the next run must create all the views again
+            print("Views created in memory, watermark not committed")
+        else:
+            watermark.commit(changes)
+
     # test that views have been created
     result = synapse.list_views()
     print(result)
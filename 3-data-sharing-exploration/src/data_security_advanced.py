@@ -1,11 +1,15 @@
+import argparse
 import logging
 
 from helpers.config import Configuration
 from helpers.datasecurity.data_security_common import DataSecurityCommon
 from helpers.datasecurity.data_security_storage import DataSecurityStorage
 from helpers.datasecurity.data_security_synapse import DataSecuritySynapse
+from helpers.inventory import ContainerInventory
 from helpers.keyvault.client import ClientHelper
-from helpers.metadata import Metadata
+from helpers.metadata_index import MetadataIndex
+from helpers.purview.catalog_mirror import CatalogMirror
+from helpers.purview.entity_cache import get_entity_cache
 from helpers.storage import StorageHelper
 
 # setup logging
@@ -16,18 +20,50 @@ logging.basicConfig(
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--inventory",
+        action="store_true",
+        help="skip the views whose paths already have the ACL in the container "
+        "inventory (see build_inventory.py)",
+    )
+    parser.add_argument(
+        "--catalog-mirror",
+        action="store_true",
+        help="read the security attributes of the views from the local mirror of "
+        "the Purview collection, refreshed before they are assigned "
+        "(see sync_catalog_mirror.py)",
+    )
+    args = parser.parse_args()
+
     # setting up data security
     config = Configuration()
-    storage_helper = StorageHelper(config.storage_account_name)
-    data_security = DataSecurityCommon(config)
-    data_security_storage = DataSecurityStorage(config)
-    data_security_synapse = DataSecuritySynapse(config)
+    storage_helper = StorageHelper.from_configuration(config)
+    catalog_mirror = (
+        CatalogMirror.for_configuration(config) if args.catalog_mirror else None
+    )
+    data_security = DataSecurityCommon(config, catalog_mirror=catalog_mirror)
+    inventory = (
+        ContainerInventory.for_container(
+            config.storage_account_name, config.adls_container_name
+        )
+        if args.inventory
+        else None
+    )
+    data_security_storage = DataSecurityStorage(config, inventory=inventory)
+    data_security_synapse = DataSecuritySynapse(config, catalog_mirror=catalog_mirror)
     key_vault_client = ClientHelper(config=config)
     container = config.adls_container_name
     security_file = key_vault_client.get_data_security_file(
         config.security_file_secret)
     print(security_file)
 
+    # the security groups assigned below are recorded in the mirror as they are
+    # written, as the search index of Purview only reports them later
+    if catalog_mirror is not None:
+        refresh = catalog_mirror.refresh_from_purview(config)
+        print(f"Catalog mirror: {refresh}")
+
     # 1. Assign the security managed attribute to all items in Purview
     data_security_synapse.assign_managed_attribute_for_security(
         security_file=security_file
@@ -35,8 +71,9 @@ def main():
 
     all_security_groups_acls = {}
     metadata_files = storage_helper.get_metadata_files(container)
+    index = MetadataIndex.from_metadata_files(metadata_files, config)
     for metadata_file in metadata_files:
-        path = Metadata.from_json(metadata_file.metadata_json).path
+        path = metadata_file.metadata.path
         print(f"... Applying security to Views in {container}/{path} ...")
 
         # 2 . Get the value of all views' security attributes from Purview
@@ -44,13 +81,20 @@ def main():
             metadata_as_json=metadata_file.metadata_json,
             m_attribute_group=config.security_managed_attribute_group,
             m_attribute_name=config.security_managed_attribute_name,
+            index=index,
         )
         print("Security Groups assigned to Views retrieved from from Purview.")
         print(assigned_security_groups)
 
         # 3. Generate GRANT statements and apply security to Synapse assets
         data_security_synapse.apply_security_to_synpase_assets(
-            assigned_security_groups, path, security_file
+            assigned_security_groups,
+            path,
+            security_file,
+            view_columns={
+                indexed_table.table.name: indexed_table.columns.keys()
+                for indexed_table in index.tables(metadata_file.metadata.version)
+            },
         )
 
         print(f"Applied security to synapse assets for {path}")
@@ -75,6 +119,7 @@ def main():
         acl=comma_separated_acl_list,
     )
     print(f"ACL applied to root directory: {list(all_security_groups_acls.keys())}")
+    print(f"Purview entity cache: {get_entity_cache().stats()}")
 
 
 if __name__ == "__main__":
@@ -24,6 +24,7 @@ class Configuration:
         self._synapse_database = ""
         self._synapse_database_schema = ""
         self._adls_container_name = ""
+        self._local_data_root = None
         self._purview_collection_name = ""
         self._data_security_attribute = ""
         self._security_managed_attribute_group = ""
@@ -184,6 +185,17 @@ class Configuration:
     def adls_container_name(self, value):
         self._adls_container_name = value
 
+    @property
+    def local_data_root(self):
+        # optional: local folder served instead of the container of the account
+        if self._local_data_root is None:
+            self._local_data_root = os.getenv("LOCAL_DATA_ROOT", "")
+        return self._local_data_root
+
+    @local_data_root.setter
+    def local_data_root(self, value):
+        self._local_data_root = value
+
     @property
     def purview_collection_name(self):
         if self._purview_collection_name == "":
@@ -1,18 +1,60 @@
 import sys
+from collections import defaultdict
+from dataclasses import dataclass, field
 from pprint import pprint
 from time import sleep
+from typing import Dict, List, Set
 
 from helpers.const import CONST
 from helpers.config import Configuration
-from helpers.metadata import Metadata
-from helpers.purview.catalog import CatalogHelper
+from helpers.metadata import MetadataFile
+from helpers.metadata_diff import MetadataDiff
+from helpers.metadata_index import MetadataIndex
+from helpers.purview.catalog import CatalogHelper, EntityUpdate, EntityUpdateResult
 from helpers.purview.collections import CollectionHelper
 from helpers.purview.datasources import DataSourceHelper
-from helpers.purview.managed_attributes import ManagedAttributesHelper
+from helpers.purview.managed_attributes import (
+    ManagedAttributesHelper,
+    ManagedAttributeUpdateResult,
+)
 from helpers.purview.scans import ScanHelper
 from helpers.storage import StorageHelper
 
 
+@dataclass
+class AssetMetadataUpdate:
+    """Views and columns of each metadata version updated in Purview"""
+
+    # qualified names of the views and columns not found in Purview, by version
+    skipped: Dict[str, List[str]] = field(default_factory=lambda: defaultdict(list))
+    # result of the update of the descriptions, by version
+    descriptions: Dict[str, EntityUpdateResult] = field(default_factory=dict)
+    sensitivity: ManagedAttributeUpdateResult = field(
+        default_factory=ManagedAttributeUpdateResult
+    )
+    # version of each entity whose sensitivity was updated, by entity id
+    sensitivity_versions: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def failed_versions(self) -> Set[str]:
+        """Versions with views or columns skipped or not updated"""
+        versions = {version for version, names in self.skipped.items() if names}
+        versions.update(
+            version for version, result in self.descriptions.items() if result.failed
+        )
+        versions.update(
+            self.sensitivity_versions[guid] for guid in self.sensitivity.failed
+        )
+        return versions
+
+    def __str__(self) -> str:
+        return (
+            f"{sum(len(names) for names in self.skipped.values())} skipped, "
+            f"{sum(len(result.failed) for result in self.descriptions.values())} "
+            f"descriptions and {len(self.sensitivity.failed)} sensitivities failed"
+        )
+
+
 def create_collection(config: Configuration):
     """Create a collection to store Synapse assets if it does not exist"""
     collection_helper = CollectionHelper(config)
@@ -103,21 +145,33 @@ def trigger_scan(data_source_name: str, scan_name: str, config: Configuration):
     print("Scan complete!")
 
 
-def update_purview_asset_metadata(config: Configuration):
-    """Updates purview scanned assets using the metadata files"""
+def update_purview_asset_metadata(
+    config: Configuration,
+    metadata_files: List[MetadataFile] = None,
+    diffs: Dict[str, MetadataDiff] = None,
+) -> AssetMetadataUpdate:
+    """
+    Updates purview scanned assets using the metadata files.
+    If metadata_files is None, all the metadata files in storage are used.
+    diffs, by metadata version, limits the update of a metadata file to the
+    tables and columns that changed since it was last processed.
+    Returns the views and columns skipped, as they are not in Purview yet, and
+    the ones whose update failed, by metadata version.
+    """
+    diffs = diffs or {}
+    update_result = AssetMetadataUpdate()
 
-    storage_helper = StorageHelper(config.storage_account_name)
     catalog_helper = CatalogHelper(config)
     managed_attribute_helper = ManagedAttributesHelper(config)
 
     # get all metadata files
-    metadata_files = storage_helper.get_metadata_files(config.adls_container_name)
+    if metadata_files is None:
+        storage_helper = StorageHelper.from_configuration(config)
+        metadata_files = storage_helper.get_metadata_files(config.adls_container_name)
 
-    # to determine the fully qualified name of the star schema tables in synapse
-    # we need to know which database and schema they belong to
-    synapse_workspace = config.synapse_workspace_name
-    server_name = f"{synapse_workspace}-ondemand.sql.azuresynapse.net"
-    database_name = config.synapse_database
+    # the index computes the fully qualified names of the star schema views in
+    # synapse, from the database and schema they belong to
+    index = MetadataIndex.from_metadata_files(metadata_files, config)
     managed_attribute_group = config.security_managed_attribute_group
     managed_attribute = config.data_security_attribute
 
@@ -127,78 +181,118 @@ def update_purview_asset_metadata(config: Configuration):
         managed_attribute_group, managed_attribute
     )
 
-    for metadata_file in metadata_files:
-        metadata = Metadata.from_json(metadata_file.metadata_json)
-        schema_name = (
-            f"{metadata.major_version_identifier}_{config.synapse_database_schema}"
-        )
+    # tables and columns to update, by table
+    updates = []
+    for indexed_table in index.tables():
+        table = indexed_table.table
+        diff = diffs.get(indexed_table.version)
+        if diff is not None and table.name not in diff.catalog_tables:
+            continue
+        indexed_columns = [
+            indexed_column
+            for indexed_column in indexed_table.columns.values()
+            if diff is None
+            or table.name in diff.added_tables
+            or indexed_column.column.name in diff.columns(table.name)
+        ]
+        updates.append((indexed_table, indexed_columns))
 
-        for table in metadata.tables:
-            print(f"Updating table {table.name}")
-            # construct fully qualified name for table
-            table_qualified_name = (
-                catalog_helper.get_synapse_table_fully_qualified_name(
-                    server_name=server_name,
-                    database_name=database_name,
-                    schema_name=schema_name,
-                    table_name=table.name,
-                )
+    # resolve the entity ids of all the views and columns up front, in bulk
+    table_guids = catalog_helper.resolve_qualified_names(
+        (indexed_table.qualified_name for indexed_table, _ in updates),
+        type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_DATA_TYPE,
+    )
+    column_guids = catalog_helper.resolve_qualified_names(
+        (
+            indexed_column.qualified_name
+            for indexed_table, indexed_columns in updates
+            if indexed_table.qualified_name in table_guids
+            for indexed_column in indexed_columns
+        ),
+        type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_COLUMN_DATA_TYPE,
+    )
+
+    # descriptions of the views and columns, by metadata version, and their
+    # sensitivity, written together once all the updates are known
+    description_updates: Dict[str, List[EntityUpdate]] = defaultdict(list)
+    sensitivity_updates = managed_attribute_helper.batch()
+    for indexed_table, indexed_columns in updates:
+        table = indexed_table.table
+        print(f"Updating table {table.name}")
+        table_guid = table_guids.get(indexed_table.qualified_name)
+        if not table_guid:
+            print(f"Skipping {table.name}...")
+            update_result.skipped[indexed_table.version].append(
+                indexed_table.qualified_name
             )
-            # fetch asset from Purview catalog
-            table_entity = catalog_helper.get_asset_by_fully_qualified_name(
-                qualified_name=table_qualified_name,
+            continue
+
+        description_updates[indexed_table.version].append(
+            EntityUpdate(
+                guid=table_guid,
                 type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_DATA_TYPE,
+                qualified_name=indexed_table.qualified_name,
+                name=table.name,
+                attributes={"description": table.description},
             )
-            if not table_entity:
-                print(f"Skipping {table.name}...")
-                continue
-
-            # extract the entity id for the table
-            table_guid = catalog_helper.get_entity_id_from_asset(table_entity)
+        )
 
-            # update table metadata in Purview
-            catalog_helper.set_attribute(
+        if table.sensitivity:
+            update_result.sensitivity_versions[table_guid] = indexed_table.version
+            sensitivity_updates.update_m_attribute(
                 entity_id=table_guid,
-                attribute_name="description",
-                attribute_value=table.description,
+                m_attribute_group=managed_attribute_group,
+                m_attribute_name=managed_attribute,
+                m_attribute_value=table.sensitivity,
             )
 
-            if table.sensitivity:
-                managed_attribute_helper.update_m_attribute(
-                    entity_id=table_guid,
-                    m_attribute_group=managed_attribute_group,
-                    m_attribute_name=managed_attribute,
-                    m_attribute_value=table.sensitivity,
+        for indexed_column in indexed_columns:
+            column = indexed_column.column
+            print(f"\tUpdating column {column.name}")
+            column_guid = column_guids.get(indexed_column.qualified_name)
+            if not column_guid:
+                print(f"\tSkipping {column.name}...")
+                update_result.skipped[indexed_table.version].append(
+                    indexed_column.qualified_name
                 )
+                continue
 
-            for column in table.columns:
-                print(f"\tUpdating column {column.name}")
-                # construct fully qualified name for column
-                column_qualified_name = table_qualified_name + f"#{column.name}"
-                column_entity = catalog_helper.get_asset_by_fully_qualified_name(
-                    qualified_name=column_qualified_name,
-                    type_name="azure_synapse_serverless_sql_view_column",
+            description_updates[indexed_table.version].append(
+                EntityUpdate(
+                    guid=column_guid,
+                    type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_COLUMN_DATA_TYPE,
+                    qualified_name=indexed_column.qualified_name,
+                    name=column.name,
+                    attributes={"description": column.description},
                 )
-                if not column_entity:
-                    print(f"\tSkipping {column.name}...")
-                    continue
-
-                # extract the entity id for the column
-                column_guid = catalog_helper.get_entity_id_from_asset(column_entity)
+            )
 
-                catalog_helper.set_attribute(
+            if column.sensitivity:
+                update_result.sensitivity_versions[column_guid] = indexed_table.version
+                sensitivity_updates.update_m_attribute(
                     entity_id=column_guid,
-                    attribute_name="description",
-                    attribute_value=column.description,
+                    m_attribute_group=managed_attribute_group,
+                    m_attribute_name=managed_attribute,
+                    m_attribute_value=column.sensitivity,
                 )
 
-                if column.sensitivity:
-                    managed_attribute_helper.update_m_attribute(
-                        entity_id=column_guid,
-                        m_attribute_group=managed_attribute_group,
-                        m_attribute_name=managed_attribute,
-                        m_attribute_value=column.sensitivity,
-                    )
+    # update the descriptions in Purview, in bulk, one metadata file at a time
+    for version, entity_updates in description_updates.items():
+        result = catalog_helper.update_entities(entity_updates)
+        update_result.descriptions[version] = result
+        print(f"Descriptions of metadata version {version}: {result}")
+        qualified_names = {
+            update.guid: update.qualified_name for update in entity_updates
+        }
+        for guid, error in result.failed.items():
+            print(f"\tFailed to update {qualified_names[guid]}: {error}")
+
+    result = sensitivity_updates.flush()
+    update_result.sensitivity = result
+    print(f"Sensitivity of the views and columns: {result}")
+    for guid, error in result.failed.items():
+        print(f"\tFailed to update {guid}: {error}")
+    return update_result
 
 
 def organize_collection(collection_name: str, config: Configuration):
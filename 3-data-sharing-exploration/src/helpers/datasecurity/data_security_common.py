@@ -1,22 +1,61 @@
 import logging
+from typing import Collection, Dict
 
 from ..const import CONST
 from ..config import Configuration
-from ..metadata import Metadata, Table
+from ..metadata import Metadata
+from ..metadata_index import IndexedTable, MetadataIndex
 from ..purview.catalog import CatalogHelper
+from ..purview.catalog_mirror import CatalogMirror
 from ..purview.managed_attributes import ManagedAttributesHelper
 
 
 class DataSecurityCommon:
     """Contains general methods for managing data security"""
 
-    def __init__(self, configuration: Configuration):
+    def __init__(
+        self, configuration: Configuration, catalog_mirror: CatalogMirror = None
+    ):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+
+        catalog_mirror: CatalogMirror = None
+            Optional.
+            local mirror of the Purview collection, refreshed by the caller, from
+            which the views, columns and their security attributes are read
+            instead of Purview
+        """
         self.logger = logging.getLogger(__name__)
         self._configuration = configuration
         self._catalog_helper = CatalogHelper(configuration)
         self._m_attribute_helper = ManagedAttributesHelper(configuration)
+        self._catalog_mirror = catalog_mirror
         self.logger.info("DataSecurityCommon initialized")
 
+    def _resolve_qualified_names(self, qualified_names, type_name: str) -> dict:
+        if self._catalog_mirror is not None:
+            return self._catalog_mirror.resolve_qualified_names(
+                qualified_names, type_name
+            )
+        return self._catalog_helper.resolve_qualified_names(
+            qualified_names, type_name=type_name
+        )
+
+    def _get_m_attribute_value(
+        self, entity_id: str, m_attribute_group: str, m_attribute_name: str
+    ):
+        if self._catalog_mirror is not None:
+            return self._catalog_mirror.m_attribute_value(
+                entity_id, m_attribute_group, m_attribute_name
+            )
+        return self._m_attribute_helper.get_m_attribute_value(
+            entity_id=entity_id,
+            m_attribute_group=m_attribute_group,
+            m_attribute_name=m_attribute_name,
+        )
+
     def get_data_security_attribute(self) -> str:
         """
         Get data security attribute from env variable
@@ -28,11 +67,25 @@ class DataSecurityCommon:
         metadata_as_json: str,
         m_attribute_name: str,
         m_attribute_group: str,
+        index: MetadataIndex = None,
+        tables: Collection[str] = None,
     ) -> dict:
         """
         Get the values of the managed attribute used for security in Purview
         for all the views in the metadata file.
 
+        Parameters
+        ----------
+        index: MetadataIndex = None
+            Optional.
+            Index of the metadata files, with the qualified names of the views.
+            Built from the metadata file if not provided.
+
+        tables: Collection[str] = None
+            Optional.
+            Names of the views to read, e.g. the `security_tables` of a
+            MetadataDiff. By default all the views of the metadata file.
+
         Returns
         -------------
         dict ( str: [ str | dict ] ) : (view_name, assigned_security_group(s))
@@ -42,36 +95,35 @@ class DataSecurityCommon:
 
         self.logger.info("Get Security Groups assigned to Views from Purview")
 
-        metadata = Metadata.from_json(metadata_as_json)  # type: ignore
-        synapse_workspace = self._configuration.synapse_workspace_name
-        synapse_server = f"{synapse_workspace}-ondemand.sql.azuresynapse.net"
-        database_name = self._configuration.synapse_database
-        path = metadata.path
-        schema_path = f"{path}_{self._configuration.synapse_database_schema}"
+        metadata = Metadata.from_json(metadata_as_json)
+        if index is None or metadata.version not in index.metadata:
+            index = MetadataIndex.for_configuration([metadata], self._configuration)
 
         results = dict()
 
-        for table in metadata.tables:
-            table_qualified_name = (
-                self._catalog_helper.get_synapse_table_fully_qualified_name(
-                    server_name=synapse_server,
-                    database_name=database_name,
-                    schema_name=schema_path,
-                    table_name=table.name,
-                )
-            )
-
-            table_guid = self._catalog_helper.get_entity_id_by_fully_qualified_name(
-                qualified_name=table_qualified_name,
-                type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_DATA_TYPE,
-            )
+        indexed_tables = [
+            indexed_table
+            for indexed_table in index.tables(metadata.version)
+            if tables is None or indexed_table.table.name in tables
+        ]
+        # resolve the entity ids of all the views at once
+        table_guids = self._resolve_qualified_names(
+            (indexed_table.qualified_name for indexed_table in indexed_tables),
+            type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_DATA_TYPE,
+        )
+
+        # views without security at table level, whose columns are read
+        column_tables = []
+        for indexed_table in indexed_tables:
+            table = indexed_table.table
+            table_guid = table_guids.get(indexed_table.qualified_name)
             if table_guid is None:
                 self.logger.error(
                     f"{table.name} can't be found, security info can't be retrieved."
                 )
                 continue
 
-            security_value = self._m_attribute_helper.get_m_attribute_value(
+            security_value = self._get_m_attribute_value(
                 entity_id=table_guid,
                 m_attribute_group=m_attribute_group,
                 m_attribute_name=m_attribute_name,
@@ -82,47 +134,69 @@ class DataSecurityCommon:
             # if security is set at table level, then we ignore columns
             if security_value != "Not Assigned":
                 continue
-
-            column_security = self.get_security_for_view_columns(
+            column_tables.append(indexed_table)
+
+        # resolve the entity ids of the columns of all these views at once
+        column_guids = self._resolve_qualified_names(
+            (
+                indexed_column.qualified_name
+                for indexed_table in column_tables
+                for indexed_column in indexed_table.columns.values()
+            ),
+            type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_COLUMN_DATA_TYPE,
+        )
+        for indexed_table in column_tables:
+            results[indexed_table.table.name] = self.get_security_for_view_columns(
                 m_attribute_name,
                 m_attribute_group,
-                table,
-                table_qualified_name,
+                indexed_table,
+                column_guids,
             )
 
-            results[table.name] = column_security
-
         return results
 
     def get_security_for_view_columns(
         self,
         m_attribute_name: str,
         m_attribute_group: str,
-        table: Table,
-        table_qualified_name: str,
+        indexed_table: IndexedTable,
+        column_guids: Dict[str, str] = None,
     ) -> dict:
         """
         Get Security managed attribute value for all the table columns
+
+        Parameters
+        ----------
+        column_guids: Dict[str, str] = None
+            Optional.
+            Entity ids of the columns by qualified name, as returned by
+            CatalogHelper.resolve_qualified_names. Resolved for the columns of
+            the table if not provided.
         """
-        security_values = {}
-        for column in table.columns:
-            column_qualified_name = table_qualified_name + f"#{column.name}"
-            column_guid = self._catalog_helper.get_entity_id_by_fully_qualified_name(
-                qualified_name=column_qualified_name,
+        if column_guids is None:
+            column_guids = self._resolve_qualified_names(
+                (
+                    indexed_column.qualified_name
+                    for indexed_column in indexed_table.columns.values()
+                ),
                 type_name=CONST.PURVIEW_SYNAPSE_SQL_VIEW_COLUMN_DATA_TYPE,
             )
+
+        security_values = {}
+        for column_name, indexed_column in indexed_table.columns.items():
+            column_guid = column_guids.get(indexed_column.qualified_name)
             if column_guid is None:
                 self.logger.error(
-                    f"{column.name} can't be found in Purview. "
+                    f"{column_name} can't be found in Purview. "
                     "Security info can't be retrieved."
                 )
                 continue
 
-            column_security_value = self._m_attribute_helper.get_m_attribute_value(
+            column_security_value = self._get_m_attribute_value(
                 entity_id=column_guid,
                 m_attribute_group=m_attribute_group,
                 m_attribute_name=m_attribute_name,
             )
 
-            security_values.update({column.name: column_security_value})
+            security_values.update({column_name: column_security_value})
         return security_values
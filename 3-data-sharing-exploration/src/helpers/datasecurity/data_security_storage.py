@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
@@ -7,6 +7,7 @@ from azure.storage.filedatalake import DataLakeServiceClient
 from msgraph.core import GraphClient
 
 from ..config import Configuration
+from ..inventory import ContainerInventory, has_acl
 from ..storage import StorageHelper
 from ..keyvault.client import ClientHelper
 from .data_security_common import DataSecurityCommon
@@ -17,9 +18,25 @@ class DataSecurityStorage:
 
     _datalake_service_client: DataLakeServiceClient
 
-    def __init__(self, configuration: Configuration):
+    def __init__(
+        self,
+        configuration: Configuration,
+        inventory: Optional[ContainerInventory] = None,
+    ):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+            configuration of the deployment
+
+        inventory: ContainerInventory = None
+            Optional.
+            inventory of the container: views whose paths already have the ACL
+            are skipped, and the ACLs applied are recorded in it
+        """
         self.logger = logging.getLogger(__name__)
         self._configuration = configuration
+        self._inventory = inventory
         self._credentials = DefaultAzureCredential()
         self._datalake_service_client = DataLakeServiceClient(
             account_url=(
@@ -27,7 +44,7 @@ class DataSecurityStorage:
             ),
             credential=self._credentials,
         )
-        self._storage_helper = StorageHelper(configuration.storage_account_name)
+        self._storage_helper = StorageHelper.from_configuration(configuration)
         self._security_common = DataSecurityCommon(configuration)
         self.logger.info("DataSecurityStorage initialized")
 
@@ -104,11 +121,27 @@ class DataSecurityStorage:
 
         self.logger.info(f"Applying permissions to the view {view_dir}")
 
+        # path of the view in the container, path_to_view_dir starts with it
+        folder = path_to_view_dir.partition("/")[2].strip("/")
+        view_path = f"{folder}/{view_dir}" if folder else view_dir
         try:
             directory_client = self.get_directory_client(
                 f"{path_to_view_dir}", view_dir
             )
+            # the inventory may be stale, as changing an ACL does not always
+            # change the ETag: check the view folder itself before skipping
+            if (
+                self._inventory is not None
+                and self._inventory.get(view_path) is not None
+                and not self._inventory.missing_acl(view_path, acl)
+                and has_acl(directory_client.get_access_control()["acl"], acl)
+            ):
+                self.logger.info(f"ACL [{acl}] already applied to the view {view_dir}")
+                return
+
             directory_client.update_access_control_recursive(acl=acl)
+            if self._inventory is not None:
+                self._inventory.set_acl(view_path, acl)
 
             self.logger.info(
                 f"Successfully applied ACL: [{acl}] to the view {view_dir}"
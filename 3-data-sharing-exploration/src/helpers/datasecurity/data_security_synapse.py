@@ -1,14 +1,25 @@
 import logging
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Collection, Dict, List
 
 from ..config import Configuration
 from ..const import CONST
 from ..keyvault.data_security_file import DataSecurityFile
 from ..purview.catalog import CatalogHelper
+from ..purview.catalog_mirror import CatalogMirror
 from ..purview.collections import CollectionHelper
-from ..purview.managed_attributes import ManagedAttributesHelper
+from ..purview.managed_attributes import (
+    ManagedAttributeBatch,
+    ManagedAttributesHelper,
+)
 from ..sql import SqlHelper
+from .db_permissions import (
+    GrantDiff,
+    PermissionSnapshot,
+    actual_grants_from_snapshot,
+    desired_grants_from_assignments,
+    diff_grants,
+)
 
 
 @dataclass
@@ -26,9 +37,22 @@ class UserDbPermission:
 class DataSecuritySynapse:
     """Contains methods for managing data security in storage"""
 
-    def __init__(self, configuration: Configuration):
+    def __init__(
+        self, configuration: Configuration, catalog_mirror: CatalogMirror = None
+    ):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+
+        catalog_mirror: CatalogMirror = None
+            Optional.
+            local mirror of the Purview collection, in which the security groups
+            assigned are recorded
+        """
         self.logger = logging.getLogger(__name__)
         self._configuration = configuration
+        self._catalog_mirror = catalog_mirror
         self._managed_attribute_helper = ManagedAttributesHelper(
             configuration=self._configuration
         )
@@ -76,6 +100,11 @@ class DataSecuritySynapse:
             managed_attribute_group, security_group_managed_attribute
         )
 
+        # the security groups are written together once they are all known,
+        # with one request per entity
+        batch = self._managed_attribute_helper.batch(
+            catalog_mirror=self._catalog_mirror
+        )
         assignments = {}
         for entity in entities:
 
@@ -89,6 +118,7 @@ class DataSecuritySynapse:
                 managed_attribute_group=managed_attribute_group,
                 security_group_managed_attribute=security_group_managed_attribute,
                 security_file=security_file,
+                writer=batch,
             )
 
             assignments[entity["name"]] = security_attribute_value
@@ -101,11 +131,15 @@ class DataSecuritySynapse:
                     managed_attribute_group=managed_attribute_group,
                     security_group_managed_attribute=security_group_managed_attribute,
                     security_file=security_file,
+                    writer=batch,
                 )
                 for column_name, column_security_value in column_assignments.items():
                     column_index = f"{entity['name']}_{column_name}"
                     assignments[column_index] = column_security_value
 
+        result = batch.flush()
+        print(f"Security group managed attribute assigned: {result}")
+
         # if no security attribute could be assigned,
         # then suggest to check constraints and managed attributes
         if all(x is None for x in assignments.values()):
@@ -123,11 +157,21 @@ class DataSecuritySynapse:
         managed_attribute_group: str,
         security_group_managed_attribute: str,
         security_file: DataSecurityFile,
+        writer: ManagedAttributeBatch = None,
     ) -> str or None:
         """
         Identify the Security Group associated to this entity
         and assign the value in Purview managed attribute
+
+        Parameters
+        ----------
+        writer: ManagedAttributeBatch = None
+            Optional.
+            batch collecting the managed attribute update, written by its
+            flush method. By default the attribute is written right away.
         """
+        if writer is None:
+            writer = self._managed_attribute_helper
         security = "Not Assigned"
 
         if security_file is None:
@@ -162,7 +206,7 @@ class DataSecuritySynapse:
                     result = constraints_lower.items() <= attributes_lower.items()
                     if result:
                         # assign the security group corresponding to the first match
-                        self._managed_attribute_helper.update_m_attribute(
+                        writer.update_m_attribute(
                             entity_id=entity_id,
                             m_attribute_group=managed_attribute_group,
                             m_attribute_name=security_group_managed_attribute,
@@ -176,7 +220,7 @@ class DataSecuritySynapse:
                 "because there is no rule matching with this entity"
             )
 
-        self._managed_attribute_helper.update_m_attribute(
+        writer.update_m_attribute(
             entity_id=entity_id,
             m_attribute_group=managed_attribute_group,
             m_attribute_name=security_group_managed_attribute,
@@ -192,9 +236,17 @@ class DataSecuritySynapse:
         managed_attribute_group: str,
         security_group_managed_attribute: str,
         security_file: DataSecurityFile,
+        writer: ManagedAttributeBatch = None,
     ) -> Dict:
         """
         Assign security attribute to all columns of this entity
+
+        Parameters
+        ----------
+        writer: ManagedAttributeBatch = None
+            Optional.
+            batch collecting the managed attribute updates, see
+            assign_security_attribute_to_entity
         """
         catalog_helper = CatalogHelper(self._configuration)
         columns = catalog_helper.get_all_columns_per_entity(entity_id)
@@ -209,6 +261,7 @@ class DataSecuritySynapse:
                     managed_attribute_group=managed_attribute_group,
                     security_group_managed_attribute=security_group_managed_attribute,
                     security_file=security_file,
+                    writer=writer,
                 )
         return assignments
 
@@ -217,40 +270,56 @@ class DataSecuritySynapse:
         assigned_security_groups: dict,
         path: str,
         security_file: DataSecurityFile = None,
-    ):
+        tables: Collection[str] = None,
+        view_columns: Dict[str, Collection[str]] = None,
+    ) -> GrantDiff:
         """
-        Create SQL grant statement and apply security to syapse assets.
+        Reconcile the SELECT permissions on the views of the schema with the
+        security groups assigned in Purview. Only the missing GRANT and the
+        obsolete REVOKE statements are sent to Synapse, in batches.
+
+        When `tables` is given (e.g. the `security_tables` of a MetadataDiff),
+        only the permissions on those views are reconciled, and
+        assigned_security_groups only needs to contain those views.
+
+        `view_columns`, the names of all the columns of each view, allows a
+        view whose columns all have the same security group to be granted with
+        one view level permission, see desired_grants_from_assignments.
         """
         schema = f"{path}_{self._configuration.synapse_database_schema}"
-        self._cleanup_database_users(security_file)
+        users = self._get_security_groups(security_file)
+        self._ensure_database_users(users)
 
-        for assigned_security_group in assigned_security_groups:
-            assigned_security_group_value = assigned_security_groups.get(
-                assigned_security_group
+        desired = desired_grants_from_assignments(
+            assigned_security_groups, schema, view_columns
+        )
+        principals = set(users) | {grant.principal for grant in desired}
+        snapshot = self.get_permission_snapshot(principals=sorted(principals))
+        actual = actual_grants_from_snapshot(snapshot, principals, schema)
+        if tables is not None:
+            desired = {grant for grant in desired if grant.table in tables}
+            actual = {grant for grant in actual if grant.table in tables}
+
+        diff = diff_grants(desired, actual)
+        self.logger.info(
+            f"Permissions on {schema}: {len(diff.to_grant)} to grant, "
+            f"{len(diff.to_revoke)} to revoke, {len(diff.unchanged)} unchanged"
+        )
+        if not diff.is_empty:
+            statements = diff.statements()
+            print(
+                f"Permissions on {schema}: "
+                f"{len(diff.statements(coalesce=False))} statements compiled "
+                f"into {len(statements)}"
             )
-            if isinstance(assigned_security_group_value, dict):
-                for value in assigned_security_group_value:
-                    securtiy_group = assigned_security_group_value[value]
-                    if securtiy_group != "Not Assigned":
-                        sqlGrantStatement = (
-                            f"GRANT SELECT ON {schema}.{assigned_security_group}({value}) TO "
-                            f"{securtiy_group}"
-                        )
-                        self._sql_helper.execute_sql(sql=sqlGrantStatement)
-            else:
-                securtiy_group = assigned_security_groups[assigned_security_group]
-                if securtiy_group != "Not Assigned":
-                    sqlGrantStatement = (
-                        f"GRANT SELECT ON {schema}.{assigned_security_group} TO "
-                        f"{securtiy_group}"
-                    )
-                    self._sql_helper.execute_sql(sql=sqlGrantStatement)
-        return None
-
-    def _cleanup_database_users(self, security_file: DataSecurityFile = None):
+            self._sql_helper.execute_sql_batch(
+                statements, batch_size=len(statements)
+            )
+        return diff
 
+    def _get_security_groups(self, security_file: DataSecurityFile = None) -> List[str]:
         """
-        Drops and recreates all db useres associated to AD Security Groups
+        Get the AD Security Groups whose permissions are managed by the module
 
         Parameters
         ----------
@@ -258,21 +327,54 @@ class DataSecuritySynapse:
             If None, then the basic security is applied and the 3 Security Groups
             are gathered from config.
         """
-        users = [
+        if security_file:
+            return list(security_file.security_groups)
+
+        return [
             self._configuration.data_security_group_low,
             self._configuration.data_security_group_medium,
             self._configuration.data_security_group_high,
         ]
 
-        if security_file:
-            users = security_file.security_groups
-
-        for user in users:
-            self._sql_helper.drop_db_user(user)
-            self._sql_helper.create_db_user(user)
+    def _ensure_database_users(self, users: List[str]):
+        """
+        Creates the db users associated to AD Security Groups, if they don't exist.
+        Existing users are kept, together with their permissions.
+        """
+        self._sql_helper.provision_principals(
+            principals={user: None for user in users}, create_logins=False
+        )
 
         return None
 
+    def get_permission_snapshot(
+        self, principals: List[str] = None
+    ) -> PermissionSnapshot:
+        """
+        Get the permissions granted on all views and columns of the database
+        with a single query.
+
+        Parameters
+        ----------
+        principals: List[str] = None
+            Optional.
+            Restrict the snapshot to these principals. If None, all principals
+            holding a permission on a view are included.
+
+        Returns
+        -------
+        PermissionSnapshot
+            Indexed permissions, to be queried in memory.
+        """
+        sql_statement = PermissionSnapshot.sql_for_principals(principals)
+        result = self._sql_helper.execute_sql_result(sql=sql_statement)
+        snapshot = PermissionSnapshot.from_rows(result)
+        self.logger.info(
+            f"Permission snapshot loaded: {len(snapshot)} permissions for "
+            f"{len(snapshot.principals)} principals"
+        )
+        return snapshot
+
     def _list_db_permissions_for_user_in_synapse(
         self, db_user: str
     ) -> Dict[str, List[UserDbPermission]]:
@@ -283,41 +385,29 @@ class DataSecuritySynapse:
                     db_user (str): the db_user name
 
             Returns:
-                    result (bool): True if the user has an active GRANT statement, False otherwise
+                    result (dict): the table and column permissions of the user
         """
         try:
-            # get user id
-            sql_statement = f"SELECT principal_id FROM sys.database_principals WHERE [name] = '{db_user}'"
-            user_id = self._sql_helper.execute_sql_result(sql=sql_statement)[0][0]
-
-            sql_statement = (
-                f"SELECT sys.views.name AS TableName, permission_name AS PermissionName, state_desc as State "
-                f"FROM sys.database_permissions "
-                f"JOIN sys.views ON sys.database_permissions.major_id = sys.views.object_id "
-                f"WHERE grantee_principal_id = {user_id}"
-            )
-
-            result = self._sql_helper.execute_sql_result(sql=sql_statement)
+            snapshot = self.get_permission_snapshot(principals=[db_user])
+            permissions = snapshot.permissions_for(db_user)
 
             table_permissions = [
-                UserDbPermission(table=x[0], column="", permission=x[1], state=x[2])
-                for x in result
+                UserDbPermission(
+                    table=x.table, column="", permission=x.permission, state=x.state
+                )
+                for x in permissions
+                if not x.column
             ]
 
-            sql_statement = (
-                f"SELECT sys.views.name AS TableName, sys.columns.name as ColumnName, permission_name AS PermissionName, state_desc as State "
-                f"FROM sys.database_permissions "
-                f"JOIN sys.views ON sys.database_permissions.major_id = sys.views.object_id "
-                f"JOIN sys.columns ON sys.database_permissions.major_id = sys.columns.object_id "
-                f"AND sys.database_permissions.minor_id = sys.columns.column_id "
-                f"WHERE grantee_principal_id = {user_id}"
-            )
-
-            result = self._sql_helper.execute_sql_result(sql=sql_statement)
-
             column_permissions = [
-                UserDbPermission(table=x[0], column=x[1], permission=x[2], state=x[3])
-                for x in result
+                UserDbPermission(
+                    table=x.table,
+                    column=x.column,
+                    permission=x.permission,
+                    state=x.state,
+                )
+                for x in permissions
+                if x.column
             ]
 
             return {
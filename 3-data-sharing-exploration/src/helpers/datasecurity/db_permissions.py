@@ -0,0 +1,348 @@
+"""
+Database permissions helper module
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Collection, Dict, Iterable, List, Set, Tuple
+
+
+@dataclass(frozen=True)
+class DbPermission:
+    """
+    Represents a single permission granted to a principal over a view or column.
+    An empty column means the permission applies to the whole view.
+    """
+
+    principal: str
+    schema: str
+    table: str
+    column: str
+    permission: str
+    state: str
+
+
+class PermissionSnapshot:
+    """
+    In-memory, indexed view of the permissions granted on all views of a database.
+    Built from a single set-based query, it answers "who can see what" without
+    further round trips to Synapse.
+    """
+
+    # query returning one row per permission on a view (minor_id = 0) or on one of
+    # its columns (minor_id = column_id), for every database principal
+    SQL = (
+        "SELECT pr.name AS PrincipalName, s.name AS SchemaName, v.name AS TableName, "
+        "ISNULL(c.name, '') AS ColumnName, p.permission_name AS PermissionName, "
+        "p.state_desc AS State "
+        "FROM sys.database_permissions p "
+        "JOIN sys.database_principals pr ON p.grantee_principal_id = pr.principal_id "
+        "JOIN sys.views v ON p.major_id = v.object_id "
+        "JOIN sys.schemas s ON v.schema_id = s.schema_id "
+        "LEFT JOIN sys.columns c ON p.major_id = c.object_id "
+        "AND p.minor_id = c.column_id "
+        "WHERE p.class = 1"
+    )
+
+    def __init__(self, permissions: Iterable[DbPermission]):
+        self._permissions: List[DbPermission] = list(permissions)
+        self._by_principal: Dict[str, List[DbPermission]] = defaultdict(list)
+        self._by_object: Dict[Tuple[str, str, str], List[DbPermission]] = (
+            defaultdict(list)
+        )
+        for permission in self._permissions:
+            self._by_principal[permission.principal].append(permission)
+            key = (permission.schema, permission.table, permission.column)
+            self._by_object[key].append(permission)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> "PermissionSnapshot":
+        """
+        Build a snapshot from the rows returned by `PermissionSnapshot.SQL`
+        """
+        return cls(DbPermission(*row) for row in rows)
+
+    @classmethod
+    def sql_for_principals(cls, principals: Iterable[str] = None) -> str:
+        """
+        Returns the snapshot query, optionally restricted to some principals
+        """
+        if not principals:
+            return cls.SQL
+        names = ", ".join(
+            "'{}'".format(principal.replace("'", "''")) for principal in principals
+        )
+        return f"{cls.SQL} AND pr.name IN ({names})"
+
+    def __len__(self) -> int:
+        return len(self._permissions)
+
+    def __iter__(self):
+        return iter(self._permissions)
+
+    @property
+    def principals(self) -> Set[str]:
+        """
+        Principals holding at least one permission
+        """
+        return set(self._by_principal.keys())
+
+    def permissions_for(self, principal: str) -> List[DbPermission]:
+        """
+        All the permissions held by a principal
+        """
+        return list(self._by_principal.get(principal, []))
+
+    def permissions_on(
+        self, schema: str, table: str, column: str = ""
+    ) -> List[DbPermission]:
+        """
+        Permissions defined exactly on a view (column="") or on one of its columns
+        """
+        return list(self._by_object.get((schema, table, column), []))
+
+    def can_select(
+        self, principal: str, schema: str, table: str, column: str = ""
+    ) -> bool:
+        """
+        True if the principal can SELECT the view (or the column of the view).
+        A DENY on the view or on the column wins over any GRANT.
+        """
+        keys = [(schema, table, "")]
+        if column:
+            keys.append((schema, table, column))
+        granted = False
+        for key in keys:
+            for permission in self._by_object.get(key, []):
+                if (
+                    permission.principal != principal
+                    or permission.permission != "SELECT"
+                ):
+                    continue
+                if permission.state == "DENY":
+                    return False
+                if permission.state.startswith("GRANT"):
+                    granted = True
+        return granted
+
+    def who_can_select(self, schema: str, table: str, column: str = "") -> Set[str]:
+        """
+        Principals that can SELECT the view (or the column of the view)
+        """
+        keys = [(schema, table, "")]
+        if column:
+            keys.append((schema, table, column))
+        candidates = {
+            permission.principal
+            for key in keys
+            for permission in self._by_object.get(key, [])
+        }
+        return {
+            principal
+            for principal in candidates
+            if self.can_select(principal, schema, table, column)
+        }
+
+
+@dataclass(frozen=True)
+class SelectGrant:
+    """
+    A SELECT permission of a principal over a view, or over a single column
+    of the view when column is not empty.
+    """
+
+    principal: str
+    schema: str
+    table: str
+    column: str = ""
+
+    @property
+    def securable(self) -> str:
+        securable = f"[{self.schema}].[{self.table}]"
+        if self.column:
+            securable += f"([{self.column}])"
+        return securable
+
+    def grant_statement(self) -> str:
+        return f"GRANT SELECT ON {self.securable} TO [{self.principal}]"
+
+    def revoke_statement(self) -> str:
+        return f"REVOKE SELECT ON {self.securable} FROM [{self.principal}]"
+
+
+@dataclass
+class GrantDiff:
+    """
+    Changes needed to move the actual grants to the desired ones
+    """
+
+    to_grant: Set[SelectGrant]
+    to_revoke: Set[SelectGrant]
+    unchanged: Set[SelectGrant]
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.to_grant and not self.to_revoke
+
+    def statements(self, coalesce: bool = True) -> List[str]:
+        """
+        REVOKE statements first: revoking a view level permission also revokes
+        the column level permissions, so the new grants must come after.
+
+        Parameters
+        ----------
+        coalesce: bool = True
+            If True, the column level permissions of a principal on the same view
+            are compiled into a single statement with a column list.
+        """
+        if not coalesce:
+            revokes = sorted(self.to_revoke, key=_key)
+            grants = sorted(self.to_grant, key=_key)
+            return [grant.revoke_statement() for grant in revokes] + [
+                grant.grant_statement() for grant in grants
+            ]
+        return compile_statements("REVOKE", self.to_revoke) + compile_statements(
+            "GRANT", self.to_grant
+        )
+
+
+def _key(grant: SelectGrant) -> Tuple[str, str, str, str]:
+    return (grant.schema, grant.table, grant.principal, grant.column)
+
+
+def compile_statements(action: str, grants: Iterable[SelectGrant]) -> List[str]:
+    """
+    Compiles SELECT grants into GRANT or REVOKE statements, with one statement
+    per principal and view: column level permissions on the same view are
+    merged into a single column list.
+    E.g. GRANT SELECT ON [v1_SalesLT].[Customer]([FirstName], [LastName]) TO [group]
+
+    Parameters
+    ----------
+    action: str
+        Either GRANT or REVOKE
+    """
+    preposition = {"GRANT": "TO", "REVOKE": "FROM"}[action]
+    columns_per_view: Dict[Tuple[str, str, str], List[str]] = defaultdict(list)
+    for grant in grants:
+        columns_per_view[(grant.schema, grant.table, grant.principal)].append(
+            grant.column
+        )
+
+    statements = []
+    for (schema, table, principal), columns in sorted(columns_per_view.items()):
+        securable = f"[{schema}].[{table}]"
+        # a view level permission and column level ones can't share a statement
+        if "" in columns:
+            statements.append(
+                f"{action} SELECT ON {securable} {preposition} [{principal}]"
+            )
+        column_list = ", ".join(f"[{column}]" for column in sorted(columns) if column)
+        if column_list:
+            statements.append(
+                f"{action} SELECT ON {securable}({column_list}) "
+                f"{preposition} [{principal}]"
+            )
+    return statements
+
+
+def desired_grants_from_assignments(
+    assigned_security_groups: dict,
+    schema: str,
+    view_columns: Dict[str, Collection[str]] = None,
+) -> Set[SelectGrant]:
+    """
+    Converts the security groups assigned to views in Purview to SELECT grants.
+
+    Parameters
+    ----------
+    assigned_security_groups: dict(str: str | dict)
+        key: view name
+        value:  security group in case of table level security
+                dict(column_name: security group) in case of column level security
+
+    schema: str
+        The schema of the views
+
+    view_columns: Dict[str, Collection[str]] = None
+        Optional.
+        Names of all the columns of each view, e.g. from the MetadataIndex.
+
+    When every column of a view, according to view_columns, is assigned to the
+    same security group, a single view level grant is used instead of the
+    column level ones. Columns missing from the assignments (e.g. not found in
+    Purview) keep the view on column level grants, so that they are not
+    exposed; without view_columns, column level grants are always used.
+    """
+    view_columns = view_columns or {}
+    desired = set()
+    for view, value in assigned_security_groups.items():
+        if isinstance(value, dict):
+            security_groups = set(value.values())
+            columns = view_columns.get(view)
+            if (
+                len(security_groups) == 1
+                and columns is not None
+                and set(columns) <= set(value)
+            ):
+                value = security_groups.pop()
+                if value and value != "Not Assigned":
+                    desired.add(SelectGrant(value, schema, view))
+                continue
+            for column, security_group in value.items():
+                if security_group and security_group != "Not Assigned":
+                    desired.add(SelectGrant(security_group, schema, view, column))
+        elif value and value != "Not Assigned":
+            desired.add(SelectGrant(value, schema, view))
+    return desired
+
+
+def actual_grants_from_snapshot(
+    snapshot: PermissionSnapshot, principals: Iterable[str], schema: str
+) -> Set[SelectGrant]:
+    """
+    SELECT permissions currently granted to the principals on the schema views
+    """
+    actual = set()
+    for principal in principals:
+        for permission in snapshot.permissions_for(principal):
+            if (
+                permission.schema == schema
+                and permission.permission == "SELECT"
+                and permission.state.startswith("GRANT")
+            ):
+                actual.add(
+                    SelectGrant(
+                        principal=principal,
+                        schema=permission.schema,
+                        table=permission.table,
+                        column=permission.column,
+                    )
+                )
+    return actual
+
+
+def diff_grants(desired: Set[SelectGrant], actual: Set[SelectGrant]) -> GrantDiff:
+    """
+    Compares desired and actual grants.
+
+    A view level permission that gets revoked also takes away the column level
+    permissions of the same principal on the view, so those are granted again.
+    """
+    to_revoke = actual - desired
+    revoked_views = {
+        (grant.principal, grant.schema, grant.table)
+        for grant in to_revoke
+        if not grant.column
+    }
+    to_grant = {
+        grant
+        for grant in desired
+        if grant not in actual
+        or (
+            grant.column
+            and (grant.principal, grant.schema, grant.table) in revoked_views
+        )
+    }
+    return GrantDiff(
+        to_grant=to_grant, to_revoke=to_revoke, unchanged=desired - to_grant
+    )
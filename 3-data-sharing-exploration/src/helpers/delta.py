@@ -0,0 +1,474 @@
+"""
+Delta log reader module
+-----------------------
+Reads the transaction log of a delta table (the `_delta_log` folder) from a
+local folder or from ADLS, without Spark or Synapse: current version, schema,
+partition columns and the live data files with their size and statistics.
+
+The state is loaded from the checkpoint referenced by `_last_checkpoint`, then
+the json commits written after it are replayed. File actions are reconciled
+with Arrow compute functions, so large logs are not processed row by row.
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.identity import DefaultAzureCredential
+from azure.storage.filedatalake import DataLakeServiceClient
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pa_json
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+
+DELTA_LOG = "_delta_log"
+
+
+def _partition_values_type():
+    return pa.map_(pa.string(), pa.string())
+
+
+class LocalFileSystem:
+    """Reads the files of a delta table from a local folder"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def read(self, path: str) -> Optional[bytes]:
+        """
+        Content of a file relative to the root, or None if it does not exist
+        """
+        try:
+            with open(os.path.join(self.root, path), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self, path: str) -> List[str]:
+        """
+        Names of the files in a folder relative to the root
+        """
+        try:
+            return sorted(os.listdir(os.path.join(self.root, path)))
+        except FileNotFoundError:
+            return []
+
+    def write(self, path: str, data: bytes, overwrite: bool = True):
+        """
+        Writes a file relative to the root. Without overwrite, the write fails
+        with FileExistsError if the file exists, as needed by delta commits.
+        """
+        full_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if not overwrite:
+            with open(full_path, "xb") as file:
+                file.write(data)
+            return
+        temp_path = f"{full_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, full_path)
+
+
+class AdlsFileSystem:
+    """Reads the files of a delta table from an ADLS Gen2 container"""
+
+    def __init__(
+        self,
+        account_name: str,
+        container_name: str,
+        root: str = "",
+        credential=None,
+    ):
+        self.root = root.strip("/")
+        service_client = DataLakeServiceClient(
+            account_url=f"https://{account_name}.dfs.core.windows.net",
+            credential=credential or DefaultAzureCredential(),
+        )
+        self._file_system_client = service_client.get_file_system_client(
+            container_name
+        )
+
+    def _full_path(self, path: str) -> str:
+        return f"{self.root}/{path}" if self.root else path
+
+    def read(self, path: str) -> Optional[bytes]:
+        file_client = self._file_system_client.get_file_client(self._full_path(path))
+        try:
+            return file_client.download_file().readall()
+        except ResourceNotFoundError:
+            return None
+
+    def list(self, path: str) -> List[str]:
+        try:
+            return sorted(
+                item.name.rsplit("/", 1)[-1]
+                for item in self._file_system_client.get_paths(
+                    self._full_path(path), recursive=False
+                )
+            )
+        except ResourceNotFoundError:
+            return []
+
+    def write(self, path: str, data: bytes, overwrite: bool = True):
+        file_client = self._file_system_client.get_file_client(self._full_path(path))
+        try:
+            file_client.upload_data(data, overwrite=overwrite)
+        except ResourceExistsError:
+            raise FileExistsError(f"{path} already exists")
+
+
+FileSystem = Union[LocalFileSystem, AdlsFileSystem]
+
+
+@dataclass(frozen=True)
+class DeltaColumn:
+    name: str
+    # delta type, e.g. integer, string, decimal(19,4), or the json of a
+    # struct, array or map type
+    type: str
+    nullable: bool = True
+
+
+@dataclass
+class DeltaSnapshot:
+    """State of a delta table at a version"""
+
+    path: str
+    version: int
+    columns: List[DeltaColumn]
+    partition_columns: List[str]
+    # one row per live data file: path, size, modification_time,
+    # partition_values and stats (json string written by the writer)
+    files: "pa.Table"
+    configuration: Dict[str, str] = field(default_factory=dict)
+    # time of the latest commit replayed, None if only a checkpoint was read
+    commit_time: Optional[datetime] = None
+    # latest metaData and protocol actions, and txn actions by appId
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    protocol: Dict[str, Any] = field(default_factory=dict)
+    transactions: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # version of the last checkpoint, -1 if there is none
+    checkpoint_version: int = -1
+
+    @property
+    def num_files(self) -> int:
+        return self.files.num_rows
+
+    @property
+    def size_bytes(self) -> int:
+        return pc.sum(self.files["size"]).as_py() or 0
+
+    @property
+    def last_modified(self) -> Optional[datetime]:
+        """
+        Modification time of the newest live file
+        """
+        newest = pc.max(self.files["modification_time"]).as_py()
+        if newest is None:
+            return None
+        return datetime.fromtimestamp(newest / 1000, tz=timezone.utc)
+
+    def file_stats(self) -> "pa.Table":
+        """
+        Statistics of each live file: path, num_records and the minValues,
+        maxValues and nullCount structs, with one field per column.
+        The json stats of all the files are parsed in a single pass.
+        """
+        stats = pc.fill_null(self.files["stats"], "{}")
+        if len(stats) == 0:
+            return pa.table({"path": self.files["path"]})
+        lines = "\n".join(
+            value.replace("\n", " ") for value in stats.to_pylist()
+        ).encode("utf-8")
+        parsed = pa_json.read_json(pa.py_buffer(lines))
+        columns = {"path": self.files["path"]}
+        for name, alias in (
+            ("numRecords", "num_records"),
+            ("minValues", "min_values"),
+            ("maxValues", "max_values"),
+            ("nullCount", "null_count"),
+        ):
+            if name in parsed.column_names:
+                columns[alias] = parsed[name]
+        return pa.table(columns)
+
+    @property
+    def num_records(self) -> Optional[int]:
+        """
+        Number of rows, from the file statistics, if all the files have them
+        """
+        stats = self.file_stats()
+        if "num_records" not in stats.column_names:
+            return None
+        if stats["num_records"].null_count:
+            return None
+        return pc.sum(stats["num_records"]).as_py() or 0
+
+
+class DeltaLogReader:
+    """
+    Reads the delta tables of a local folder or an ADLS container
+
+    Example
+    -------
+        reader = DeltaLogReader.local("sample_data")
+        snapshot = reader.snapshot("v1/SalesLT_Customer")
+        print(snapshot.version, snapshot.columns, snapshot.num_files)
+    """
+
+    def __init__(self, file_system: FileSystem):
+        if pa is None:
+            raise ImportError("pyarrow is required to read delta logs")
+        self.logger = logging.getLogger(__name__)
+        self._file_system = file_system
+
+    @property
+    def file_system(self) -> FileSystem:
+        return self._file_system
+
+    @classmethod
+    def local(cls, root: str) -> "DeltaLogReader":
+        return cls(LocalFileSystem(root))
+
+    @classmethod
+    def adls(
+        cls, account_name: str, container_name: str, root: str = ""
+    ) -> "DeltaLogReader":
+        return cls(AdlsFileSystem(account_name, container_name, root))
+
+    def list_tables(self, path: str = "") -> List[str]:
+        """
+        Delta tables directly under a folder, e.g. v1 -> [v1/SalesLT_Address, ...]
+        """
+        prefix = f"{path.strip('/')}/" if path.strip("/") else ""
+        return [
+            f"{prefix}{name}"
+            for name in self._file_system.list(path)
+            if self._file_system.list(f"{prefix}{name}/{DELTA_LOG}")
+        ]
+
+    def snapshot(self, table_path: str) -> DeltaSnapshot:
+        """
+        Current state of a delta table
+
+        Parameters
+        ----------
+        table_path: str
+            folder of the table, relative to the root, e.g. v1/SalesLT_Customer
+
+        Raises
+        ------
+        FileNotFoundError
+            if the folder has no delta log
+        """
+        table_folder = table_path.strip("/")
+        log_path = f"{table_folder}/{DELTA_LOG}" if table_folder else DELTA_LOG
+        checkpoint_version, checkpoint = self._read_checkpoint(log_path)
+
+        # commits after the checkpoint are numbered sequentially
+        version = checkpoint_version
+        commits = []
+        while True:
+            content = self._file_system.read(f"{log_path}/{version + 1:020d}.json")
+            if content is None:
+                break
+            version += 1
+            commits.append([json.loads(line) for line in content.splitlines() if line])
+
+        if version < 0:
+            raise FileNotFoundError(f"No delta log found in {table_path}")
+
+        metadata = protocol = None
+        transactions = {}
+        if checkpoint is not None:
+            metadata = self._checkpoint_action(checkpoint, "metaData")
+            protocol = self._checkpoint_action(checkpoint, "protocol")
+            if "txn" in checkpoint.column_names:
+                txn = checkpoint["txn"]
+                for row in txn.filter(pc.is_valid(txn)).to_pylist():
+                    transactions[row["appId"]] = row
+
+        commit_time = None
+        actions = []
+        for commit in commits:
+            for action in commit:
+                if "add" in action or "remove" in action:
+                    actions.append(action)
+                elif "metaData" in action:
+                    metadata = action["metaData"]
+                elif "protocol" in action:
+                    protocol = action["protocol"]
+                elif "txn" in action:
+                    transactions[action["txn"]["appId"]] = action["txn"]
+                elif "commitInfo" in action:
+                    commit_time = action["commitInfo"].get("timestamp", commit_time)
+
+        if metadata is None:
+            raise ValueError(f"No metaData action found in the log of {table_path}")
+
+        files = self._reconcile_files(checkpoint, actions)
+        schema = json.loads(metadata["schemaString"])
+        snapshot = DeltaSnapshot(
+            path=table_path,
+            version=version,
+            columns=[
+                DeltaColumn(
+                    name=column["name"],
+                    type=(
+                        column["type"]
+                        if isinstance(column["type"], str)
+                        else json.dumps(column["type"])
+                    ),
+                    nullable=column.get("nullable", True),
+                )
+                for column in schema["fields"]
+            ],
+            partition_columns=list(metadata.get("partitionColumns") or []),
+            files=files,
+            configuration=dict(metadata.get("configuration") or {}),
+            commit_time=(
+                datetime.fromtimestamp(commit_time / 1000, tz=timezone.utc)
+                if commit_time
+                else None
+            ),
+            metadata=metadata,
+            protocol=protocol or {},
+            transactions=transactions,
+            checkpoint_version=checkpoint_version,
+        )
+        self.logger.info(
+            f"Delta table {table_path} at version {version}: "
+            f"{snapshot.num_files} files, {len(commits)} commits after checkpoint"
+        )
+        return snapshot
+
+    def _read_checkpoint(self, log_path: str):
+        """
+        Version and content of the last checkpoint, or (-1, None)
+        """
+        content = self._file_system.read(f"{log_path}/_last_checkpoint")
+        if content is None:
+            return -1, None
+        last_checkpoint = json.loads(content)
+        version = last_checkpoint["version"]
+        parts = last_checkpoint.get("parts")
+        if parts:
+            names = [
+                f"{version:020d}.checkpoint.{part:010d}.{parts:010d}.parquet"
+                for part in range(1, parts + 1)
+            ]
+        else:
+            names = [f"{version:020d}.checkpoint.parquet"]
+
+        tables = []
+        for name in names:
+            data = self._file_system.read(f"{log_path}/{name}")
+            if data is None:
+                raise FileNotFoundError(f"Checkpoint {log_path}/{name} not found")
+            parquet_file = pq.ParquetFile(pa.BufferReader(data))
+            columns = [
+                name
+                for name in ("add", "metaData", "protocol", "txn")
+                if name in parquet_file.schema_arrow.names
+            ]
+            tables.append(parquet_file.read(columns=columns))
+        return version, pa.concat_tables(tables, promote_options="permissive")
+
+    @staticmethod
+    def _checkpoint_action(checkpoint: "pa.Table", name: str) -> Optional[dict]:
+        """
+        The action of a checkpoint stored once, e.g. metaData or protocol
+        """
+        if name not in checkpoint.column_names:
+            return None
+        actions = checkpoint[name]
+        rows = actions.filter(pc.is_valid(actions))
+        if len(rows) == 0:
+            return None
+        row = rows[0].as_py()
+        # maps are read as lists of (key, value) tuples
+        if "configuration" in row:
+            row["configuration"] = dict(row["configuration"] or [])
+        if row.get("format"):
+            row["format"]["options"] = dict(row["format"].get("options") or [])
+        return row
+
+    @staticmethod
+    def _reconcile_files(checkpoint: Optional["pa.Table"], actions: list) -> "pa.Table":
+        """
+        Live files: the adds of the checkpoint, then the adds and removes of the
+        later commits. The last action on a path wins.
+        """
+        schema = pa.schema(
+            [
+                ("path", pa.string()),
+                ("size", pa.int64()),
+                ("modification_time", pa.int64()),
+                ("partition_values", _partition_values_type()),
+                ("stats", pa.string()),
+                ("is_add", pa.bool_()),
+                ("sequence", pa.int64()),
+            ]
+        )
+        tables = []
+        if checkpoint is not None:
+            adds = checkpoint["add"].combine_chunks()
+            adds = adds.filter(pc.is_valid(adds))
+            tables.append(
+                pa.table(
+                    {
+                        "path": pc.struct_field(adds, "path"),
+                        "size": pc.struct_field(adds, "size"),
+                        "modification_time": pc.struct_field(adds, "modificationTime"),
+                        "partition_values": pc.struct_field(
+                            adds, "partitionValues"
+                        ).cast(_partition_values_type()),
+                        "stats": pc.struct_field(adds, "stats"),
+                        "is_add": pa.array([True] * len(adds), pa.bool_()),
+                        "sequence": pa.array([0] * len(adds), pa.int64()),
+                    },
+                    schema=schema,
+                )
+            )
+        if actions:
+            rows = []
+            for sequence, action in enumerate(actions, start=1):
+                is_add = "add" in action
+                file_action = action["add"] if is_add else action["remove"]
+                rows.append(
+                    {
+                        "path": file_action["path"],
+                        "size": file_action.get("size"),
+                        "modification_time": file_action.get("modificationTime"),
+                        "partition_values": list(
+                            (file_action.get("partitionValues") or {}).items()
+                        ),
+                        "stats": file_action.get("stats"),
+                        "is_add": is_add,
+                        "sequence": sequence,
+                    }
+                )
+            tables.append(pa.Table.from_pylist(rows, schema=schema))
+
+        if not tables:
+            return schema.empty_table().drop_columns(["is_add", "sequence"])
+        log = pa.concat_tables(tables)
+        if actions:
+            # keep the last action of each path: sorted by path and newest
+            # first, it is the first row of each run of equal paths
+            log = log.sort_by([("path", "ascending"), ("sequence", "descending")])
+            paths = log["path"].combine_chunks()
+            first = pc.not_equal(paths[1:], paths[:-1])
+            log = log.filter(pa.concat_arrays([pa.array([True]), first]))
+        else:
+            log = log.sort_by("path")
+        log = log.filter(pc.field("is_add"))
+        return log.drop_columns(["is_add", "sequence"])
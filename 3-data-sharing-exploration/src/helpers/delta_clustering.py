@@ -0,0 +1,420 @@
+"""
+Delta clustering module
+-----------------------
+Rewrites the data files of delta tables sorted by their key or cluster_by
+columns, so that the min/max statistics of the row groups let Synapse and
+DuckDB skip most of the data of selective queries.
+
+Row groups are sized in bytes and dictionary encoding is only kept for the
+columns with few distinct values. The spread of the statistics of each column
+is reported before and after the rewrite.
+"""
+import json
+import logging
+import math
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from .delta import DeltaSnapshot
+from .delta_maintenance import MB, DeltaMaintenance
+from .metadata import Metadata, Table
+from .metadata_validation import MetadataValidator
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+
+
+def _overlap(ranges: List[Tuple[object, object]]) -> float:
+    """
+    Average fraction of the row groups whose min/max range overlaps the range
+    of a row group, which is the fraction read by an equality filter on a
+    value of the column
+    """
+    count = len(ranges)
+    if count == 0:
+        return 0.0
+    lows = sorted(low for low, _ in ranges)
+    highs = sorted(high for _, high in ranges)
+    read = 0
+    for low, high in ranges:
+        # row groups entirely below or above this one are skipped
+        below = bisect_left(highs, low)
+        above = count - bisect_right(lows, high)
+        read += count - below - above
+    return read / (count * count)
+
+
+def stats_spread(
+    table: "pa.Table", row_group_rows: List[int], columns: List[str] = None
+) -> Dict[str, float]:
+    """
+    Spread of the min/max statistics of each column over the row groups of
+    the table: 1.0 when every row group has to be read for any value of the
+    column, 1 / row groups when the ranges of the row groups do not overlap.
+    Columns without an order (e.g. structs) are left out.
+
+    Parameters
+    ----------
+    table: pa.Table
+        rows of the data files, in the order of the files
+
+    row_group_rows: List[int]
+        number of rows of each row group of the files, in the same order
+    """
+    spread = {}
+    for name in columns or table.column_names:
+        column = table[name]
+        ranges = []
+        start = 0
+        try:
+            for rows in row_group_rows:
+                min_max = pc.min_max(column.slice(start, rows))
+                start += rows
+                low = min_max["min"].as_py()
+                # row groups with only nulls are skipped by any filter
+                if low is not None:
+                    ranges.append((low, min_max["max"].as_py()))
+            spread[name] = _overlap(ranges)
+        except (pa.ArrowNotImplementedError, TypeError):
+            continue
+    return spread
+
+
+@dataclass
+class ClusterResult:
+    table_path: str
+    version: int
+    sort_columns: Tuple[str, ...]
+    files_before: int = 0
+    files_after: int = 0
+    row_groups_before: int = 0
+    row_groups_after: int = 0
+    # spread of the statistics by column, see stats_spread
+    spread_before: Dict[str, float] = field(default_factory=dict)
+    spread_after: Dict[str, float] = field(default_factory=dict)
+    # files of the partitions to sort, committed when rewritten is set
+    files_rewritten: int = 0
+    rewritten: bool = False
+    error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.table_path}: {self.error}"
+        if self.rewritten:
+            status = "rewritten"
+        else:
+            status = "to rewrite" if self.files_rewritten else "unchanged"
+        lines = [
+            f"{self.table_path} version {self.version} sorted by "
+            f"{', '.join(self.sort_columns)} ({status}): {self.files_before} -> "
+            f"{self.files_after} files, {self.row_groups_before} -> "
+            f"{self.row_groups_after} row groups"
+        ]
+        lines.extend(
+            f"    {name}: {before:.0%} -> {self.spread_after.get(name, before):.0%} "
+            "of row groups read"
+            for name, before in self.spread_before.items()
+        )
+        return "\n".join(lines)
+
+
+@dataclass
+class _Partition:
+    folder: str
+    values: Dict[str, str]
+    paths: List[str]
+    size: int
+    data: "pa.Table"
+    row_group_rows: List[int]
+    sorted_data: "pa.Table" = None
+    already_sorted: bool = False
+
+
+class DeltaClustering:
+    """
+    Sorts the data files of delta tables by the cluster_by columns of the
+    metadata, or by their key columns. Each partition is sorted separately and
+    rewritten in files of the target size of the maintenance, in one commit.
+    The data of a table is loaded in memory.
+
+    Example
+    -------
+        maintenance = DeltaMaintenance(DeltaLogReader.local("sample_data"))
+        clustering = DeltaClustering(maintenance, row_group_size=16 * MB)
+        for result in clustering.cluster(metadata, schema="SalesLT"):
+            print(result)
+    """
+
+    def __init__(
+        self,
+        maintenance: DeltaMaintenance,
+        row_group_size: int = 64 * MB,
+        dictionary_ratio: float = 0.5,
+        max_workers: int = 4,
+    ):
+        """
+        Parameters
+        ----------
+        maintenance: DeltaMaintenance
+            maintenance whose reader, rewrite and target file size are used
+
+        row_group_size: int = 64 MB
+            uncompressed size of the row groups written. Smaller row groups
+            skip more data, at the cost of larger footers
+
+        dictionary_ratio: float = 0.5
+            columns are dictionary encoded when their number of distinct values
+            is at most this fraction of the rows
+
+        max_workers: int = 4
+            number of tables clustered in parallel
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required to cluster delta tables")
+        self.logger = logging.getLogger(__name__)
+        self._maintenance = maintenance
+        self._reader = maintenance.reader
+        self._row_group_size = row_group_size
+        self._dictionary_ratio = dictionary_ratio
+        self._max_workers = max_workers
+
+    @staticmethod
+    def sort_columns(table: Table) -> List[str]:
+        """
+        Columns a table is sorted by: its cluster_by columns, else its keys
+        """
+        return list(table.cluster_by) or table.key_columns
+
+    def cluster(
+        self, metadata: Metadata, schema: str, dry_run: bool = False
+    ) -> List[ClusterResult]:
+        """
+        Clusters the tables of a metadata file that declare sort columns
+        """
+        tables = []
+        for table in metadata.tables:
+            columns = self.sort_columns(table)
+            if not columns:
+                self.logger.info(f"No key or cluster_by columns for {table.name}")
+                continue
+            folder = MetadataValidator.table_folder(metadata.path, schema, table.name)
+            tables.append((folder, columns))
+
+        def cluster_table(folder_columns: Tuple[str, List[str]]) -> ClusterResult:
+            folder, columns = folder_columns
+            try:
+                return self.cluster_table(folder, columns, dry_run)
+            except Exception as ex:
+                self.logger.error(f"Clustering of {folder} failed: {ex}")
+                return ClusterResult(folder, -1, tuple(columns), error=str(ex))
+
+        with ThreadPoolExecutor(self._max_workers) as executor:
+            return list(executor.map(cluster_table, tables))
+
+    def cluster_table(
+        self, table_path: str, sort_columns: List[str], dry_run: bool = False
+    ) -> ClusterResult:
+        """
+        Sorts a delta table by the given columns. Partitions already sorted,
+        with the planned number of files and row groups, are not rewritten.
+        """
+        snapshot = self._reader.snapshot(table_path)
+        self._maintenance.check_supported(snapshot)
+        names = {column.name for column in snapshot.columns}
+        missing = [name for name in sort_columns if name not in names]
+        if missing:
+            raise ValueError(f"Sort columns {missing} not in {table_path}")
+        # partition columns are constant within the files of a partition
+        sort_columns = [
+            name for name in sort_columns if name not in snapshot.partition_columns
+        ]
+        if not sort_columns:
+            raise ValueError(f"{table_path} is only sorted by partition columns")
+        result = ClusterResult(
+            table_path, snapshot.version, tuple(sort_columns), snapshot.num_files
+        )
+        partitions = self._read_partitions(snapshot)
+        if not partitions:
+            return result
+
+        sort_keys = [(name, "ascending") for name in sort_columns]
+        for partition in partitions:
+            indices = pc.sort_indices(partition.data, sort_keys=sort_keys)
+            partition.sorted_data = partition.data.take(indices)
+            partition.already_sorted = pc.all(
+                pc.equal(indices, pa.array(range(len(indices)), indices.type))
+            ).as_py() in (True, None)
+
+        total_rows = sum(partition.data.num_rows for partition in partitions)
+        total_bytes = sum(partition.data.nbytes for partition in partitions)
+        row_group_rows = max(1, self._row_group_size * total_rows // (total_bytes or 1))
+        write_options = {
+            "row_group_size": row_group_rows,
+            "use_dictionary": self._dictionary_columns(partitions),
+            "sorting_columns": pq.SortingColumn.from_ordering(
+                partitions[0].data.schema, sort_keys
+            ),
+        }
+
+        added = []
+        removed = []
+        spread_before: Dict[str, List[float]] = {}
+        spread_after: Dict[str, List[float]] = {}
+        for partition in partitions:
+            files = self._plan_files(partition, row_group_rows)
+            planned_rows = [
+                rows
+                for file_rows in files
+                for rows in self._split_rows(file_rows, row_group_rows)
+            ]
+            before = stats_spread(partition.data, partition.row_group_rows)
+            after = stats_spread(partition.sorted_data, planned_rows)
+            # weighted by the rows of the partition
+            for spread, values in ((before, spread_before), (after, spread_after)):
+                for name, value in spread.items():
+                    values.setdefault(name, []).append(
+                        value * partition.data.num_rows
+                    )
+
+            unchanged = (
+                partition.already_sorted
+                and len(files) == len(partition.paths)
+                and len(planned_rows) == len(partition.row_group_rows)
+            )
+            result.row_groups_before += len(partition.row_group_rows)
+            if unchanged:
+                result.files_after += len(partition.paths)
+                result.row_groups_after += len(partition.row_group_rows)
+                continue
+            result.files_after += len(files)
+            result.row_groups_after += len(planned_rows)
+            removed.extend(partition.paths)
+            start = 0
+            for file_rows in files:
+                added.append(
+                    (
+                        partition.folder,
+                        partition.sorted_data.slice(start, file_rows),
+                        partition.values,
+                    )
+                )
+                start += file_rows
+
+        # files outside of the partitions read (absolute paths) are kept
+        result.files_after += snapshot.num_files - sum(
+            len(partition.paths) for partition in partitions
+        )
+        result.spread_before = {
+            name: sum(values) / total_rows for name, values in spread_before.items()
+        }
+        result.spread_after = {
+            name: sum(values) / total_rows for name, values in spread_after.items()
+        }
+        result.files_rewritten = len(removed)
+        if removed and not dry_run:
+            snapshot = self._maintenance.rewrite(
+                snapshot,
+                removed,
+                added,
+                operation="OPTIMIZE",
+                operation_parameters={
+                    "sortBy": json.dumps(sort_columns),
+                    "rowGroupSize": str(row_group_rows),
+                },
+                write_options=write_options,
+            )
+            result.version = snapshot.version
+            result.rewritten = True
+        return result
+
+    def _read_partitions(self, snapshot: DeltaSnapshot) -> List[_Partition]:
+        partitions: Dict[str, _Partition] = {}
+        files = snapshot.files
+        for path, size, partition_values in zip(
+            files["path"].to_pylist(),
+            files["size"].to_pylist(),
+            files["partition_values"].to_pylist(),
+        ):
+            # absolute paths point outside of the table folder
+            if "://" in path:
+                continue
+            values = dict(partition_values or [])
+            key = json.dumps(values, sort_keys=True)
+            if key not in partitions:
+                folder = path.rsplit("/", 1)[0] if "/" in path else ""
+                partitions[key] = _Partition(
+                    folder=unquote(folder),
+                    values=values,
+                    paths=[],
+                    size=0,
+                    data=None,
+                    row_group_rows=[],
+                )
+            partition = partitions[key]
+            partition.paths.append(path)
+            partition.size += size
+            parquet_file = self._maintenance.read_file(snapshot, path)
+            metadata = parquet_file.metadata
+            partition.row_group_rows.extend(
+                metadata.row_group(index).num_rows
+                for index in range(metadata.num_row_groups)
+            )
+            data = parquet_file.read()
+            partition.data = (
+                data
+                if partition.data is None
+                else pa.concat_tables(
+                    [partition.data, data], promote_options="permissive"
+                )
+            )
+        return [
+            partition for partition in partitions.values() if partition.data.num_rows
+        ]
+
+    def _plan_files(self, partition: _Partition, row_group_rows: int) -> List[int]:
+        """
+        Rows of each file of a partition: files of about the target size, made
+        of whole row groups
+        """
+        num_rows = partition.data.num_rows
+        count = max(1, math.ceil(partition.size / self._maintenance.target_file_size))
+        file_rows = math.ceil(num_rows / count)
+        file_rows = math.ceil(file_rows / row_group_rows) * row_group_rows
+        files = [file_rows] * (num_rows // file_rows)
+        if num_rows % file_rows:
+            files.append(num_rows % file_rows)
+        return files
+
+    @staticmethod
+    def _split_rows(file_rows: int, row_group_rows: int) -> List[int]:
+        groups = [row_group_rows] * (file_rows // row_group_rows)
+        if file_rows % row_group_rows:
+            groups.append(file_rows % row_group_rows)
+        return groups
+
+    def _dictionary_columns(self, partitions: List[_Partition]) -> List[str]:
+        """
+        Columns with few distinct values in every partition. Dictionaries of
+        the other columns grow past the page limit and fall back to plain
+        encoding after being built for nothing.
+        """
+        columns = []
+        for name in partitions[0].data.column_names:
+            try:
+                low_cardinality = all(
+                    pc.count_distinct(partition.data[name]).as_py()
+                    <= self._dictionary_ratio * partition.data.num_rows
+                    for partition in partitions
+                )
+            except pa.ArrowNotImplementedError:
+                continue
+            if low_cardinality:
+                columns.append(name)
+        return columns
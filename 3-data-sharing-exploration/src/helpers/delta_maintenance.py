@@ -0,0 +1,653 @@
+"""
+Delta maintenance module
+------------------------
+Keeps the delta tables read by the views fast to query: small data files are
+compacted into files of a target size, and checkpoints are written so that
+readers do not have to replay many json commits.
+
+Works on the same file systems as the delta log reader (local folder or ADLS).
+Rewrites are committed as new versions of the table, with dataChange false, so
+concurrent readers keep a consistent view of the data.
+"""
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from .delta import DELTA_LOG, DeltaLogReader, DeltaSnapshot
+from .metadata import Metadata
+from .metadata_validation import MetadataValidator
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+
+MB = 1024 * 1024
+
+# longest string kept in the min/max statistics of a file
+_MAX_STRING_STATS = 32
+
+_ENGINE_INFO = "eds-data-exploration"
+
+
+class DeltaConflictError(Exception):
+    """Raised when another writer committed the version being written"""
+
+
+@dataclass
+class MaintenanceResult:
+    table_path: str
+    version: int
+    files_before: int
+    files_after: int
+    files_compacted: int = 0
+    # version of the checkpoint written, None if no checkpoint was needed
+    checkpoint_version: Optional[int] = None
+    error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.table_path}: {self.error}"
+        checkpoint = (
+            f", checkpoint at version {self.checkpoint_version}"
+            if self.checkpoint_version is not None
+            else ""
+        )
+        return (
+            f"{self.table_path} version {self.version}: {self.files_before} -> "
+            f"{self.files_after} files ({self.files_compacted} compacted){checkpoint}"
+        )
+
+
+def _stats_value(value):
+    if isinstance(value, datetime):
+        milliseconds = value.microsecond // 1000
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{milliseconds:03d}Z"
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def file_stats(table: "pa.Table") -> str:
+    """
+    Statistics of a data file, in the json format of the add actions:
+    numRecords, and minValues, maxValues and nullCount by column.
+    Strings longer than 32 characters only have a (truncated) min value, and
+    decimals have no min/max, so the statistics never exclude a row they hold.
+    """
+    min_values: Dict[str, object] = {}
+    max_values: Dict[str, object] = {}
+    null_count: Dict[str, int] = {}
+    for name in table.column_names:
+        column = table[name]
+        null_count[name] = column.null_count
+        column_type = column.type
+        if column.null_count == len(column) or not (
+            pa.types.is_integer(column_type)
+            or pa.types.is_floating(column_type)
+            or pa.types.is_string(column_type)
+            or pa.types.is_date(column_type)
+            or pa.types.is_timestamp(column_type)
+        ):
+            continue
+        min_max = pc.min_max(column)
+        low, high = min_max["min"].as_py(), min_max["max"].as_py()
+        if isinstance(low, str):
+            min_values[name] = low[:_MAX_STRING_STATS]
+            if len(high) <= _MAX_STRING_STATS:
+                max_values[name] = high
+            continue
+        min_values[name] = _stats_value(low)
+        max_values[name] = _stats_value(high)
+    return json.dumps(
+        {
+            "numRecords": table.num_rows,
+            "minValues": min_values,
+            "maxValues": max_values,
+            "nullCount": null_count,
+        }
+    )
+
+
+def _checkpoint_schema() -> "pa.Schema":
+    string_map = pa.map_(pa.string(), pa.string())
+    return pa.schema(
+        [
+            (
+                "txn",
+                pa.struct(
+                    [
+                        ("appId", pa.string()),
+                        ("version", pa.int64()),
+                        ("lastUpdated", pa.int64()),
+                    ]
+                ),
+            ),
+            (
+                "add",
+                pa.struct(
+                    [
+                        ("path", pa.string()),
+                        ("partitionValues", string_map),
+                        ("size", pa.int64()),
+                        ("modificationTime", pa.int64()),
+                        ("dataChange", pa.bool_()),
+                        ("tags", string_map),
+                        ("stats", pa.string()),
+                    ]
+                ),
+            ),
+            (
+                "remove",
+                pa.struct(
+                    [
+                        ("path", pa.string()),
+                        ("deletionTimestamp", pa.int64()),
+                        ("dataChange", pa.bool_()),
+                        ("extendedFileMetadata", pa.bool_()),
+                        ("partitionValues", string_map),
+                        ("size", pa.int64()),
+                        ("tags", string_map),
+                    ]
+                ),
+            ),
+            (
+                "metaData",
+                pa.struct(
+                    [
+                        ("id", pa.string()),
+                        ("name", pa.string()),
+                        ("description", pa.string()),
+                        (
+                            "format",
+                            pa.struct(
+                                [("provider", pa.string()), ("options", string_map)]
+                            ),
+                        ),
+                        ("schemaString", pa.string()),
+                        ("partitionColumns", pa.list_(pa.string())),
+                        ("configuration", string_map),
+                        ("createdTime", pa.int64()),
+                    ]
+                ),
+            ),
+            (
+                "protocol",
+                pa.struct(
+                    [
+                        ("minReaderVersion", pa.int32()),
+                        ("minWriterVersion", pa.int32()),
+                    ]
+                ),
+            ),
+        ]
+    )
+
+
+class DeltaMaintenance:
+    """
+    Compacts the small files of delta tables and writes their checkpoints
+
+    Example
+    -------
+        maintenance = DeltaMaintenance(DeltaLogReader.local("sample_data"))
+        for result in maintenance.maintain(metadata, schema="SalesLT"):
+            print(result)
+    """
+
+    def __init__(
+        self,
+        reader: DeltaLogReader,
+        target_file_size: int = 128 * MB,
+        small_file_size: int = None,
+        max_workers: int = 4,
+    ):
+        """
+        Parameters
+        ----------
+        reader: DeltaLogReader
+            reader of the file system holding the tables
+
+        target_file_size: int = 128 MB
+            size of the files written by the compaction
+
+        small_file_size: int = None
+            Optional.
+            files smaller than this are compacted. Defaults to target_file_size / 2
+
+        max_workers: int = 4
+            number of tables maintained in parallel
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required to maintain delta tables")
+        self.logger = logging.getLogger(__name__)
+        self._reader = reader
+        self._file_system = reader.file_system
+        self._target_file_size = target_file_size
+        self._small_file_size = small_file_size or target_file_size // 2
+        self._max_workers = max_workers
+
+    @property
+    def reader(self) -> DeltaLogReader:
+        return self._reader
+
+    @property
+    def target_file_size(self) -> int:
+        return self._target_file_size
+
+    def maintain(
+        self,
+        metadata: Metadata,
+        schema: str,
+        compact: bool = True,
+        checkpoint: bool = True,
+        dry_run: bool = False,
+    ) -> List[MaintenanceResult]:
+        """
+        Compacts and checkpoints the delta tables described by a metadata file.
+        The small files of a table are grouped by the ranges of its cluster_by
+        columns, or of its keys.
+        """
+        tables = [
+            (
+                MetadataValidator.table_folder(metadata.path, schema, table.name),
+                list(table.cluster_by) or table.key_columns,
+            )
+            for table in metadata.tables
+        ]
+
+        def maintain_table(folder_columns: Tuple[str, List[str]]) -> MaintenanceResult:
+            folder, sort_columns = folder_columns
+            try:
+                return self.maintain_table(
+                    folder, compact, checkpoint, dry_run, sort_columns
+                )
+            except Exception as ex:
+                self.logger.error(f"Maintenance of {folder} failed: {ex}")
+                return MaintenanceResult(folder, -1, 0, 0, error=str(ex))
+
+        with ThreadPoolExecutor(self._max_workers) as executor:
+            return list(executor.map(maintain_table, tables))
+
+    def maintain_table(
+        self,
+        table_path: str,
+        compact: bool = True,
+        checkpoint: bool = True,
+        dry_run: bool = False,
+        sort_columns: List[str] = None,
+    ) -> MaintenanceResult:
+        snapshot = self._reader.snapshot(table_path)
+        self.check_supported(snapshot)
+        result = MaintenanceResult(
+            table_path, snapshot.version, snapshot.num_files, snapshot.num_files
+        )
+
+        if compact:
+            bins = self.plan_compaction(snapshot, sort_columns)
+            result.files_compacted = sum(len(paths) for paths, _ in bins)
+            result.files_after = snapshot.num_files - result.files_compacted + len(bins)
+            if bins and not dry_run:
+                snapshot = self._compact(snapshot, bins)
+                result.version = snapshot.version
+
+        if checkpoint and snapshot.checkpoint_version < snapshot.version:
+            result.checkpoint_version = snapshot.version
+            if not dry_run:
+                self.write_checkpoint(snapshot)
+        return result
+
+    def plan_compaction(
+        self, snapshot: DeltaSnapshot, sort_columns: List[str] = None
+    ) -> List[Tuple[List[str], Dict[str, str]]]:
+        """
+        Groups of small files to rewrite into one file each, with their
+        partition values. Files are only grouped within a partition, and each
+        group holds at most target_file_size bytes.
+
+        Parameters
+        ----------
+        sort_columns: List[str] = None
+            Optional.
+            columns the table is clustered by: files are grouped in the order
+            of the min values of these columns in their statistics, so that the
+            groups cover adjacent ranges. Default the order they were written.
+        """
+        small = snapshot.files.filter(
+            pc.less(snapshot.files["size"], self._small_file_size)
+        )
+        partitions: Dict[str, List[Tuple[tuple, int, str, Dict[str, str]]]] = {}
+        for path, size, partition_values, modification_time, stats in zip(
+            small["path"].to_pylist(),
+            small["size"].to_pylist(),
+            small["partition_values"].to_pylist(),
+            small["modification_time"].to_pylist(),
+            small["stats"].to_pylist(),
+        ):
+            # absolute paths point outside of the table folder
+            if "://" in path:
+                continue
+            values = dict(partition_values or [])
+            key = json.dumps(values, sort_keys=True)
+            min_values = json.loads(stats).get("minValues", {}) if stats else {}
+            order = tuple(
+                # files without statistics for a column come first
+                (min_values.get(name) is not None, min_values.get(name))
+                for name in sort_columns or []
+            ) + (modification_time or 0, path)
+            partitions.setdefault(key, []).append((order, size, path, values))
+
+        bins = []
+        for files in partitions.values():
+            current: List[str] = []
+            current_size = 0
+            for _, size, path, values in sorted(files):
+                if current and current_size + size > self._target_file_size:
+                    bins.append((current, values))
+                    current, current_size = [], 0
+                current.append(path)
+                current_size += size
+            if current:
+                bins.append((current, values))
+        # a single file cannot be compacted
+        return [(paths, values) for paths, values in bins if len(paths) > 1]
+
+    def rewrite(
+        self,
+        snapshot: DeltaSnapshot,
+        removed: List[str],
+        added: List[Tuple[str, "pa.Table", Dict[str, str]]],
+        operation: str,
+        operation_parameters: dict = None,
+        write_options: dict = None,
+        file_write_options: List[dict] = None,
+    ) -> DeltaSnapshot:
+        """
+        Replaces data files of a table without changing its data, in a single
+        commit: the new files are written first, then the commit that removes
+        the old ones and adds the new ones.
+
+        Parameters
+        ----------
+        removed: List[str]
+            paths of the files removed, as in the delta log
+
+        added: List[Tuple[str, pa.Table, Dict[str, str]]]
+            folder relative to the table, not URL encoded (empty for
+            unpartitioned tables), rows and partition values of each new file
+
+        write_options: dict = None
+            Optional.
+            options of pyarrow.parquet.write_table, e.g. row_group_size
+
+        file_write_options: List[dict] = None
+            Optional.
+            options of each added file, on top of write_options
+
+        Raises
+        ------
+        DeltaConflictError
+            if another writer committed the same version first
+        """
+        now = int(time.time() * 1000)
+        files = snapshot.files
+        removed_rows = files.filter(pc.is_in(files["path"], pa.array(removed)))
+        actions = [
+            {
+                "commitInfo": {
+                    "timestamp": now,
+                    "operation": operation,
+                    "operationParameters": operation_parameters or {},
+                    "readVersion": snapshot.version,
+                    "isolationLevel": "SnapshotIsolation",
+                    "isBlindAppend": False,
+                    "engineInfo": _ENGINE_INFO,
+                }
+            }
+        ]
+        for path, size, partition_values in zip(
+            removed_rows["path"].to_pylist(),
+            removed_rows["size"].to_pylist(),
+            removed_rows["partition_values"].to_pylist(),
+        ):
+            actions.append(
+                {
+                    "remove": {
+                        "path": path,
+                        "deletionTimestamp": now,
+                        "dataChange": False,
+                        "extendedFileMetadata": True,
+                        "partitionValues": dict(partition_values or []),
+                        "size": size,
+                    }
+                }
+            )
+
+        options = {
+            "compression": "snappy",
+            # the format written by Spark, read by Synapse serverless
+            "use_deprecated_int96_timestamps": True,
+        }
+        options.update(write_options or {})
+        for index, (folder, table, partition_values) in enumerate(added):
+            name = f"part-00000-{uuid.uuid4()}-c000.snappy.parquet"
+            file_path = f"{folder.strip('/')}/{name}" if folder.strip("/") else name
+            sink = pa.BufferOutputStream()
+            file_options = file_write_options[index] if file_write_options else {}
+            pq.write_table(table, sink, **{**options, **file_options})
+            data = sink.getvalue().to_pybytes()
+            self._file_system.write(f"{snapshot.path}/{file_path}", data)
+            # paths in the log are URIs relative to the table
+            path = quote(file_path, safe="/=")
+            actions.append(
+                {
+                    "add": {
+                        "path": path,
+                        "partitionValues": partition_values,
+                        "size": len(data),
+                        "modificationTime": now,
+                        "dataChange": False,
+                        "stats": file_stats(table),
+                    }
+                }
+            )
+
+        version = snapshot.version + 1
+        commit = "\n".join(json.dumps(action) for action in actions) + "\n"
+        try:
+            self._file_system.write(
+                f"{snapshot.path}/{DELTA_LOG}/{version:020d}.json",
+                commit.encode("utf-8"),
+                overwrite=False,
+            )
+        except FileExistsError:
+            raise DeltaConflictError(
+                f"Version {version} of {snapshot.path} was committed by another "
+                "writer, the files written by this rewrite are not referenced"
+            )
+        self.logger.info(
+            f"{operation} committed version {version} of {snapshot.path}: "
+            f"{len(removed)} files removed, {len(added)} added"
+        )
+        return self._reader.snapshot(snapshot.path)
+
+    def read_file(self, snapshot: DeltaSnapshot, path: str) -> "pq.ParquetFile":
+        """
+        Data file of the table, from its path in the delta log
+        """
+        data = self._file_system.read(f"{snapshot.path}/{unquote(path)}")
+        if data is None:
+            raise FileNotFoundError(f"Data file {path} of {snapshot.path} not found")
+        return pq.ParquetFile(pa.BufferReader(data))
+
+    def read_files(self, snapshot: DeltaSnapshot, paths: List[str]) -> "pa.Table":
+        """
+        Rows of data files of the table, in the order of the paths
+        """
+        tables = [self.read_file(snapshot, path).read() for path in paths]
+        return pa.concat_tables(tables, promote_options="permissive")
+
+    def write_checkpoint(self, snapshot: DeltaSnapshot) -> int:
+        """
+        Writes the checkpoint of the version of the snapshot and points
+        _last_checkpoint to it. Returns the version of the checkpoint.
+        """
+        schema = _checkpoint_schema()
+        files = snapshot.files
+        count = files.num_rows
+        add_type = schema.field("add").type
+        adds = pa.StructArray.from_arrays(
+            [
+                files["path"].combine_chunks(),
+                files["partition_values"].combine_chunks(),
+                files["size"].combine_chunks(),
+                files["modification_time"].combine_chunks(),
+                pa.array([False] * count, pa.bool_()),
+                pa.nulls(count, add_type.field("tags").type),
+                files["stats"].combine_chunks(),
+            ],
+            fields=list(add_type),
+        )
+        add_rows = pa.table(
+            {
+                field.name: (
+                    adds if field.name == "add" else pa.nulls(count, field.type)
+                )
+                for field in schema
+            },
+            schema=schema,
+        )
+
+        metadata = dict(snapshot.metadata)
+        metadata_format = dict(metadata.get("format") or {"provider": "parquet"})
+        options = metadata_format.get("options") or {}
+        metadata_format["options"] = list(options.items())
+        metadata["format"] = metadata_format
+        metadata["configuration"] = list(
+            (metadata.get("configuration") or {}).items()
+        )
+        rows = [{"protocol": snapshot.protocol}, {"metaData": metadata}]
+        rows.extend({"txn": txn} for txn in snapshot.transactions.values())
+        checkpoint = pa.concat_tables(
+            [pa.Table.from_pylist(rows, schema=schema), add_rows]
+        )
+
+        sink = pa.BufferOutputStream()
+        pq.write_table(checkpoint, sink, compression="snappy")
+        data = sink.getvalue().to_pybytes()
+        log_path = f"{snapshot.path}/{DELTA_LOG}"
+        self._file_system.write(
+            f"{log_path}/{snapshot.version:020d}.checkpoint.parquet", data
+        )
+        last_checkpoint = {
+            "version": snapshot.version,
+            "size": checkpoint.num_rows,
+            "sizeInBytes": len(data),
+            "numOfAddFiles": count,
+        }
+        self._file_system.write(
+            f"{log_path}/_last_checkpoint",
+            json.dumps(last_checkpoint).encode("utf-8"),
+        )
+        self.logger.info(
+            f"Checkpoint written for version {snapshot.version} of {snapshot.path}"
+        )
+        return snapshot.version
+
+    def _compact(
+        self, snapshot: DeltaSnapshot, bins: List[Tuple[List[str], Dict[str, str]]]
+    ) -> DeltaSnapshot:
+        added = []
+        removed = []
+        file_write_options = []
+        for paths, partition_values in bins:
+            folder = paths[0].rsplit("/", 1)[0] if "/" in paths[0] else ""
+            files = [self.read_file(snapshot, path) for path in paths]
+            table = pa.concat_tables(
+                [file.read() for file in files], promote_options="permissive"
+            )
+            options = self._sorted_write_options(files, table.schema)
+            if options:
+                # merge files sorted by a clustering, and keep their layout
+                sort_keys, _ = pq.SortingColumn.to_ordering(
+                    table.schema, options["sorting_columns"]
+                )
+                table = table.take(pc.sort_indices(table, sort_keys=sort_keys))
+            added.append((unquote(folder), table, partition_values))
+            file_write_options.append(options)
+            removed.extend(paths)
+        return self.rewrite(
+            snapshot,
+            removed,
+            added,
+            operation="OPTIMIZE",
+            operation_parameters={
+                "targetFileSize": str(self._target_file_size),
+                "numFilesCompacted": str(len(removed)),
+            },
+            file_write_options=file_write_options,
+        )
+
+    @staticmethod
+    def _sorted_write_options(files: List["pq.ParquetFile"], schema) -> dict:
+        """
+        Sorting columns and row group size of files that all declare the same
+        sorting columns in their footer, e.g. files written by DeltaClustering.
+        Empty if any file is not sorted, or sorted differently.
+        """
+        orderings = set()
+        row_group_rows = 0
+        for file in files:
+            metadata = file.metadata
+            if metadata.num_row_groups == 0:
+                continue
+            # column indices refer to the schema of each file
+            orderings.add(
+                pq.SortingColumn.to_ordering(
+                    file.schema_arrow, metadata.row_group(0).sorting_columns
+                )
+            )
+            row_group_rows = max(
+                [row_group_rows]
+                + [
+                    metadata.row_group(index).num_rows
+                    for index in range(metadata.num_row_groups)
+                ]
+            )
+        if len(orderings) != 1:
+            return {}
+        ((sort_keys, null_placement),) = orderings
+        # DeltaClustering sorts the nulls last
+        if (
+            not sort_keys
+            or null_placement != "at_end"
+            or any(name not in schema.names for name, _ in sort_keys)
+        ):
+            return {}
+        return {
+            "sorting_columns": pq.SortingColumn.from_ordering(schema, sort_keys),
+            "row_group_size": row_group_rows,
+        }
+
+    @staticmethod
+    def check_supported(snapshot: DeltaSnapshot):
+        """
+        Tables using features this module does not write (deletion vectors,
+        column mapping and other table features) are left untouched
+        """
+        protocol = snapshot.protocol
+        if (
+            protocol.get("minReaderVersion", 1) > 1
+            or protocol.get("minWriterVersion", 2) > 6
+        ):
+            raise ValueError(
+                f"Unsupported delta protocol for {snapshot.path}: {protocol}"
+            )
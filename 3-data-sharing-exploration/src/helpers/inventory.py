@@ -0,0 +1,540 @@
+"""
+Container inventory module
+--------------------------
+Local SQLite index of the paths of a container (size, last-modified time,
+ETag, owner, group, permissions and ACL), so that the stages can plan their
+work with queries instead of listing the storage account each time.
+
+The index is refreshed from an ADLS listing (`get_paths`) or from a blob
+inventory report (csv or parquet). Each refresh covers a prefix: paths listed
+are inserted or updated, and the paths of the prefix that were not listed
+are removed.
+"""
+import csv
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .delta import DELTA_LOG
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pq = None
+
+DEFAULT_INVENTORY_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "eds", "inventory"
+)
+
+_BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    name TEXT PRIMARY KEY,
+    is_directory INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    last_modified TEXT,
+    etag TEXT,
+    owner TEXT,
+    owner_group TEXT,
+    permissions TEXT,
+    acl TEXT,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    prefix TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    source TEXT,
+    refreshed_at TEXT NOT NULL
+);
+"""
+
+_COLUMNS = (
+    "name, is_directory, size, last_modified, etag, owner, owner_group, "
+    "permissions, acl"
+)
+
+
+@dataclass(frozen=True)
+class InventoryEntry:
+    name: str
+    is_directory: bool = False
+    size: int = 0
+    # ISO 8601 timestamp
+    last_modified: Optional[str] = None
+    etag: Optional[str] = None
+    owner: Optional[str] = None
+    group: Optional[str] = None
+    # short form, e.g. rwxr-x---
+    permissions: Optional[str] = None
+    # access control list, e.g. user::rwx,group::r-x,other::---,group:<id>:r-x
+    acl: Optional[str] = None
+
+
+@dataclass
+class InventoryRefresh:
+    """Paths of the prefix added, changed and removed by a refresh"""
+
+    prefix: str
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"'{self.prefix or '/'}': {len(self.added)} added, "
+            f"{len(self.changed)} changed, {len(self.removed)} removed, "
+            f"{self.unchanged} unchanged"
+        )
+
+
+def _acl_entries(acl: Optional[str]) -> Dict[str, str]:
+    """
+    Entries of an ACL by scope, type and id, e.g.
+    {"group:<id>": "r-x", "default:group:<id>": "r-x"}
+    """
+    entries = {}
+    for entry in (acl or "").split(","):
+        entry = entry.strip()
+        if entry:
+            key, _, permissions = entry.rpartition(":")
+            entries[key] = permissions
+    return entries
+
+
+def merge_acl(acl: Optional[str], update: str) -> str:
+    """
+    ACL after `update_access_control_recursive(acl=update)`: the entries of the
+    update replace the ones of the same scope, type and id
+    """
+    entries = _acl_entries(acl)
+    entries.update(_acl_entries(update))
+    return ",".join(f"{key}:{permissions}" for key, permissions in entries.items())
+
+
+def has_acl(current: Optional[str], acl: str, is_directory: bool = True) -> bool:
+    """
+    True if an ACL has all the entries of another one.
+    Default entries only apply to directories.
+    """
+    entries = _acl_entries(current)
+    return all(
+        entries.get(key) == permissions
+        for key, permissions in _acl_entries(acl).items()
+        if is_directory or not key.startswith("default:")
+    )
+
+
+def _timestamp(value) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    return str(value)
+
+
+def _report_entry(row: dict) -> InventoryEntry:
+    is_folder = row.get("hdi_isfolder")
+    return InventoryEntry(
+        name=row["Name"],
+        is_directory=is_folder is True or str(is_folder).lower() == "true",
+        size=int(row.get("Content-Length") or 0),
+        last_modified=_timestamp(row.get("Last-Modified")),
+        etag=row.get("Etag") or None,
+        owner=row.get("Owner") or None,
+        group=row.get("Group") or None,
+        permissions=row.get("Permissions") or None,
+        acl=row.get("Acl") or None,
+    )
+
+
+def read_inventory_report(report_path: str) -> Iterator[InventoryEntry]:
+    """
+    Paths of a blob inventory report, in csv or parquet format. The report
+    rule should include the Name, Last-Modified, Etag, Content-Length and,
+    for ADLS accounts, hdi_isfolder, Owner, Group, Permissions and Acl fields.
+    """
+    if report_path.endswith(".parquet"):
+        if pq is None:
+            raise ImportError("pyarrow is required to read parquet inventory reports")
+        for batch in pq.ParquetFile(report_path).iter_batches(_BATCH_SIZE):
+            for row in batch.to_pylist():
+                yield _report_entry(row)
+        return
+    with open(report_path, newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            yield _report_entry(row)
+
+
+class ContainerInventory:
+    """
+    Index of the paths of a container, persisted in a SQLite file.
+    Safe to use from several threads.
+
+    Example
+    -------
+        inventory = ContainerInventory.for_container(account, container)
+        inventory.refresh_from_adls(file_system_client, prefix="v2")
+        for table_folder in inventory.delta_tables("v2"):
+            print(table_folder, inventory.size(table_folder))
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path: str
+            SQLite file of the inventory, created if missing, or :memory:
+        """
+        self.logger = logging.getLogger(__name__)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def for_container(
+        cls, account_name: str, container_name: str
+    ) -> "ContainerInventory":
+        """
+        Inventory of a container in the default location, shared by the stages
+        """
+        return cls(
+            os.path.join(
+                DEFAULT_INVENTORY_DIR, account_name, f"{container_name}.sqlite"
+            )
+        )
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _prefix_range(prefix: str) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Condition selecting a path and everything below it: names are compared
+        as a range, as `_` and `%` in folder names would be LIKE wildcards
+        """
+        if not prefix:
+            return "1 = 1", ()
+        # "0" is the character after "/"
+        return "(name = ? OR (name >= ? AND name < ?))", (
+            prefix,
+            f"{prefix}/",
+            f"{prefix}0",
+        )
+
+    def update(
+        self, entries: Iterable[InventoryEntry], prefix: str = "", source: str = ""
+    ) -> InventoryRefresh:
+        """
+        Replaces the paths of a prefix with the entries given: entries are
+        inserted or updated, and the paths of the prefix not given are removed
+
+        Parameters
+        ----------
+        entries: Iterable[InventoryEntry]
+            all the paths under the prefix, e.g. a listing or an inventory report
+
+        prefix: str = ""
+            Optional.
+            folder refreshed, e.g. v2. Default the whole container.
+
+        source: str = ""
+            Optional.
+            description of where the entries come from, kept with the refresh
+        """
+        prefix = prefix.strip("/")
+        condition, parameters = self._prefix_range(prefix)
+        result = InventoryRefresh(prefix)
+        with self._lock, self._connection:
+            generation = (
+                self._connection.execute(
+                    "SELECT COALESCE(MAX(generation), 0) + 1 FROM refreshes"
+                ).fetchone()[0]
+            )
+            existing = {
+                name: (etag, size)
+                for name, etag, size in self._connection.execute(
+                    f"SELECT name, etag, size FROM paths WHERE {condition}", parameters
+                )
+            }
+            batch = []
+            for entry in entries:
+                previous = existing.pop(entry.name, None)
+                if previous is None:
+                    result.added.append(entry.name)
+                elif previous != (entry.etag, entry.size):
+                    result.changed.append(entry.name)
+                else:
+                    result.unchanged += 1
+                batch.append(
+                    (
+                        entry.name,
+                        entry.is_directory,
+                        entry.size,
+                        entry.last_modified,
+                        entry.etag,
+                        entry.owner,
+                        entry.group,
+                        entry.permissions,
+                        entry.acl,
+                        generation,
+                    )
+                )
+                if len(batch) >= _BATCH_SIZE:
+                    self._upsert(batch)
+                    batch = []
+            self._upsert(batch)
+            result.removed = sorted(existing)
+            self._connection.execute(
+                f"DELETE FROM paths WHERE generation < ? AND {condition}",
+                (generation, *parameters),
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)",
+                (
+                    prefix,
+                    generation,
+                    source,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+        self.logger.info(f"Inventory {self._path} refreshed from {source}: {result}")
+        return result
+
+    def _upsert(self, rows: list):
+        self._connection.executemany(
+            f"INSERT OR REPLACE INTO paths ({_COLUMNS}, generation) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def refresh_from_adls(
+        self,
+        file_system_client,
+        prefix: str = "",
+        fetch_acl: bool = True,
+        full_acl: bool = False,
+        max_workers: int = 8,
+    ) -> InventoryRefresh:
+        """
+        Refreshes the paths of a prefix from a recursive ADLS listing.
+        The ACLs are not part of the listing: they are read, concurrently, for
+        the paths that are new or whose ETag changed, and kept for the others.
+        The listing does not include the prefix folder, which is read directly.
+
+        Parameters
+        ----------
+        file_system_client: azure.storage.filedatalake.FileSystemClient
+            client of the container
+
+        fetch_acl: bool = True
+            Optional.
+            read the ACL of the paths. Set to False for a faster listing.
+
+        full_acl: bool = False
+            Optional.
+            read the ACL of every path, e.g. after ACLs were changed by
+            another tool, which does not always change the ETag of a path
+        """
+        prefix = prefix.strip("/")
+        known = {entry.name: entry for entry in self.list(prefix)}
+        entries = [
+            InventoryEntry(
+                name=path.name,
+                is_directory=bool(path.is_directory),
+                size=path.content_length or 0,
+                last_modified=_timestamp(path.last_modified),
+                etag=path.etag,
+                owner=path.owner,
+                group=path.group,
+                permissions=path.permissions,
+            )
+            for path in file_system_client.get_paths(
+                path=prefix or None, recursive=True
+            )
+        ]
+
+        def with_acl(entry: InventoryEntry) -> InventoryEntry:
+            previous = known.get(entry.name)
+            if not fetch_acl:
+                acl = None
+            elif not full_acl and previous is not None and previous.etag == entry.etag:
+                acl = previous.acl
+            else:
+                client = (
+                    file_system_client.get_directory_client(entry.name)
+                    if entry.is_directory
+                    else file_system_client.get_file_client(entry.name)
+                )
+                acl = client.get_access_control()["acl"]
+            return InventoryEntry(**{**entry.__dict__, "acl": acl})
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            entries = list(executor.map(with_acl, entries))
+        if prefix:
+            directory_client = file_system_client.get_directory_client(prefix)
+            properties = directory_client.get_directory_properties()
+            access_control = directory_client.get_access_control()
+            entries.append(
+                InventoryEntry(
+                    name=prefix,
+                    is_directory=True,
+                    last_modified=_timestamp(properties.last_modified),
+                    etag=properties.etag,
+                    owner=access_control["owner"],
+                    group=access_control["group"],
+                    permissions=access_control["permissions"],
+                    acl=access_control["acl"] if fetch_acl else None,
+                )
+            )
+        return self.update(entries, prefix, source="adls listing")
+
+    def refresh_from_report(
+        self, report_path: str, prefix: str = ""
+    ) -> InventoryRefresh:
+        """
+        Refreshes the paths of a prefix from a blob inventory report, which
+        lists the container without any call to the storage account
+        """
+        prefix = prefix.strip("/")
+        condition_prefix = f"{prefix}/" if prefix else ""
+        entries = (
+            entry
+            for entry in read_inventory_report(report_path)
+            if not prefix
+            or entry.name == prefix
+            or entry.name.startswith(condition_prefix)
+        )
+        return self.update(entries, prefix, source=report_path)
+
+    def _entries(self, query: str, parameters: tuple) -> List[InventoryEntry]:
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [
+            InventoryEntry(
+                name=row[0],
+                is_directory=bool(row[1]),
+                size=row[2],
+                last_modified=row[3],
+                etag=row[4],
+                owner=row[5],
+                group=row[6],
+                permissions=row[7],
+                acl=row[8],
+            )
+            for row in rows
+        ]
+
+    def get(self, name: str) -> Optional[InventoryEntry]:
+        entries = self._entries(
+            f"SELECT {_COLUMNS} FROM paths WHERE name = ?", (name.strip("/"),)
+        )
+        return entries[0] if entries else None
+
+    def list(
+        self, prefix: str = "", directories: Optional[bool] = None
+    ) -> List[InventoryEntry]:
+        """
+        Paths of a prefix, itself included, sorted by name
+
+        Parameters
+        ----------
+        directories: Optional[bool] = None
+            Optional.
+            True for the directories only, False for the files only
+        """
+        condition, parameters = self._prefix_range(prefix.strip("/"))
+        if directories is not None:
+            condition = f"{condition} AND is_directory = ?"
+            parameters = (*parameters, directories)
+        return self._entries(
+            f"SELECT {_COLUMNS} FROM paths WHERE {condition} ORDER BY name",
+            parameters,
+        )
+
+    def size(self, prefix: str = "") -> int:
+        """Bytes of the files of a prefix"""
+        condition, parameters = self._prefix_range(prefix.strip("/"))
+        with self._lock:
+            return self._connection.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM paths WHERE {condition}",
+                parameters,
+            ).fetchone()[0]
+
+    def delta_tables(self, prefix: str = "") -> List[str]:
+        """Folders of a prefix holding a delta table (a _delta_log folder)"""
+        return [
+            entry.name.rsplit("/", 1)[0]
+            for entry in self.list(prefix, directories=True)
+            if entry.name.endswith(f"/{DELTA_LOG}")
+        ]
+
+    def modified_since(self, timestamp: datetime, prefix: str = "") -> List[str]:
+        """Paths of a prefix modified after a time"""
+        condition, parameters = self._prefix_range(prefix.strip("/"))
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT name FROM paths WHERE last_modified > ? AND {condition} "
+                "ORDER BY name",
+                (_timestamp(timestamp), *parameters),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def last_refresh(self, prefix: str = "") -> Optional[str]:
+        """Time of the last refresh of the prefix, or of a folder containing it"""
+        prefix = prefix.strip("/")
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT prefix, refreshed_at FROM refreshes"
+            ).fetchall()
+        times = [
+            refreshed_at
+            for refreshed, refreshed_at in rows
+            if not refreshed
+            or prefix == refreshed
+            or prefix.startswith(f"{refreshed}/")
+        ]
+        return max(times) if times else None
+
+    def missing_acl(self, prefix: str, acl: str) -> List[str]:
+        """
+        Paths of a prefix whose ACL does not have all the entries of an ACL.
+        Default entries only apply to directories.
+        """
+        return [
+            entry.name
+            for entry in self.list(prefix)
+            if not has_acl(entry.acl, acl, entry.is_directory)
+        ]
+
+    def set_acl(self, prefix: str, acl: str):
+        """
+        Records the entries of an ACL applied recursively to a prefix, e.g. by
+        `update_access_control_recursive`
+        """
+        # default entries are only set on directories
+        file_acl = ",".join(
+            f"{key}:{permissions}"
+            for key, permissions in _acl_entries(acl).items()
+            if not key.startswith("default:")
+        )
+        rows = [
+            (merge_acl(entry.acl, acl if entry.is_directory else file_acl), entry.name)
+            for entry in self.list(prefix)
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE paths SET acl = ? WHERE name = ?", rows
+            )
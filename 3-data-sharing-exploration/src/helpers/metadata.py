@@ -1,50 +1,312 @@
-from dataclasses import dataclass, field
-from typing import List, Optional
+import codecs
+import hashlib
+import json
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
 
-from dataclasses_json import config, dataclass_json
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
 
 
-@dataclass_json
-@dataclass
+# __slots__ are generated by dataclass from Python 3.10; earlier versions fall
+# back to instances with a __dict__
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+def _loads(data: Union[str, bytes]):
+    """Parses json with orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    """
+    Interns the strings repeated across tables and columns (names, sensitivity,
+    types) so that each distinct value is stored once
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass(frozen=True, **_SLOTS)
 class Column:
     name: str
     description: Optional[str] = None
-    sensitivity: Optional[str] = field(
-        metadata=config(field_name="sensitivity"), default=""
-    )
-    data_type: str = field(metadata=config(field_name="type"), default="")
+    sensitivity: Optional[str] = ""
+    data_type: str = ""
+    is_key: bool = False
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Column":
+        return cls(
+            _intern(data["name"]),
+            data.get("description"),
+            _intern(data.get("sensitivity", "")),
+            _intern(data.get("type", "")),
+            data.get("key", False),
+        )
 
-@dataclass_json
-@dataclass
+    def to_dict(self) -> dict:
+        data = {
+            "name": self.name,
+            "description": self.description,
+            "sensitivity": self.sensitivity,
+            "type": self.data_type,
+        }
+        if self.is_key:
+            data["key"] = True
+        return data
+
+
+@dataclass(frozen=True, **_SLOTS)
 class Table:
     name: str
-    columns: List[Column]
+    columns: Tuple[Column, ...]
     description: Optional[str] = None
-    sensitivity: Optional[str] = field(
-        metadata=config(field_name="sensitivity"), default=""
-    )
+    sensitivity: Optional[str] = ""
+    # columns the data files are sorted by, to skip row groups on filters
+    cluster_by: Tuple[str, ...] = ()
 
+    def __post_init__(self):
+        if not isinstance(self.columns, tuple):
+            object.__setattr__(self, "columns", tuple(self.columns))
+        if not isinstance(self.cluster_by, tuple):
+            object.__setattr__(self, "cluster_by", tuple(self.cluster_by))
 
-@dataclass_json
-@dataclass
+    @property
+    def key_columns(self) -> List[str]:
+        """Names of the columns flagged as key in the metadata, in order"""
+        return [column.name for column in self.columns if column.is_key]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Table":
+        return cls(
+            _intern(data["name"]),
+            tuple(Column.from_dict(column) for column in data["columns"]),
+            data.get("description"),
+            _intern(data.get("sensitivity", "")),
+            tuple(_intern(name) for name in data.get("cluster_by", ())),
+        )
+
+    def to_dict(self) -> dict:
+        data = {
+            "name": self.name,
+            "description": self.description,
+            "sensitivity": self.sensitivity,
+            "columns": [column.to_dict() for column in self.columns],
+        }
+        if self.cluster_by:
+            data["cluster_by"] = list(self.cluster_by)
+        return data
+
+
+class MetadataStream:
+    """
+    Reads a metadata file from chunks of bytes (e.g. a blob download) and yields
+    its tables one at a time, so that memory is bounded by the size of a table
+    rather than the size of the file.
+
+    `version` and `path` are set as soon as they are read, which is before the
+    first table for the files written by `Metadata.to_json`.
+
+    Example
+    -------
+        stream = MetadataStream(chunks)
+        for table in stream:
+            print(stream.version, table.name)
+    """
+
+    _WHITESPACE = " \t\n\r"
+
+    def __init__(self, chunks: Iterable[Union[bytes, str]]):
+        self.version: Optional[str] = None
+        self.path: Optional[str] = None
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self) -> Iterator[Table]:
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "tables":
+                yield from self._tables()
+            else:
+                value = self._value()
+                if key in ("version", "path"):
+                    setattr(self, key, value)
+            if self._expect(",}") == "}":
+                return
+
+    def _tables(self) -> Iterator[Table]:
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield Table.from_dict(self._value())
+            if self._expect(",]") == "]":
+                return
+
+    def _read(self) -> bool:
+        """
+        Appends the next chunk to the buffer, dropping what was already parsed.
+        Returns False at the end of the stream.
+        """
+        while not self._eof:
+            parsed = self._pos
+            self._buffer = self._buffer[parsed:]
+            self._pos = 0
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                self._buffer += self._utf8.decode(b"", final=True)
+                return False
+            text = self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text:
+                self._buffer += text
+                return True
+        return False
+
+    def _peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or "" at the end
+        """
+        while True:
+            while (
+                self._pos < len(self._buffer)
+                and self._buffer[self._pos] in self._WHITESPACE
+            ):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return ""
+
+    def _expect(self, characters: str) -> str:
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError(
+                f"Invalid metadata json: expected one of '{characters}', "
+                f"found '{character or 'end of file'}'"
+            )
+        self._pos += 1
+        return character
+
+    def _value(self) -> Any:
+        """
+        Decodes the next json value, reading more chunks until it is complete
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read()
+
+
+# Recently parsed metadata, by hash of the json content, least recently used
+# first. Metadata objects are immutable, so the same instance can be shared by
+# all the callers in the process.
+_parsed_metadata: "OrderedDict[bytes, Metadata]" = OrderedDict()
+_parsed_metadata_lock = threading.Lock()
+# number of parsed metadata files kept
+PARSED_METADATA_CACHE_SIZE = 16
+
+
+def clear_metadata_cache():
+    """Drops the parsed metadata kept by Metadata.from_json"""
+    with _parsed_metadata_lock:
+        _parsed_metadata.clear()
+
+
+@dataclass(frozen=True, **_SLOTS)
 class Metadata:
 
     version: str
     path: str
-    tables: List[Table]
+    tables: Tuple[Table, ...]
+
+    def __post_init__(self):
+        if not isinstance(self.tables, tuple):
+            object.__setattr__(self, "tables", tuple(self.tables))
 
     @property
     def major_version_identifier(self):
         return f"v{self.version.split('.')[0]}"
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Metadata":
+        return cls(
+            data["version"],
+            data["path"],
+            tuple(Table.from_dict(table) for table in data["tables"]),
+        )
+
+    @classmethod
+    def from_json(cls, metadata_json: Union[str, bytes]) -> "Metadata":
+        """
+        Parses a metadata file. The last PARSED_METADATA_CACHE_SIZE distinct
+        contents parsed are kept: later calls with the same content return the
+        same instance.
+        """
+        data = (
+            metadata_json.encode("utf-8")
+            if isinstance(metadata_json, str)
+            else metadata_json
+        )
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with _parsed_metadata_lock:
+            metadata = _parsed_metadata.get(digest)
+            if metadata is not None:
+                _parsed_metadata.move_to_end(digest)
+                return metadata
+        metadata = cls.from_dict(_loads(data))
+        with _parsed_metadata_lock:
+            _parsed_metadata[digest] = metadata
+            while len(_parsed_metadata) > PARSED_METADATA_CACHE_SIZE:
+                _parsed_metadata.popitem(last=False)
+        return metadata
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "path": self.path,
+            "tables": [table.to_dict() for table in self.tables],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=4, ensure_ascii=False)
+
 
-@dataclass_json
 @dataclass
 class MetadataFile:
 
     container: str
     metadata_json: str
+    name: str = ""
+
+    @property
+    def metadata(self) -> Metadata:
+        """The parsed metadata, shared with any other parse of the same content"""
+        return Metadata.from_json(self.metadata_json)
 
     @staticmethod
     def as_metadata_file(json: dict):
@@ -0,0 +1,198 @@
+"""
+Metadata diff module
+--------------------
+Compares two metadata files, either two versions (1.0.0 and 2.0.0) or two
+revisions of the same file, so that the stages only process the tables and
+columns that changed.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from .metadata import Metadata
+
+ADDED = "added"
+REMOVED = "removed"
+RETYPED = "retyped"
+REDESCRIBED = "redescribed"
+RECLASSIFIED = "reclassified"
+
+
+@dataclass(frozen=True)
+class MetadataChange:
+    table: str
+    # None for the changes of the table itself
+    column: Optional[str]
+    kind: str
+    old: Optional[str] = None
+    new: Optional[str] = None
+
+    def __str__(self) -> str:
+        name = self.table if self.column is None else f"{self.table}.{self.column}"
+        if self.kind in (ADDED, REMOVED):
+            return f"{self.kind} {name}"
+        return f"{self.kind} {name}: {self.old!r} -> {self.new!r}"
+
+
+@dataclass
+class MetadataDiff:
+    """Changes between an old and a new metadata file"""
+
+    old_version: Optional[str]
+    new_version: str
+    changes: List[MetadataChange] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.changes
+
+    def tables(self, *kinds: str) -> Set[str]:
+        """
+        Tables with at least one change of the given kinds (any kind if empty),
+        to the table itself or to one of its columns
+        """
+        return {
+            change.table
+            for change in self.changes
+            if not kinds or change.kind in kinds
+        }
+
+    def columns(self, table: str, *kinds: str) -> Set[str]:
+        """
+        Changed columns of a table, optionally only for the given kinds
+        """
+        return {
+            change.column
+            for change in self.changes
+            if change.table == table
+            and change.column is not None
+            and (not kinds or change.kind in kinds)
+        }
+
+    @property
+    def added_tables(self) -> Set[str]:
+        return {
+            change.table
+            for change in self.changes
+            if change.column is None and change.kind == ADDED
+        }
+
+    @property
+    def removed_tables(self) -> Set[str]:
+        return {
+            change.table
+            for change in self.changes
+            if change.column is None and change.kind == REMOVED
+        }
+
+    @property
+    def view_tables(self) -> Set[str]:
+        """
+        Tables whose views must be created or altered: the new ones and the ones
+        with added, removed or retyped columns, as views bind their columns when
+        they are created
+        """
+        return self.tables(ADDED, REMOVED, RETYPED) - self.removed_tables
+
+    @property
+    def catalog_tables(self) -> Set[str]:
+        """
+        Tables whose descriptions or sensitivity must be updated in Purview
+        """
+        return self.tables() - self.removed_tables
+
+    @property
+    def security_tables(self) -> Set[str]:
+        """
+        Tables whose permissions may change: the new ones, the ones with new
+        columns and the ones with a different sensitivity
+        """
+        return self.tables(ADDED, RECLASSIFIED) - self.removed_tables
+
+    def summary(self) -> str:
+        header = f"{self.old_version or 'nothing'} -> {self.new_version}"
+        if self.is_empty:
+            return f"{header}: no changes"
+        return "\n".join([f"{header}:"] + [f"  {change}" for change in self.changes])
+
+
+def diff_metadata(old: Optional[Metadata], new: Metadata) -> MetadataDiff:
+    """
+    Compares two metadata files. Tables and columns are matched by name.
+
+    Parameters
+    ----------
+    old: Metadata
+        Previous version or revision. None when the file is new: every table
+        is then reported as added.
+
+    new: Metadata
+        Current version or revision.
+    """
+    diff = MetadataDiff(old.version if old else None, new.version)
+    changes = diff.changes
+    old_tables = {table.name: table for table in old.tables} if old else {}
+    new_names = set()
+
+    for table in new.tables:
+        new_names.add(table.name)
+        old_table = old_tables.get(table.name)
+        if old_table is None:
+            changes.append(MetadataChange(table.name, None, ADDED))
+            changes.extend(
+                MetadataChange(table.name, column.name, ADDED)
+                for column in table.columns
+            )
+            continue
+
+        if old_table.description != table.description:
+            changes.append(
+                MetadataChange(
+                    table.name,
+                    None,
+                    REDESCRIBED,
+                    old_table.description,
+                    table.description,
+                )
+            )
+        if old_table.sensitivity != table.sensitivity:
+            changes.append(
+                MetadataChange(
+                    table.name,
+                    None,
+                    RECLASSIFIED,
+                    old_table.sensitivity,
+                    table.sensitivity,
+                )
+            )
+
+        old_columns = {column.name: column for column in old_table.columns}
+        column_names = set()
+        for column in table.columns:
+            column_names.add(column.name)
+            old_column = old_columns.get(column.name)
+            if old_column is None:
+                changes.append(MetadataChange(table.name, column.name, ADDED))
+                continue
+            for kind, old_value, new_value in (
+                (RETYPED, old_column.data_type, column.data_type),
+                (REDESCRIBED, old_column.description, column.description),
+                (RECLASSIFIED, old_column.sensitivity, column.sensitivity),
+            ):
+                if old_value != new_value:
+                    changes.append(
+                        MetadataChange(
+                            table.name, column.name, kind, old_value, new_value
+                        )
+                    )
+        changes.extend(
+            MetadataChange(table.name, column.name, REMOVED)
+            for column in old_table.columns
+            if column.name not in column_names
+        )
+
+    changes.extend(
+        MetadataChange(name, None, REMOVED)
+        for name in old_tables
+        if name not in new_names
+    )
+    return diff
@@ -0,0 +1,193 @@
+"""
+Metadata index module
+---------------------
+Indexes the tables and columns of all the metadata files, so that they can be
+looked up by name or sensitivity without scanning the metadata, and keeps the
+names of the corresponding Synapse views and Purview assets.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .config import Configuration
+from .metadata import Column, Metadata, MetadataFile, Table
+
+
+def synapse_view_qualified_name(
+    server_name: str, database_name: str, schema_name: str, table_name: str
+) -> str:
+    """
+    Fully qualified name of a Synapse serverless view in Purview
+    """
+    return f"mssql://{server_name}/{database_name}/{schema_name}/{table_name}"
+
+
+@dataclass(frozen=True)
+class IndexedColumn:
+    version: str
+    table_name: str
+    column: Column
+    # qualified name of the view column in Purview
+    qualified_name: str
+
+
+@dataclass(frozen=True)
+class IndexedTable:
+    # version of the metadata file, e.g. 1.0.0
+    version: str
+    table: Table
+    # schema of the view in Synapse, e.g. v1_SalesLT
+    schema: str
+    # quoted name of the view in Synapse, e.g. [v1_SalesLT].[Customer]
+    sql_name: str
+    # qualified name of the view in Purview
+    qualified_name: str
+    columns: Dict[str, IndexedColumn] = field(default_factory=dict)
+
+
+class MetadataIndex:
+    """
+    Tables and columns of all the metadata versions, by name and sensitivity.
+
+    Example
+    -------
+        index = MetadataIndex.from_metadata_files(metadata_files, config)
+        customer = index.table("1.0.0", "Customer")
+        print(customer.qualified_name, customer.sql_name)
+        for column in index.columns_with_sensitivity("high"):
+            print(column.qualified_name)
+    """
+
+    def __init__(
+        self,
+        metadata: Iterable[Metadata],
+        server_name: str,
+        database_name: str,
+        schema: str,
+    ):
+        """
+        Parameters
+        ----------
+        metadata: Iterable[Metadata]
+            Parsed metadata files, one per version
+
+        server_name: str
+            Synapse serverless SQL endpoint, e.g. ws-ondemand.sql.azuresynapse.net
+
+        database_name: str
+            Synapse database of the views
+
+        schema: str
+            Schema of the views, prefixed by the major version (e.g. SalesLT)
+        """
+        self.metadata: Dict[str, Metadata] = {}
+        self._tables: Dict[Tuple[str, str], IndexedTable] = {}
+        self._tables_by_version: Dict[str, List[IndexedTable]] = defaultdict(list)
+        self._tables_by_sensitivity: Dict[str, List[IndexedTable]] = defaultdict(list)
+        self._columns_by_sensitivity: Dict[str, List[IndexedColumn]] = defaultdict(
+            list
+        )
+
+        for item in metadata:
+            self.metadata[item.version] = item
+            view_schema = f"{item.major_version_identifier}_{schema}"
+            for table in item.tables:
+                table_qualified_name = synapse_view_qualified_name(
+                    server_name, database_name, view_schema, table.name
+                )
+                indexed_table = IndexedTable(
+                    version=item.version,
+                    table=table,
+                    schema=view_schema,
+                    sql_name=f"[{view_schema}].[{table.name}]",
+                    qualified_name=table_qualified_name,
+                )
+                self._tables[(item.version, table.name)] = indexed_table
+                self._tables_by_version[item.version].append(indexed_table)
+                if table.sensitivity:
+                    self._tables_by_sensitivity[table.sensitivity].append(
+                        indexed_table
+                    )
+
+                for column in table.columns:
+                    indexed_column = IndexedColumn(
+                        version=item.version,
+                        table_name=table.name,
+                        column=column,
+                        qualified_name=f"{table_qualified_name}#{column.name}",
+                    )
+                    indexed_table.columns[column.name] = indexed_column
+                    if column.sensitivity:
+                        self._columns_by_sensitivity[column.sensitivity].append(
+                            indexed_column
+                        )
+
+    @classmethod
+    def for_configuration(
+        cls, metadata: Iterable[Metadata], configuration: Configuration
+    ) -> "MetadataIndex":
+        """
+        Index the metadata for the Synapse workspace of the configuration
+        """
+        workspace = configuration.synapse_workspace_name
+        return cls(
+            metadata,
+            server_name=f"{workspace}-ondemand.sql.azuresynapse.net",
+            database_name=configuration.synapse_database,
+            schema=configuration.synapse_database_schema,
+        )
+
+    @classmethod
+    def from_metadata_files(
+        cls, metadata_files: Iterable[MetadataFile], configuration: Configuration
+    ) -> "MetadataIndex":
+        """
+        Index the metadata files for the Synapse workspace of the configuration.
+        Files that could not be downloaded are skipped.
+        """
+        return cls.for_configuration(
+            (
+                metadata_file.metadata
+                for metadata_file in metadata_files
+                if metadata_file.metadata_json is not None
+            ),
+            configuration,
+        )
+
+    @property
+    def versions(self) -> List[str]:
+        return list(self.metadata)
+
+    def tables(self, version: str = None) -> List[IndexedTable]:
+        """
+        All the tables, or only the ones of a version, in metadata order
+        """
+        if version is None:
+            return list(self._tables.values())
+        return list(self._tables_by_version.get(version, []))
+
+    def table(self, version: str, table_name: str) -> Optional[IndexedTable]:
+        return self._tables.get((version, table_name))
+
+    def column(
+        self, version: str, table_name: str, column_name: str
+    ) -> Optional[IndexedColumn]:
+        table = self._tables.get((version, table_name))
+        if table is None:
+            return None
+        return table.columns.get(column_name)
+
+    def tables_with_sensitivity(self, sensitivity: str) -> List[IndexedTable]:
+        return list(self._tables_by_sensitivity.get(sensitivity, []))
+
+    def columns_with_sensitivity(self, sensitivity: str) -> List[IndexedColumn]:
+        return list(self._columns_by_sensitivity.get(sensitivity, []))
+
+    @property
+    def sensitivities(self) -> List[str]:
+        """
+        Sensitivity labels used by at least one table or column
+        """
+        return sorted(
+            set(self._tables_by_sensitivity) | set(self._columns_by_sensitivity)
+        )
@@ -0,0 +1,273 @@
+"""
+Metadata validation module
+--------------------------
+Checks the metadata files against the schema of the delta tables they
+describe, read from the delta logs, and generates metadata files from those
+schemas. No Synapse call is needed, so drift is found before data ingest.
+"""
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .delta import DeltaLogReader, DeltaSnapshot
+from .metadata import Column, Metadata, Table
+
+MISSING_TABLE = "missing_table"
+MISSING_COLUMN = "missing_column"
+EXTRA_COLUMN = "extra_column"
+TYPE_MISMATCH = "type_mismatch"
+
+# metadata type generated for each delta primitive type
+_METADATA_TYPES = {
+    "string": "Varchar",
+    "long": "Bigint",
+    "integer": "Integer",
+    "short": "Smallint",
+    "byte": "Tinyint",
+    "float": "Real",
+    "double": "Float",
+    "boolean": "Bit",
+    "binary": "Binary",
+    "date": "Date",
+    "timestamp": "Datetime",
+    "timestamp_ntz": "Datetime",
+}
+
+# metadata (SQL) types accepted for each delta type, lower case without length:
+# the types at least as wide as the delta type
+_COMPATIBLE_TYPES = {
+    "string": {"varchar", "nvarchar", "char", "nchar", "text", "guid", "xml"},
+    "long": {"bigint"},
+    "integer": {"integer", "int", "bigint"},
+    "short": {"smallint", "integer", "int", "bigint"},
+    "byte": {"tinyint", "smallint", "integer", "int", "bigint"},
+    "float": {"real", "float"},
+    "double": {"float"},
+    "boolean": {"bit"},
+    "binary": {"binary", "varbinary"},
+    "date": {"date"},
+    "timestamp": {"datetime", "datetime2", "smalldatetime", "datetimeoffset"},
+    "timestamp_ntz": {"datetime", "datetime2", "smalldatetime"},
+}
+
+_DECIMAL_PATTERN = re.compile(r"(?:decimal|numeric)\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)")
+_MONEY_TYPES = {"money": (19, 4), "smallmoney": (10, 4)}
+
+
+def metadata_type_for(delta_type: str) -> str:
+    """
+    Metadata type of a column, from its type in the delta schema
+    """
+    decimal = _DECIMAL_PATTERN.fullmatch(delta_type)
+    if decimal:
+        return f"Decimal({decimal[1]},{decimal[2]})"
+    # struct, array and map columns are exposed as json text by the views
+    return _METADATA_TYPES.get(delta_type, "Varchar")
+
+
+def is_compatible(delta_type: str, metadata_type: str) -> bool:
+    """
+    Whether the type declared in the metadata can hold the delta column type
+    """
+    declared = metadata_type.strip().lower()
+    decimal = _DECIMAL_PATTERN.fullmatch(delta_type)
+    if decimal:
+        precision_scale = (int(decimal[1]), int(decimal[2]))
+        declared_decimal = _DECIMAL_PATTERN.fullmatch(declared)
+        if declared_decimal:
+            return (int(declared_decimal[1]), int(declared_decimal[2])) == (
+                precision_scale
+            )
+        return _MONEY_TYPES.get(declared) == precision_scale
+    base_type = declared.split("(")[0].strip()
+    return base_type in _COMPATIBLE_TYPES.get(delta_type, {"varchar", "nvarchar"})
+
+
+@dataclass(frozen=True)
+class SchemaMismatch:
+    table: str
+    column: Optional[str]
+    kind: str
+    # type in the delta schema and in the metadata file
+    delta_type: Optional[str] = None
+    metadata_type: Optional[str] = None
+
+    def __str__(self) -> str:
+        name = self.table if self.column is None else f"{self.table}.{self.column}"
+        if self.kind == TYPE_MISMATCH:
+            return (
+                f"{self.kind} {name}: metadata {self.metadata_type!r}, "
+                f"delta {self.delta_type!r}"
+            )
+        return f"{self.kind} {name}"
+
+
+class MetadataValidator:
+    """
+    Compares metadata files with the delta tables of the container.
+    The delta logs of all the tables are read in parallel.
+
+    Example
+    -------
+        validator = MetadataValidator(DeltaLogReader.local("sample_data"))
+        for mismatch in validator.validate(metadata, schema="SalesLT"):
+            print(mismatch)
+    """
+
+    def __init__(self, reader: DeltaLogReader, max_workers: int = 8):
+        self.logger = logging.getLogger(__name__)
+        self._reader = reader
+        self._max_workers = max_workers
+
+    @staticmethod
+    def table_folder(path: str, schema: str, table_name: str) -> str:
+        """
+        Folder of a table in the container, as used by the views: the sample
+        data embeds the schema in the folder name, e.g. v1/SalesLT_Customer
+        """
+        return f"{path}/{schema}_{table_name}"
+
+    def read_snapshots(self, folders: List[str]) -> Dict[str, Optional[DeltaSnapshot]]:
+        """
+        Snapshots of the delta tables, None for the folders without a delta log
+        """
+
+        def read(folder: str) -> Optional[DeltaSnapshot]:
+            try:
+                return self._reader.snapshot(folder)
+            except FileNotFoundError:
+                return None
+
+        with ThreadPoolExecutor(self._max_workers) as executor:
+            return dict(zip(folders, executor.map(read, folders)))
+
+    def validate(self, metadata: Metadata, schema: str) -> List[SchemaMismatch]:
+        """
+        Tables and columns of the metadata file that do not match the delta tables
+        """
+        folders = {
+            table.name: self.table_folder(metadata.path, schema, table.name)
+            for table in metadata.tables
+        }
+        snapshots = self.read_snapshots(list(folders.values()))
+
+        mismatches = []
+        for table in metadata.tables:
+            snapshot = snapshots[folders[table.name]]
+            if snapshot is None:
+                mismatches.append(SchemaMismatch(table.name, None, MISSING_TABLE))
+                continue
+            delta_columns = {column.name: column for column in snapshot.columns}
+            for column in table.columns:
+                delta_column = delta_columns.pop(column.name, None)
+                if delta_column is None:
+                    mismatches.append(
+                        SchemaMismatch(
+                            table.name,
+                            column.name,
+                            MISSING_COLUMN,
+                            metadata_type=column.data_type,
+                        )
+                    )
+                elif not is_compatible(delta_column.type, column.data_type):
+                    mismatches.append(
+                        SchemaMismatch(
+                            table.name,
+                            column.name,
+                            TYPE_MISMATCH,
+                            delta_type=delta_column.type,
+                            metadata_type=column.data_type,
+                        )
+                    )
+            mismatches.extend(
+                SchemaMismatch(
+                    table.name, name, EXTRA_COLUMN, delta_type=delta_column.type
+                )
+                for name, delta_column in delta_columns.items()
+            )
+        self.logger.info(
+            f"Metadata {metadata.version} validated: {len(mismatches)} mismatches"
+        )
+        return mismatches
+
+    def generate(
+        self,
+        version: str,
+        path: str,
+        schema: str,
+        existing: Metadata = None,
+    ) -> Metadata:
+        """
+        Metadata file describing all the delta tables of a folder.
+
+        Parameters
+        ----------
+        version: str
+            version of the metadata file, e.g. 2.0.0
+
+        path: str
+            folder of the tables in the container, e.g. v2
+
+        schema: str
+            schema embedded in the folder names of the tables, e.g. SalesLT
+
+        existing: Metadata = None
+            Optional.
+            Metadata file whose descriptions, sensitivity and keys are kept for
+            the tables and columns that still exist.
+        """
+        prefix = f"{schema}_"
+        folders = [
+            folder
+            for folder in self._reader.list_tables(path)
+            if folder.rsplit("/", 1)[-1].startswith(prefix)
+        ]
+        snapshots = self.read_snapshots(folders)
+        existing_tables = (
+            {table.name: table for table in existing.tables} if existing else {}
+        )
+
+        tables = []
+        for folder in folders:
+            snapshot = snapshots[folder]
+            if snapshot is None:
+                continue
+            name = folder.rsplit("/", 1)[-1].replace(prefix, "", 1)
+            previous = existing_tables.get(name)
+            previous_columns = (
+                {column.name: column for column in previous.columns}
+                if previous
+                else {}
+            )
+            columns = []
+            for delta_column in snapshot.columns:
+                column = previous_columns.get(delta_column.name)
+                data_type = metadata_type_for(delta_column.type)
+                if column is not None and is_compatible(
+                    delta_column.type, column.data_type
+                ):
+                    data_type = column.data_type
+                columns.append(
+                    Column(
+                        name=delta_column.name,
+                        description=column.description if column else "",
+                        sensitivity=column.sensitivity if column else "",
+                        data_type=data_type,
+                        is_key=column.is_key if column else False,
+                    )
+                )
+            tables.append(
+                Table(
+                    name=name,
+                    columns=tuple(columns),
+                    description=previous.description if previous else "",
+                    sensitivity=previous.sensitivity if previous else "",
+                    cluster_by=previous.cluster_by if previous else (),
+                )
+            )
+        # tables already described keep their order, new ones come after
+        order = {name: index for index, name in enumerate(existing_tables)}
+        tables.sort(key=lambda table: order.get(table.name, len(order)))
+        return Metadata(version=version, path=path, tables=tuple(tables))
@@ -2,26 +2,87 @@
 Purview Catalog helper module
 """
 import logging
-from typing import Any, Union
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Union
 
 from azure.core.exceptions import HttpResponseError
+from azure.core.rest import HttpRequest
 
 from ..config import Configuration
+from ..metadata_index import synapse_view_qualified_name
 from .clients import ClientHelper
+from .entity_cache import EntityCache, get_entity_cache
 
 JSONType = Any
 
+# qualified names resolved per request: they are sent in the query string, and
+# 50 synapse column names stay well below the URL length limits
+RESOLVE_CHUNK_SIZE = 50
+# entities per bulk update request
+UPDATE_CHUNK_SIZE = 100
+
+
+@dataclass(frozen=True)
+class EntityUpdate:
+    """New values of attributes of an existing entity"""
+
+    guid: str
+    type_name: str
+    qualified_name: str
+    # name of the entity, required by the bulk API
+    name: str
+    # e.g. {"description": "..."}
+    attributes: Dict[str, Any]
+
+    def to_json(self) -> JSONType:
+        return {
+            "guid": self.guid,
+            "typeName": self.type_name,
+            "attributes": {
+                **self.attributes,
+                "qualifiedName": self.qualified_name,
+                "name": self.name,
+            },
+        }
+
+
+@dataclass
+class EntityUpdateResult:
+    """Entities updated, and error by entity id of the ones that failed"""
+
+    updated: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    requests: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.updated)} entities updated, {len(self.failed)} failed, "
+            f"in {self.requests} requests"
+        )
+
 
 class CatalogHelper:
     """
     Catalog helper functions
     """
 
-    def __init__(self, configuration: Configuration):
+    def __init__(self, configuration: Configuration, entity_cache: EntityCache = None):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+
+        entity_cache: EntityCache = None
+            Optional.
+            cache of the entities read by guid. Default the cache of the
+            process, shared with the ManagedAttributesHelper.
+        """
         self._configuration = configuration
         self.logger = logging.getLogger(__name__)
         purviewhelper = ClientHelper(account_name=configuration.purview_account_name)
         self._catalog_client = purviewhelper.get_catalog_client()
+        self._entity_cache = entity_cache or get_entity_cache()
 
     def get_synapse_table_fully_qualified_name(
         self, server_name: str, database_name: str, schema_name: str, table_name: str
@@ -30,7 +91,9 @@ class CatalogHelper:
         """
         Get the fully qualified name of a table given its attributes
         """
-        return f"mssql://{server_name}/{database_name}/{schema_name}/{table_name}"
+        return synapse_view_qualified_name(
+            server_name, database_name, schema_name, table_name
+        )
 
     def get_asset_by_fully_qualified_name(
         self, qualified_name: str, type_name: str
@@ -66,6 +129,96 @@ class CatalogHelper:
             self.logger.error(ex)
             return None
 
+    def resolve_qualified_names(
+        self,
+        qualified_names: Iterable[str],
+        type_name: str,
+        chunk_size: int = RESOLVE_CHUNK_SIZE,
+        max_workers: int = 4,
+    ) -> Dict[str, str]:
+        """
+        Resolves the entity ids of many assets of a type at once, through the
+        Atlas bulk unique attributes endpoint: one request per chunk of
+        qualified names instead of one per asset, with the chunks requested
+        concurrently.
+
+        Parameters
+        ----------
+        qualified_names: Iterable[str]
+            fully qualified names of the assets, e.g. the qualified names of the
+            tables or columns of a MetadataIndex
+
+        type_name: str
+            type of the assets, e.g. azure_synapse_serverless_sql_view
+
+        chunk_size: int = 50
+            Optional.
+            number of qualified names per request
+
+        max_workers: int = 4
+            Optional.
+            number of requests sent at once
+
+        Returns
+        -------
+        Dict[str, str]: entity id by qualified name. The names that are not
+        in the catalog, or whose request failed, are logged and left out.
+        """
+        names = list(dict.fromkeys(qualified_names))
+        chunks = [
+            names[start:start + chunk_size]
+            for start in range(0, len(names), chunk_size)
+        ]
+        guids: Dict[str, str] = {}
+        if not chunks:
+            return guids
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+            for entities in pool.map(
+                lambda chunk: self._get_entities_by_qualified_names(chunk, type_name),
+                chunks,
+            ):
+                for entity in entities:
+                    qualified_name = entity.get("attributes", {}).get("qualifiedName")
+                    if qualified_name and entity.get("guid"):
+                        guids[qualified_name] = entity["guid"]
+
+        missing = [name for name in names if name not in guids]
+        if missing:
+            self.logger.warning(
+                f"{len(missing)} of {len(names)} {type_name} assets not found: "
+                f"{', '.join(missing[:10])}{'...' if len(missing) > 10 else ''}"
+            )
+        return guids
+
+    def _get_entities_by_qualified_names(
+        self, qualified_names: List[str], type_name: str
+    ) -> List[JSONType]:
+        """
+        Entities of a type by qualified name, in one request. The catalog
+        client only exposes one attr_N parameter, so the request is sent as is.
+        """
+        params = {
+            f"attr_{position}:qualifiedName": qualified_name
+            for position, qualified_name in enumerate(qualified_names)
+        }
+        params["minExtInfo"] = "true"
+        params["ignoreRelationships"] = "true"
+        request = HttpRequest(
+            "GET",
+            f"/atlas/v2/entity/bulk/uniqueAttribute/type/{type_name}",
+            params=params,
+        )
+        try:
+            response = self._catalog_client.send_request(request)
+            if response.status_code == 404:
+                return []
+            response.raise_for_status()
+            return response.json().get("entities", [])
+        except (ValueError, HttpResponseError) as ex:
+            self.logger.error(ex)
+            return []
+
     def get_entity_id_from_asset(self, asset: Any) -> Union[str, None]:
         """Extracts the entity id from a purview catalog asset"""
         try:
@@ -89,15 +242,88 @@ class CatalogHelper:
 
         except (ValueError, HttpResponseError) as ex:
             self.logger.error(ex)
+        finally:
+            self._entity_cache.invalidate(entity_id)
 
-    def get_by_guid(self, guid: str):
+    def update_entities(
+        self,
+        updates: Iterable[EntityUpdate],
+        chunk_size: int = UPDATE_CHUNK_SIZE,
+        max_workers: int = 4,
+    ) -> EntityUpdateResult:
         """
-        Get an entity by guid
+        Updates attributes of many entities through the Atlas bulk entity API,
+        in chunks requested concurrently, instead of one partial update per
+        entity and attribute. Only the attributes given are changed.
+
+        A bulk request is applied atomically: when a chunk fails, it is split
+        and sent again, so that only the entities whose update is rejected
+        are reported as failed.
+
+        Parameters
+        ----------
+        updates: Iterable[EntityUpdate]
+            new attribute values, e.g. the descriptions of the views and columns
+            of a metadata file
+
+        chunk_size: int = 100
+            Optional.
+            number of entities per request
+
+        max_workers: int = 4
+            Optional.
+            number of requests sent at once
         """
+        updates = list(updates)
+        chunks = [
+            updates[start:start + chunk_size]
+            for start in range(0, len(updates), chunk_size)
+        ]
+        result = EntityUpdateResult()
+        if not chunks:
+            return result
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+            for chunk_result in pool.map(self._update_entities_chunk, chunks):
+                result.updated.extend(chunk_result.updated)
+                result.failed.update(chunk_result.failed)
+                result.requests += chunk_result.requests
+
+        for guid, error in result.failed.items():
+            self.logger.error(f"Entity {guid} could not be updated: {error}")
+        return result
+
+    def _update_entities_chunk(self, chunk: List[EntityUpdate]) -> EntityUpdateResult:
+        result = EntityUpdateResult(requests=1)
         try:
-            response = self._catalog_client.entity.get_by_guid(guid)  # type: ignore
-            return response
+            self._catalog_client.entity.create_or_update_entities(
+                entities={"entities": [update.to_json() for update in chunk]}
+            )
+            result.updated = [update.guid for update in chunk]
+        except (ValueError, HttpResponseError) as ex:
+            if len(chunk) == 1:
+                result.failed[chunk[0].guid] = str(ex)
+            else:
+                middle = len(chunk) // 2
+                for half in (chunk[:middle], chunk[middle:]):
+                    half_result = self._update_entities_chunk(half)
+                    result.updated.extend(half_result.updated)
+                    result.failed.update(half_result.failed)
+                    result.requests += half_result.requests
+        finally:
+            for update in chunk:
+                self._entity_cache.invalidate(update.guid)
+        return result
+
+    def get_by_guid(self, guid: str):
+        """
+        Get an entity by guid, from the entity cache if it was recently read
+        """
+        return self._entity_cache.get_or_fetch(guid, self._fetch_by_guid)
 
+    def _fetch_by_guid(self, guid: str):
+        try:
+            return self._catalog_client.entity.get_by_guid(guid)  # type: ignore
         except (ValueError, HttpResponseError) as ex:
             self.logger.error(ex)
 
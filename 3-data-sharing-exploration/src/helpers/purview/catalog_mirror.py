@@ -0,0 +1,539 @@
+"""
+Purview catalog mirror module
+-----------------------------
+Local SQLite copy of the entities of a Purview collection tree: qualified
+names, types, collections, managed (business) attributes and the columns of
+the views and tables, so that security resolution and audits can run as local
+queries instead of reading Purview entity by entity.
+
+The first refresh lists all the entities of the collections and reads them in
+bulk. The following ones only read the entities updated since the last
+refresh, and remove the entities that are no longer listed.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from azure.core.exceptions import HttpResponseError
+
+from ..config import Configuration
+from .clients import ClientHelper
+from .collections import CollectionHelper
+from .managed_attributes import ManagedAttributeUpdate
+
+JSONType = Any
+
+DEFAULT_MIRROR_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "eds", "catalog"
+)
+
+# entities read per bulk request: their guids are sent in the query string
+_FETCH_CHUNK_SIZE = 100
+_SEARCH_PAGE_SIZE = 1000
+# entities updated up to this long before the last refresh are read again, as
+# the search index of Purview is updated asynchronously
+_REFRESH_OVERLAP_MS = 10 * 60 * 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    guid TEXT PRIMARY KEY,
+    type_name TEXT NOT NULL,
+    qualified_name TEXT,
+    name TEXT,
+    collection TEXT,
+    update_time INTEGER
+);
+CREATE INDEX IF NOT EXISTS entities_qualified_name
+    ON entities (qualified_name, type_name);
+CREATE TABLE IF NOT EXISTS business_attributes (
+    guid TEXT NOT NULL,
+    attribute_group TEXT NOT NULL,
+    name TEXT NOT NULL,
+    -- JSON value
+    value TEXT,
+    PRIMARY KEY (guid, attribute_group, name)
+);
+CREATE INDEX IF NOT EXISTS business_attributes_name
+    ON business_attributes (attribute_group, name);
+CREATE TABLE IF NOT EXISTS columns (
+    table_guid TEXT NOT NULL,
+    column_guid TEXT NOT NULL,
+    name TEXT,
+    PRIMARY KEY (table_guid, column_guid)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    collections TEXT PRIMARY KEY,
+    update_time INTEGER,
+    refreshed_at TEXT NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class CatalogEntity:
+    guid: str
+    type_name: str
+    qualified_name: Optional[str]
+    name: Optional[str]
+    # name of the collection of the entity
+    collection: Optional[str]
+    # last update of the entity in Purview, in milliseconds since the epoch
+    update_time: Optional[int]
+    # managed attributes by group, e.g. {"Metadata": {"Sensitivity": "low"}}
+    business_attributes: Dict[str, Dict[str, JSONType]] = field(
+        default_factory=dict
+    )
+
+
+@dataclass
+class CatalogRefresh:
+    """Entities added, updated and removed by a refresh"""
+
+    collections: List[str]
+    full: bool = False
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    # entities listed or read whose update failed
+    failed: List[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"{'full' if self.full else 'incremental'} refresh of "
+            f"{len(self.collections)} collections: {len(self.added)} added, "
+            f"{len(self.updated)} updated, {len(self.removed)} removed, "
+            f"{len(self.failed)} failed"
+        )
+
+
+def _column_relations(entity: JSONType) -> List[JSONType]:
+    relationships = entity.get("relationshipAttributes") or {}
+    return relationships.get("columns") or []
+
+
+class CatalogMirror:
+    """
+    Entities of a Purview collection tree, persisted in a SQLite file.
+    Safe to use from several threads.
+
+    Example
+    -------
+        mirror = CatalogMirror.for_configuration(config)
+        mirror.refresh_from_purview(config)
+        guids = mirror.resolve_qualified_names(names, type_name)
+        print(mirror.m_attribute_value(guids[names[0]], "Metadata", "Sensitivity"))
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path: str
+            SQLite file of the mirror, created if missing, or :memory:
+        """
+        self.logger = logging.getLogger(__name__)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def for_collection(
+        cls, account_name: str, collection_name: str
+    ) -> "CatalogMirror":
+        """
+        Mirror of a collection tree in the default location, shared by the stages
+        """
+        return cls(
+            os.path.join(DEFAULT_MIRROR_DIR, account_name, f"{collection_name}.sqlite")
+        )
+
+    @classmethod
+    def for_configuration(cls, configuration: Configuration) -> "CatalogMirror":
+        """Mirror of the Purview collection of the configuration"""
+        return cls.for_collection(
+            configuration.purview_account_name, configuration.purview_collection_name
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def refresh_from_purview(
+        self,
+        configuration: Configuration,
+        full: bool = False,
+        prune: bool = True,
+        max_workers: int = 4,
+    ) -> CatalogRefresh:
+        """
+        Refreshes the entities of the Purview collection of the configuration
+        and of its descendants, see refresh
+        """
+        collections = CollectionHelper(configuration).get_collection_tree(
+            configuration.purview_collection_name
+        )
+        catalog_client = ClientHelper(
+            account_name=configuration.purview_account_name
+        ).get_catalog_client()
+        return self.refresh(
+            catalog_client,
+            collections,
+            full=full,
+            prune=prune,
+            max_workers=max_workers,
+        )
+
+    def refresh(
+        self,
+        catalog_client,
+        collections: Iterable[str],
+        full: bool = False,
+        prune: bool = True,
+        max_workers: int = 4,
+    ) -> CatalogRefresh:
+        """
+        Reads the entities of the collections that changed since the last
+        refresh, or all of them on the first refresh.
+
+        Parameters
+        ----------
+        catalog_client: azure.purview.catalog.PurviewCatalogClient
+
+        collections: Iterable[str]
+            names of the collections mirrored, e.g. the result of
+            CollectionHelper.get_collection_tree
+
+        full: bool = False
+            Optional.
+            read all the entities again
+
+        prune: bool = True
+            Optional.
+            list the ids of all the entities of the collections to remove the
+            deleted ones and to update the moved ones, and read the entities
+            missing from the mirror. Without it, only the entities updated
+            since the last refresh are read.
+
+        max_workers: int = 4
+            Optional.
+            number of requests sent at once
+        """
+        collections = sorted(set(collections))
+        key = ",".join(collections)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT update_time FROM refreshes WHERE collections = ?", (key,)
+            ).fetchone()
+            known = dict(
+                self._connection.execute("SELECT guid, collection FROM entities")
+            )
+        last_update_time = None if full or row is None else row[0]
+        result = CatalogRefresh(collections, full=last_update_time is None)
+
+        to_fetch = set()
+        listed: Dict[str, str] = {}
+        if result.full or prune:
+            # ids and collections of all the entities of the collection tree
+            with ThreadPoolExecutor(max_workers) as executor:
+                for collection, assets in zip(
+                    collections,
+                    executor.map(
+                        lambda collection: self._search(catalog_client, collection),
+                        collections,
+                    ),
+                ):
+                    for asset in assets:
+                        listed[asset["id"]] = collection
+            if result.full:
+                to_fetch.update(listed)
+            else:
+                to_fetch.update(guid for guid in listed if guid not in known)
+        if not result.full:
+            since = (last_update_time or 0) - _REFRESH_OVERLAP_MS
+            with ThreadPoolExecutor(max_workers) as executor:
+                for assets in executor.map(
+                    lambda collection: self._search(catalog_client, collection, since),
+                    collections,
+                ):
+                    to_fetch.update(asset["id"] for asset in assets)
+
+        guids = sorted(to_fetch)
+        chunks = [
+            guids[start:start + _FETCH_CHUNK_SIZE]
+            for start in range(0, len(guids), _FETCH_CHUNK_SIZE)
+        ]
+        entities: List[JSONType] = []
+        with ThreadPoolExecutor(max_workers) as executor:
+            for chunk, fetched in zip(
+                chunks,
+                executor.map(lambda chunk: self._fetch(catalog_client, chunk), chunks),
+            ):
+                if fetched is None:
+                    result.failed.extend(chunk)
+                else:
+                    entities.extend(fetched)
+
+        # the entities that could not be read are read again by the next refresh
+        update_time = last_update_time
+        if not result.failed:
+            update_time = max(
+                [last_update_time or 0]
+                + [entity.get("updateTime") or 0 for entity in entities]
+            )
+        with self._lock, self._connection:
+            for entity in entities:
+                guid = entity["guid"]
+                (result.updated if guid in known else result.added).append(guid)
+                self._upsert(entity, listed.get(guid))
+            if prune or result.full:
+                result.removed = sorted(set(known) - set(listed))
+                self._delete(result.removed)
+                # entities moved to another collection of the tree
+                self._connection.executemany(
+                    "UPDATE entities SET collection = ? WHERE guid = ?",
+                    [
+                        (collection, guid)
+                        for guid, collection in listed.items()
+                        if guid in known and known[guid] != collection
+                    ],
+                )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)",
+                (key, update_time, datetime.now(timezone.utc).isoformat()),
+            )
+        self.logger.info(f"Catalog mirror {self._path}: {result}")
+        return result
+
+    def _search(
+        self, catalog_client, collection: str, updated_since: Optional[int] = None
+    ) -> List[JSONType]:
+        """
+        Search results of the entities of a collection, optionally only the
+        ones updated after a time in milliseconds since the epoch
+        """
+        filter: JSONType = {"collectionId": collection}
+        if updated_since is not None:
+            filter = {
+                "and": [
+                    filter,
+                    {
+                        "updateTime": {
+                            "operator": "gt",
+                            "timeThreshold": max(updated_since, 0),
+                        }
+                    },
+                ]
+            }
+        results = []
+        offset = 0
+        while True:
+            page = catalog_client.discovery.query(
+                {"filter": filter, "limit": _SEARCH_PAGE_SIZE, "offset": offset}
+            )["value"]
+            results.extend(page)
+            if len(page) < _SEARCH_PAGE_SIZE:
+                return results
+            offset += _SEARCH_PAGE_SIZE
+
+    def _fetch(self, catalog_client, guids: List[str]) -> Optional[List[JSONType]]:
+        """Entities of a chunk of guids, in one request, or None if it failed"""
+        try:
+            response = catalog_client.entity.list_by_guids(
+                guids=guids, min_ext_info=True
+            )
+            return response.get("entities") or []
+        except (ValueError, HttpResponseError) as ex:
+            self.logger.error(ex)
+            return None
+
+    def _upsert(self, entity: JSONType, collection: Optional[str]):
+        guid = entity["guid"]
+        attributes = entity.get("attributes") or {}
+        self._delete([guid], keep_entity=True)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                guid,
+                entity.get("typeName"),
+                attributes.get("qualifiedName"),
+                attributes.get("name"),
+                entity.get("collectionId") or collection,
+                entity.get("updateTime"),
+            ),
+        )
+        self._connection.executemany(
+            "INSERT INTO business_attributes VALUES (?, ?, ?, ?)",
+            [
+                (guid, group, name, json.dumps(value))
+                for group, values in (entity.get("businessAttributes") or {}).items()
+                for name, value in values.items()
+            ],
+        )
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO columns VALUES (?, ?, ?)",
+            [
+                (guid, column["guid"], column.get("displayText"))
+                for column in _column_relations(entity)
+                if column.get("guid")
+            ],
+        )
+
+    def _delete(self, guids: List[str], keep_entity: bool = False):
+        rows = [(guid,) for guid in guids]
+        self._connection.executemany(
+            "DELETE FROM business_attributes WHERE guid = ?", rows
+        )
+        self._connection.executemany("DELETE FROM columns WHERE table_guid = ?", rows)
+        if not keep_entity:
+            self._connection.executemany("DELETE FROM entities WHERE guid = ?", rows)
+
+    def set_m_attribute(
+        self, guid: str, m_attribute_group: str, m_attribute_name: str, value: Any
+    ):
+        """
+        Records a managed attribute written to Purview, e.g. by
+        ManagedAttributesHelper.update_m_attribute, before the next refresh
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO business_attributes VALUES (?, ?, ?, ?)",
+                (guid, m_attribute_group, m_attribute_name, json.dumps(value)),
+            )
+
+    def set_m_attributes(self, updates: Iterable[ManagedAttributeUpdate]):
+        """
+        Records managed attributes written to Purview, e.g. by a flushed
+        ManagedAttributeBatch, in one transaction
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO business_attributes VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        update.entity_id,
+                        update.m_attribute_group,
+                        update.m_attribute_name,
+                        json.dumps(update.m_attribute_value),
+                    )
+                    for update in updates
+                ],
+            )
+
+    def _entities(self, condition: str, parameters: tuple) -> List[CatalogEntity]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT guid, type_name, qualified_name, name, collection, "
+                f"update_time FROM entities WHERE {condition} ORDER BY qualified_name",
+                parameters,
+            ).fetchall()
+            attributes: Dict[str, Dict[str, Dict[str, JSONType]]] = {}
+            for guid, group, name, value in self._connection.execute(
+                "SELECT guid, attribute_group, name, value FROM business_attributes "
+                f"WHERE guid IN (SELECT guid FROM entities WHERE {condition})",
+                parameters,
+            ):
+                attributes.setdefault(guid, {}).setdefault(group, {})[
+                    name
+                ] = json.loads(value)
+        return [
+            CatalogEntity(*row, business_attributes=attributes.get(row[0], {}))
+            for row in rows
+        ]
+
+    def get(self, guid: str) -> Optional[CatalogEntity]:
+        entities = self._entities("guid = ?", (guid,))
+        return entities[0] if entities else None
+
+    def entities(
+        self, type_name: str = None, collection: str = None
+    ) -> List[CatalogEntity]:
+        """Entities of the mirror, optionally of a type or collection"""
+        conditions, parameters = ["1 = 1"], []
+        if type_name is not None:
+            conditions.append("type_name = ?")
+            parameters.append(type_name)
+        if collection is not None:
+            conditions.append("collection = ?")
+            parameters.append(collection)
+        return self._entities(" AND ".join(conditions), tuple(parameters))
+
+    def resolve_qualified_names(
+        self, qualified_names: Iterable[str], type_name: str
+    ) -> Dict[str, str]:
+        """
+        Entity ids by qualified name, like CatalogHelper.resolve_qualified_names.
+        The names that are not in the mirror are left out.
+        """
+        names = list(dict.fromkeys(qualified_names))
+        guids = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a query
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                guids.update(
+                    self._connection.execute(
+                        "SELECT qualified_name, guid FROM entities "
+                        "WHERE type_name = ? AND qualified_name IN "
+                        f"({', '.join('?' * len(chunk))})",
+                        (type_name, *chunk),
+                    ).fetchall()
+                )
+        return guids
+
+    def m_attribute_value(
+        self, guid: str, m_attribute_group: str, m_attribute_name: str
+    ) -> Optional[JSONType]:
+        """Value of a managed attribute of an entity, or None if not set"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM business_attributes "
+                "WHERE guid = ? AND attribute_group = ? AND name = ?",
+                (guid, m_attribute_group, m_attribute_name),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def with_m_attribute(
+        self, m_attribute_group: str, m_attribute_name: str, value: Any = None
+    ) -> Iterator[CatalogEntity]:
+        """
+        Entities with a managed attribute, optionally with a given value,
+        e.g. for audits of the security groups assigned
+        """
+        condition = (
+            "guid IN (SELECT guid FROM business_attributes "
+            "WHERE attribute_group = ? AND name = ?"
+        )
+        parameters: tuple = (m_attribute_group, m_attribute_name)
+        if value is not None:
+            condition += " AND value = ?"
+            parameters += (json.dumps(value),)
+        yield from self._entities(f"{condition})", parameters)
+
+    def columns(self, table_guid: str) -> Dict[str, str]:
+        """
+        Names of the columns of a view or table by guid, like
+        CatalogHelper.get_all_columns_per_entity
+        """
+        with self._lock:
+            return dict(
+                self._connection.execute(
+                    "SELECT column_guid, name FROM columns WHERE table_guid = ?",
+                    (table_guid,),
+                ).fetchall()
+            )
+
+    def last_refresh(self) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(refreshed_at) FROM refreshes"
+            ).fetchone()
+        return row[0]
@@ -116,6 +116,15 @@ class CollectionHelper:
             result.append(child.get("name"))
         return result
 
+    def get_collection_tree(self, collection_name: str) -> List[str]:
+        """
+        Names of a collection and of all its descendants, parents first
+        """
+        result = [collection_name]
+        for child in self.get_children(collection_name):
+            result.extend(self.get_collection_tree(child))
+        return result
+
     def cleanup_collection(self, collection_name: str):
         """
         Deletes catalog items from a given collection
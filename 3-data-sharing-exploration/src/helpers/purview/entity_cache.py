@@ -0,0 +1,155 @@
+"""
+Purview entity cache module
+---------------------------
+Entities read from the Purview catalog by GUID, shared by the catalog and
+managed attribute helpers of the process, so that an entity read several times
+in one run (its managed attributes, then its columns, then again by the
+security stage) is only fetched once. Entries are evicted when least recently
+used and after a time to live, and invalidated by the writes of the helpers.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+JSONType = Any
+
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_TTL_SECONDS = 300.0
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    # entries dropped because the cache was full
+    evictions: int
+    # entries dropped because they were older than the time to live
+    expirations: int
+    # entries dropped because the entity was written
+    invalidations: int
+    size: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%} hits), "
+            f"{self.evictions} evicted, {self.expirations} expired, "
+            f"{self.invalidations} invalidated, {self.size} cached"
+        )
+
+
+class EntityCache:
+    """
+    Thread safe LRU cache of Purview entities by GUID, with a time to live.
+
+    The cached entities are shared: callers must not modify them.
+
+    Example
+    -------
+        cache = EntityCache(max_entries=1000, ttl_seconds=60)
+        entity = cache.get_or_fetch(guid, client.entity.get_by_guid)
+        cache.invalidate(guid)  # after updating the entity
+        print(cache.stats())
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+    ):
+        """
+        Parameters
+        ----------
+        max_entries: int = 2048
+            Optional.
+            number of entities kept, the least recently used are evicted first
+
+        ttl_seconds: float = 300
+            Optional.
+            seconds after which an entity is fetched again, so that the changes
+            made outside of the process are eventually seen
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # guid: (expiry, entity), least recently used first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, guid: str) -> Optional[JSONType]:
+        """Cached entity, or None if not cached or expired"""
+        with self._lock:
+            entry = self._entries.get(guid)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[guid]
+                self._expirations += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(guid)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, guid: str, entity: JSONType):
+        with self._lock:
+            self._entries[guid] = (time.monotonic() + self.ttl_seconds, entity)
+            self._entries.move_to_end(guid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def get_or_fetch(
+        self, guid: str, fetch: Callable[[str], Optional[JSONType]]
+    ) -> Optional[JSONType]:
+        """
+        Cached entity, or the entity returned by fetch(guid), which is cached
+        unless it is None. Concurrent misses on the same entity may fetch it
+        more than once.
+        """
+        entity = self.get(guid)
+        if entity is None:
+            entity = fetch(guid)
+            if entity is not None:
+                self.put(guid, entity)
+        return entity
+
+    def invalidate(self, guid: str):
+        """Drops an entity, e.g. after updating its attributes"""
+        with self._lock:
+            if self._entries.pop(guid, None) is not None:
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                invalidations=self._invalidations,
+                size=len(self._entries),
+            )
+
+
+# shared by all the helpers of the process
+_entity_cache = EntityCache()
+
+
+def get_entity_cache() -> EntityCache:
+    """Entity cache of the process"""
+    return _entity_cache
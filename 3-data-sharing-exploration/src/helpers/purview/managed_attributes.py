@@ -3,9 +3,13 @@ Purview Managed Attributes helper functions
 """
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 # pyright: reportMissingTypeStubs=false
-from typing import Any, Union
+from typing import Any, Dict, Iterable, List, Tuple, Union
 
 import requests
 from azure.core.exceptions import HttpResponseError
@@ -13,17 +17,132 @@ from azure.purview.catalog import PurviewCatalogClient
 
 from ..config import Configuration
 from .clients import ClientHelper
+from .entity_cache import EntityCache, get_entity_cache
 
 JSONType = Any
 
+# access tokens of the process by tenant and client id: (token, expiry time)
+_tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+_tokens_lock = threading.Lock()
+# tokens are requested again this long before they expire
+_TOKEN_EXPIRY_MARGIN_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class ManagedAttributeUpdate:
+    entity_id: str
+    m_attribute_group: str
+    m_attribute_name: str
+    m_attribute_value: Any
+
+
+@dataclass
+class ManagedAttributeUpdateResult:
+    """Entities updated, and error by entity id of the ones that failed"""
+
+    updated: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    # updates given, before the ones of the same entity were merged
+    updates: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.updates} managed attribute updates: {len(self.updated)} "
+            f"entities updated, {len(self.failed)} failed"
+        )
+
+
+class ManagedAttributeBatch:
+    """
+    Managed attribute updates collected to be written together by
+    ManagedAttributesHelper.update_m_attributes. update_m_attribute has the
+    signature of the one of the helper, so that a batch can be passed where
+    the helper writes one attribute at a time.
+
+    Example
+    -------
+        batch = managed_attribute_helper.batch()
+        for entity_id in entity_ids:
+            batch.update_m_attribute(entity_id, "Metadata", "Security", "group")
+        print(batch.flush())
+    """
+
+    def __init__(
+        self,
+        helper: "ManagedAttributesHelper",
+        max_workers: int = 8,
+        catalog_mirror=None,
+    ):
+        """
+        Parameters
+        ----------
+        helper: ManagedAttributesHelper
+
+        max_workers: int = 8
+            Optional.
+            number of requests sent at once
+
+        catalog_mirror: CatalogMirror = None
+            Optional.
+            local mirror of the catalog in which the updates written are
+            recorded, so that it can be read right after the flush, before the
+            search index of Purview reports the entities as updated
+        """
+        self._helper = helper
+        self._max_workers = max_workers
+        self._catalog_mirror = catalog_mirror
+        self._updates: List[ManagedAttributeUpdate] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._updates)
+
+    def update_m_attribute(
+        self,
+        entity_id: str,
+        m_attribute_group: str,
+        m_attribute_name: str,
+        m_attribute_value: Any,
+    ):
+        with self._lock:
+            self._updates.append(
+                ManagedAttributeUpdate(
+                    entity_id, m_attribute_group, m_attribute_name, m_attribute_value
+                )
+            )
+
+    def flush(self) -> ManagedAttributeUpdateResult:
+        """Writes the updates collected since the last flush"""
+        with self._lock:
+            updates, self._updates = self._updates, []
+        result = self._helper.update_m_attributes(updates, self._max_workers)
+        if self._catalog_mirror is not None:
+            written = set(result.updated)
+            self._catalog_mirror.set_m_attributes(
+                update for update in updates if update.entity_id in written
+            )
+        return result
+
 
 class ManagedAttributesHelper:
 
     _catalog_client: PurviewCatalogClient
     _configuration: Configuration
+    _entity_cache: EntityCache
+
+    def __init__(self, configuration: Configuration, entity_cache: EntityCache = None):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
 
-    def __init__(self, configuration: Configuration):
+        entity_cache: EntityCache = None
+            Optional.
+            cache of the entities read by guid. Default the cache of the
+            process, shared with the CatalogHelper.
+        """
         self._configuration = configuration
+        self._entity_cache = entity_cache or get_entity_cache()
         self.logger = logging.getLogger(__name__)
         purviewhelper = ClientHelper(account_name=configuration.purview_account_name)
         self._catalog_client = purviewhelper.get_catalog_client()
@@ -33,7 +152,23 @@ class ManagedAttributesHelper:
 
     def _get_token(self) -> str:
         """
-        Get token to enable API calls
+        Get token to enable API calls, cached for the process until it expires
+        """
+        key = (self._configuration.azure_tenant_id, self._configuration.azure_client_id)
+        with _tokens_lock:
+            token, expiry = _tokens.get(key, (None, 0.0))
+            if token and time.time() < expiry:
+                return token
+            token, lifetime = self._request_token()
+            _tokens[key] = (
+                token,
+                time.time() + lifetime - _TOKEN_EXPIRY_MARGIN_SECONDS,
+            )
+            return token
+
+    def _request_token(self) -> Tuple[str, int]:
+        """
+        Request a token and its lifetime in seconds
         """
         url = f"https://login.microsoftonline.com/{self._configuration.azure_tenant_id}/oauth2/token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
@@ -51,21 +186,24 @@ class ManagedAttributesHelper:
         )
 
         try:
-            access_token = response.json().get("access_token")
+            body = response.json()
+            access_token = body.get("access_token")
+            lifetime = int(body.get("expires_in", 0))
         except Exception as e:
             self.logger.error("Access token could not be retrieved correctly", e)
             raise Exception("Access token could not be retrieved correctly.", e)
 
-        return access_token
+        return access_token, lifetime
 
     def get_entity_by_guid(self, guid: str):
         """
-        Get an entity by guid
+        Get an entity by guid, from the entity cache if it was recently read
         """
-        try:
-            response = self._catalog_client.entity.get_by_guid(guid)  # type: ignore
-            return response
+        return self._entity_cache.get_or_fetch(guid, self._fetch_entity_by_guid)
 
+    def _fetch_entity_by_guid(self, guid: str):
+        try:
+            return self._catalog_client.entity.get_by_guid(guid)  # type: ignore
         except (ValueError, HttpResponseError) as ex:
             self.logger.error(ex)
 
@@ -119,9 +257,89 @@ class ManagedAttributesHelper:
         data = {m_attribute_name: m_attribute_value}
 
         response = requests.post(url=url, headers=headers, data=json.dumps(data))
+        self._entity_cache.invalidate(entity_id)
         self.logger.info(response.text)
         return response
 
+    def batch(self, max_workers: int = 8, catalog_mirror=None) -> ManagedAttributeBatch:
+        """
+        Collector of managed attribute updates, written by its flush method,
+        and recorded in the catalog mirror if given
+        """
+        return ManagedAttributeBatch(self, max_workers, catalog_mirror)
+
+    def update_m_attributes(
+        self, updates: Iterable[ManagedAttributeUpdate], max_workers: int = 8
+    ) -> ManagedAttributeUpdateResult:
+        """
+        Updates the managed attributes of many entities. The updates of an
+        entity are merged, the last value of an attribute winning, and written
+        in one request, for all its attribute groups. The entities are written
+        concurrently, with one access token.
+
+        Parameters
+        ----------
+        updates: Iterable[ManagedAttributeUpdate]
+            values of the managed attributes to write, in order
+
+        max_workers: int = 8
+            Optional.
+            number of requests sent at once
+        """
+        result = ManagedAttributeUpdateResult()
+        # attribute values by group, by entity
+        merged: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for update in updates:
+            result.updates += 1
+            merged.setdefault(update.entity_id, {}).setdefault(
+                update.m_attribute_group, {}
+            )[update.m_attribute_name] = update.m_attribute_value
+        if not merged:
+            return result
+
+        headers = {
+            "Authorization": f"Bearer {self._get_token()}",
+            "Content-Type": "application/json",
+        }
+        with requests.Session() as session:
+            session.mount(
+                "https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+            )
+
+            def write(entity_id: str) -> Union[str, None]:
+                """Error of the update of an entity, or None"""
+                url = (
+                    f"{self._endpoint}/catalog/api/atlas/v2/entity/guid/{entity_id}"
+                    "/businessmetadata"
+                )
+                try:
+                    response = session.post(
+                        url=url,
+                        headers=headers,
+                        params={"isOverwrite": "false"},
+                        data=json.dumps(merged[entity_id]),
+                    )
+                except requests.RequestException as ex:
+                    return str(ex)
+                finally:
+                    self._entity_cache.invalidate(entity_id)
+                if response.status_code >= 400:
+                    return f"{response.status_code} {response.text}"
+                return None
+
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(merged))) as pool:
+                for entity_id, error in zip(merged, pool.map(write, merged)):
+                    if error is None:
+                        result.updated.append(entity_id)
+                    else:
+                        result.failed[entity_id] = error
+                        self.logger.error(
+                            f"Managed attributes of {entity_id} could not be "
+                            f"updated: {error}"
+                        )
+        self.logger.info(result)
+        return result
+
     def get_all_m_attribute_groups(self) -> list:
         """
         Get a list of all managed attribute groups
@@ -1,13 +1,15 @@
+import json
 import logging
+import os
 import struct
 from itertools import chain, repeat
-from typing import List, Tuple
+from typing import Collection, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 import pyodbc
 from azure.identity import AzureCliCredential
 
 from .config import Configuration
-from .metadata import Metadata
+from .metadata import Metadata, Table
 
 
 class SqlHelper:
@@ -24,6 +26,7 @@ class SqlHelper:
         self._configuration = configuration
         self._cli_credentials = use_cli_credentials
         self._cursor = None
+        self._cli_cursor = None
         if database != "":
             self._database = database
         else:
@@ -36,6 +39,8 @@ class SqlHelper:
         """
         Connects to SYNAPSE_DATABASE provided in the configuration using AZ CLI cred
         """
+        if self._cli_cursor is not None:
+            return self._cli_cursor
 
         driver = self._configuration.synapse_driver
         synapse_workspace = self._configuration.synapse_workspace_name
@@ -67,8 +72,8 @@ class SqlHelper:
                 connectionstring, attrs_before={1256: tokenstruct}
             )
             connection.autocommit = True
-            self._cursor = connection.cursor()
-            return self._cursor
+            self._cli_cursor = connection.cursor()
+            return self._cli_cursor
 
         except Exception as e:
             self.logger.error(e)
@@ -113,7 +118,9 @@ class SqlHelper:
             self.logger.error(e)
             raise e
 
-    def execute_sql_result(self, sql: str) -> list:
+    def execute_sql_result(
+        self, sql: str, use_cli_cred: bool = False, params: Sequence = ()
+    ) -> list:
         """
         Executes a sql command on the database provided in the configuraiton
         and returns a list of results.
@@ -122,11 +129,23 @@ class SqlHelper:
         ----------
         sql: str
             the SQL statement to run
+
+        use_cli_cred : bool = False
+            Optional.
+            Set as True if the method should use Azure CLI credentials
+            instead of service principal's.
+
+        params : Sequence = ()
+            Optional.
+            Values bound to the `?` placeholders of the statement.
         """
         self.logger.info(f"Execute SQL-Command on {self._database}: {sql}")
-        cursor = self.get_connection_cursor()
+        if use_cli_cred:
+            cursor = self.get_connection_cursor_az_cli_token()
+        else:
+            cursor = self.get_connection_cursor()
         if cursor is not None:
-            cursor.execute(sql)
+            cursor.execute(sql, *params)
             result = []
             row = cursor.fetchone()
             while row:
@@ -159,6 +178,42 @@ class SqlHelper:
 
         return cursor
 
+    def execute_sql_batch(
+        self, statements: List[str], batch_size: int = 100, use_cli_cred: bool = False
+    ) -> int:
+        """
+        Executes a list of sql statements, sending up to `batch_size` statements
+        to the database in a single round trip.
+
+        Parameters:
+        ----------
+        statements : List[str]
+            the SQL statements to run, in order
+
+        batch_size : int = 100
+            Optional.
+            Maximum number of statements sent in a single batch.
+
+        use_cli_cred : bool = False
+            Optional.
+            Set as True if the method should use Azure CLI credentials
+            instead of service principal's.
+
+        Returns
+        -------
+        int
+            Number of batches sent to the database.
+        """
+        batches = 0
+        for start in range(0, len(statements), batch_size):
+            end = start + batch_size
+            batch = ";\n".join(statements[start:end]) + ";"
+            self.execute_sql(batch, use_cli_cred)
+            batches += 1
+
+        self.logger.info(f"Executed {len(statements)} statements in {batches} batches")
+        return batches
+
     def create_external_data_source(
         self, container_name: str, path: str, schema: str
     ) -> str:
@@ -256,7 +311,9 @@ class SqlHelper:
         )
         self.execute_sql(sql)
 
-    def create_views_from_metadata(self, metadata_as_json: str, schema: str):
+    def create_views_from_metadata(
+        self, metadata_as_json: str, schema: str, tables: Collection[str] = None
+    ):
         """
         Create views for each table listed in the metadata file in input
         The views will be created on the database provided as configuration.
@@ -268,8 +325,13 @@ class SqlHelper:
 
         schema: str
             schema name to be used for the Views.
+
+        tables: Collection[str] = None
+            Optional.
+            Names of the tables whose views are created, e.g. the `view_tables`
+            of a MetadataDiff. By default all the tables of the metadata file.
         """
-        metadata = Metadata.from_json(metadata_as_json)  # type: ignore
+        metadata = Metadata.from_json(metadata_as_json)
 
         # Create External Data Source
         external_datasource_name = self.create_external_data_source(
@@ -280,6 +342,8 @@ class SqlHelper:
 
         # Create Views (and schema) based on the metadata file
         for table in metadata.tables:
+            if tables is not None and table.name not in tables:
+                continue
             self.logger.info(
                 f"Creating view {table.name} on data source {external_datasource_name}"
             )
@@ -293,6 +357,108 @@ class SqlHelper:
                 schema=schema,
             )
 
+    def iter_view(
+        self,
+        schema: str,
+        table: Table,
+        page_size: int = 10000,
+        checkpoint_file: str = None,
+    ) -> Iterator[pyodbc.Row]:
+        """
+        Iterate over all the rows of a view, one page at a time.
+        Pages are read in the order of the key columns declared in the metadata
+        and each page starts after the last key of the previous one (keyset
+        pagination), so earlier pages are never scanned again.
+
+        Parameters
+        ----------
+        schema: str
+            Schema of the view. E.g. v1_SalesLT
+
+        table: Table
+            Metadata of the table exposed by the view. At least one column must be
+            flagged as key.
+
+        page_size: int = 10000
+            Optional.
+            Number of rows read with each query.
+
+        checkpoint_file: str = None
+            Optional.
+            File storing the last key read. If the file exists, the iteration
+            resumes after that key. The checkpoint is updated after each page has
+            been consumed and removed once the whole view has been read.
+        """
+        key_columns = table.key_columns
+        if not key_columns:
+            raise ValueError(f"No key column declared for {table.name} in metadata")
+
+        view = f"[{schema}].[{table.name}]"
+        last_key = None
+        rows_read = 0
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as file:
+                checkpoint = json.load(file)
+            if checkpoint["view"] != view or checkpoint["key_columns"] != key_columns:
+                raise ValueError(
+                    f"Checkpoint {checkpoint_file} does not match {view} "
+                    f"ordered by {key_columns}"
+                )
+            last_key = checkpoint["last_key"]
+            rows_read = checkpoint["rows"]
+            self.logger.info(f"Resuming {view} after {rows_read} rows: {last_key}")
+
+        order_by = ", ".join(f"[{column}]" for column in key_columns)
+        while True:
+            sql = f"SELECT TOP ({int(page_size)}) * FROM {view}"
+            params: List = []
+            if last_key is not None:
+                # (k1, k2) > (v1, v2) <=> k1 > v1 OR (k1 = v1 AND k2 > v2)
+                predicates = []
+                for index, column in enumerate(key_columns):
+                    equals = [f"[{key}] = ?" for key in key_columns[:index]]
+                    predicates.append(" AND ".join(equals + [f"[{column}] > ?"]))
+                    params.extend(last_key[: index + 1])
+                sql += " WHERE (" + ") OR (".join(predicates) + ")"
+            sql += f" ORDER BY {order_by}"
+
+            rows = self.execute_sql_result(sql, params=params)
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+
+            rows_read += len(rows)
+            last_key = [getattr(rows[-1], column) for column in key_columns]
+            if checkpoint_file:
+                self._save_checkpoint(
+                    checkpoint_file,
+                    {
+                        "view": view,
+                        "key_columns": key_columns,
+                        "last_key": last_key,
+                        "rows": rows_read,
+                    },
+                )
+            if len(rows) < page_size:
+                break
+
+        self.logger.info(f"Read {rows_read} rows from {view}")
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    def _save_checkpoint(self, checkpoint_file: str, checkpoint: dict):
+        """
+        Atomically write a checkpoint.
+        Key values without a json type (dates, decimals, uuids) are stored as
+        strings, which SQL converts back when comparing them with the key columns.
+        """
+        temp_file = f"{checkpoint_file}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump(checkpoint, file, default=str)
+        os.replace(temp_file, checkpoint_file)
+
     def create_schema(self, schema_name: str):
         """
         Create a schema on the default database provided as env variable
@@ -455,3 +621,85 @@ class SqlHelper:
         self.logger.info(
             f"Created User for {user_name} in {db_name}," f"assigned role {role}"
         )
+
+    def provision_principals(
+        self,
+        principals: Dict[str, Optional[str]],
+        create_logins: bool = True,
+        database: str = None,
+    ) -> Dict[str, List[str]]:
+        """
+        Create all the missing logins, db users and role memberships at once.
+        Existing principals are read with one query on sys.server_principals and
+        one on sys.database_principals, then the missing ones are created in a
+        single batch.
+
+        Parameters
+        ----------
+        principals : Dict[str, Optional[str]]
+            Name of the AD User/Group mapped to the role to be assigned to its db
+            user. If the role is None, no role will be assigned.
+
+        create_logins : bool = True
+            Optional.
+            Set as False to only create db users, e.g. when running as the
+            service principal, which does not have permissions to create logins.
+
+        database : str = None
+            Optional.
+            Name of the database to create the db users
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            The logins, users and role memberships that have been created.
+        """
+        db_name = database if database is not None else self._database
+        use_cli_cred = self._cli_credentials
+        created: Dict[str, List[str]] = {"logins": [], "users": [], "roles": []}
+        statements = []
+
+        if create_logins:
+            existing_logins = {
+                row[0]
+                for row in self.execute_sql_result(
+                    "SELECT name FROM sys.server_principals", use_cli_cred
+                )
+            }
+            for name in principals:
+                if name not in existing_logins:
+                    statements.append(f"CREATE LOGIN [{name}] FROM EXTERNAL PROVIDER")
+                    created["logins"].append(name)
+
+        self.execute_sql(f"USE [{db_name}]", use_cli_cred)
+        sql = (
+            "SELECT p.name, r.name "
+            "FROM sys.database_principals p "
+            "LEFT JOIN sys.database_role_members m "
+            "ON m.member_principal_id = p.principal_id "
+            "LEFT JOIN sys.database_principals r "
+            "ON r.principal_id = m.role_principal_id"
+        )
+        existing_users: Dict[str, Set[str]] = {}
+        for user_name, role_name in self.execute_sql_result(sql, use_cli_cred):
+            existing_users.setdefault(user_name, set())
+            if role_name is not None:
+                existing_users[user_name].add(role_name)
+
+        statements.append(f"USE [{db_name}]")
+        for name, role in principals.items():
+            if name not in existing_users:
+                statements.append(f"CREATE USER [{name}] FOR LOGIN [{name}]")
+                created["users"].append(name)
+            if role is not None and role not in existing_users.get(name, set()):
+                statements.append(f"ALTER ROLE {role} ADD MEMBER [{name}]")
+                created["roles"].append(f"{name}:{role}")
+
+        if any(created.values()):
+            self.execute_sql_batch(
+                statements, batch_size=len(statements), use_cli_cred=use_cli_cred
+            )
+        self.logger.info(
+            f"Provisioned {len(principals)} principals in {db_name}: {created}"
+        )
+        return created
@@ -0,0 +1,333 @@
+"""
+SQL Gateway helper module
+-------------------------
+Multiplexes the queries of many clients over a small pool of Synapse serverless
+connections, with priority based admission control, so that heavy extracts
+cannot starve interactive queries.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Tuple
+
+import pyodbc
+
+from .config import Configuration
+from .sql import SqlHelper
+
+
+class QueryPriority(IntEnum):
+    """Priority classes, lower values are served first"""
+
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class AdmissionError(Exception):
+    """Raised when a query is rejected: the gateway is stopped or its queue is full"""
+
+
+class _PriorityMetrics:
+    """Counters and latency samples for one priority class"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_times: Deque[float] = deque(maxlen=max_samples)
+        self.run_times: Deque[float] = deque(maxlen=max_samples)
+
+    @staticmethod
+    def _percentile(samples: Deque[float], percentile: float) -> float:
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile))
+        return round(ordered[index], 4)
+
+    def as_dict(self, queue_depth: int, running: int) -> dict:
+        return {
+            "queue_depth": queue_depth,
+            "running": running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_p50_s": self._percentile(self.wait_times, 0.5),
+            "wait_p95_s": self._percentile(self.wait_times, 0.95),
+            "run_p50_s": self._percentile(self.run_times, 0.5),
+            "run_p95_s": self._percentile(self.run_times, 0.95),
+        }
+
+
+class SqlGateway:
+    """
+    Runs queries submitted by many clients on a shared pool of connections.
+
+    Each worker of the pool owns a SqlHelper (and therefore a connection).
+    Interactive queries are always served first, and at most
+    `max_batch_concurrency` workers run batch queries at the same time, so the
+    remaining workers are always available to interactive queries.
+    Queries are rejected with AdmissionError when their queue is full.
+    """
+
+    def __init__(
+        self,
+        configuration: Configuration,
+        pool_size: int = 4,
+        max_batch_concurrency: int = 1,
+        max_queue_depth: Dict[QueryPriority, int] = None,
+        helper_factory: Callable[[], SqlHelper] = None,
+    ):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+            Configuration used to create the SqlHelper of each worker
+
+        pool_size: int = 4
+            Number of connections to Synapse
+
+        max_batch_concurrency: int = 1
+            Maximum number of workers running batch queries at the same time.
+            Must be at least 1 and lower than pool_size.
+
+        max_queue_depth: Dict[QueryPriority, int] = None
+            Maximum number of queued queries per priority class
+
+        helper_factory: Callable[[], SqlHelper] = None
+            Optional.
+            Creates the SqlHelper of a worker. Defaults to SqlHelper(configuration)
+        """
+        if max_batch_concurrency < 1:
+            raise ValueError("max_batch_concurrency must be at least 1")
+        if max_batch_concurrency >= pool_size:
+            raise ValueError("max_batch_concurrency must be lower than pool_size")
+
+        self.logger = logging.getLogger(__name__)
+        self._pool_size = pool_size
+        self._max_batch_concurrency = max_batch_concurrency
+        self._max_queue_depth = max_queue_depth or {
+            QueryPriority.INTERACTIVE: 200,
+            QueryPriority.BATCH: 20,
+        }
+        self._helper_factory = helper_factory or (lambda: SqlHelper(configuration))
+
+        self._condition = threading.Condition()
+        self._queues: Dict[QueryPriority, Deque[Tuple[str, Future, float]]] = {
+            priority: deque() for priority in QueryPriority
+        }
+        self._running = {priority: 0 for priority in QueryPriority}
+        self._metrics = {priority: _PriorityMetrics() for priority in QueryPriority}
+        self._workers: List[threading.Thread] = []
+        self._stopped = False
+        self.logger.info(
+            f"SqlGateway initialized with {pool_size} connections, "
+            f"{max_batch_concurrency} for batch queries"
+        )
+
+    def start(self):
+        """
+        Start the workers of the pool
+        """
+        for index in range(self._pool_size):
+            worker = threading.Thread(
+                target=self._work, name=f"sql-gateway-{index}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """
+        Stop the workers once the queued queries have been served
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def submit(
+        self, sql: str, priority: QueryPriority = QueryPriority.INTERACTIVE
+    ) -> Future:
+        """
+        Queue a query and return a Future with its rows
+
+        Raises
+        ------
+        AdmissionError
+            if the gateway is stopped or the queue of the priority class is full
+        """
+        future: Future = Future()
+        with self._condition:
+            metrics = self._metrics[priority]
+            metrics.submitted += 1
+            if self._stopped:
+                metrics.rejected += 1
+                raise AdmissionError("SqlGateway is stopped")
+            if len(self._queues[priority]) >= self._max_queue_depth[priority]:
+                metrics.rejected += 1
+                raise AdmissionError(
+                    f"Queue for {priority.name} queries is full "
+                    f"({self._max_queue_depth[priority]})"
+                )
+            self._queues[priority].append((sql, future, time.perf_counter()))
+            self._condition.notify()
+        return future
+
+    def execute(
+        self,
+        sql: str,
+        priority: QueryPriority = QueryPriority.INTERACTIVE,
+        timeout: float = None,
+    ) -> list:
+        """
+        Run a query through the gateway and wait for its rows
+        """
+        return self.submit(sql, priority).result(timeout=timeout)
+
+    def metrics(self) -> dict:
+        """
+        Queue depth, counters and latencies for each priority class
+        """
+        with self._condition:
+            return {
+                priority.name.lower(): self._metrics[priority].as_dict(
+                    queue_depth=len(self._queues[priority]),
+                    running=self._running[priority],
+                )
+                for priority in QueryPriority
+            }
+
+    def _next_query(self):
+        """
+        Pick the next query to run, must be called holding the condition lock
+        """
+        if self._queues[QueryPriority.INTERACTIVE]:
+            return QueryPriority.INTERACTIVE
+        if (
+            self._queues[QueryPriority.BATCH]
+            and self._running[QueryPriority.BATCH] < self._max_batch_concurrency
+        ):
+            return QueryPriority.BATCH
+        return None
+
+    def _work(self):
+        sql_helper = self._helper_factory()
+        while True:
+            with self._condition:
+                priority = self._next_query()
+                while priority is None:
+                    if self._stopped and not any(self._queues.values()):
+                        return
+                    self._condition.wait()
+                    priority = self._next_query()
+                sql, future, queued_at = self._queues[priority].popleft()
+                self._running[priority] += 1
+                started_at = time.perf_counter()
+                self._metrics[priority].wait_times.append(started_at - queued_at)
+
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(sql_helper.execute_sql_result(sql))
+                except Exception as ex:
+                    self.logger.error(f"Query failed: {ex}")
+                    failed = True
+                    future.set_exception(ex)
+                    if _is_connection_error(ex):
+                        # the helper keeps its cursor, reconnect on the next query
+                        self.logger.warning("Connection lost, recreating SqlHelper")
+                        sql_helper = self._helper_factory()
+
+            with self._condition:
+                metrics = self._metrics[priority]
+                metrics.run_times.append(time.perf_counter() - started_at)
+                if failed:
+                    metrics.failed += 1
+                else:
+                    metrics.completed += 1
+                self._running[priority] -= 1
+                # a batch slot may have been released
+                self._condition.notify_all()
+
+
+def _is_connection_error(ex: Exception) -> bool:
+    """
+    True if the query failed because the connection to Synapse was lost.
+    pyodbc raises OperationalError for the SQLSTATE class 08 (connection
+    exception), e.g. 08S01 communication link failure.
+    """
+    if isinstance(ex, pyodbc.OperationalError):
+        return True
+    return (
+        isinstance(ex, pyodbc.Error)
+        and len(ex.args) > 0
+        and str(ex.args[0]).startswith("08")
+    )
+
+
+def serve(gateway: SqlGateway, host: str = "127.0.0.1", port: int = 8765):
+    """
+    Expose the gateway to local clients over HTTP.
+
+    POST /query  {"sql": "...", "priority": "interactive" | "batch"}
+    GET  /metrics
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            payload = json.dumps(body, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(200, gateway.metrics())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/query":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise ValueError("the body must be a json object")
+                sql = request["sql"]
+                priority = request.get("priority", "interactive")
+                if not isinstance(sql, str) or not isinstance(priority, str):
+                    raise ValueError("sql and priority must be strings")
+                priority = QueryPriority[priority.upper()]
+            except (KeyError, ValueError) as ex:
+                self._reply(400, {"error": f"Invalid request: {ex}"})
+                return
+            try:
+                rows = gateway.execute(sql, priority)
+                self._reply(200, {"rows": [list(row) for row in rows]})
+            except AdmissionError as ex:
+                self._reply(429, {"error": str(ex)})
+            except Exception as ex:
+                self._reply(500, {"error": str(ex)})
+
+        def log_message(self, format, *args):
+            gateway.logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    gateway.logger.info(f"SqlGateway listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,176 @@
+"""
+Local SQL helper module
+-----------------------
+Runs the statements generated by SqlHelper against an embedded DuckDB database
+reading the delta tables from a local folder (e.g. sample_data), so that view
+creation and query workloads can be validated and timed without Synapse.
+"""
+import os
+import re
+from collections import namedtuple
+from typing import Dict, List, Sequence
+from urllib.parse import unquote
+
+from .config import Configuration
+from .delta import DeltaLogReader
+from .sql import SqlHelper
+
+try:
+    import duckdb
+except ImportError:  # pragma: no cover - optional dependency
+    duckdb = None
+
+
+class LocalSqlHelper(SqlHelper):
+    """SqlHelper backed by an embedded DuckDB database"""
+
+    _SCHEMA_PATTERN = re.compile(
+        r"IF NOT EXISTS\s*\(SELECT \* FROM sys\.schemas WHERE name='(?P<name>\w+)'\)"
+        r"\s*EXEC\('CREATE SCHEMA \w+'\);?",
+        re.IGNORECASE,
+    )
+    _VIEW_PATTERN = re.compile(
+        r"CREATE OR ALTER VIEW (?P<view>[\w.]+) AS SELECT \* FROM\s+OPENROWSET\(\s*"
+        r"BULK '(?P<folder>[^']+)',\s*DATA_SOURCE = '(?P<data_source>[^']+)',\s*"
+        r"FORMAT = 'DELTA'\s*\)\s*(?P<alias>\w+)",
+        re.IGNORECASE,
+    )
+    _TOP_PATTERN = re.compile(r"SELECT TOP \((?P<rows>\d+)\)", re.IGNORECASE)
+
+    def __init__(
+        self,
+        configuration: Configuration,
+        data_root: str,
+        database: str = ":memory:",
+    ):
+        """
+        Parameters
+        ----------
+        configuration: Configuration
+            the configuration, only used for names (e.g. the schema)
+
+        data_root: str
+            local folder with the same layout as the container, e.g. sample_data
+
+        database: str = ":memory:"
+            Optional.
+            DuckDB database file. By default the database is kept in memory.
+        """
+        if duckdb is None:
+            raise ImportError("duckdb is required to use LocalSqlHelper")
+        super().__init__(configuration, database=database)
+        self._data_root = os.path.abspath(data_root)
+        self._data_sources: Dict[str, str] = {}
+        self._delta_scan = None
+
+    def get_connection_cursor(self):
+        """
+        Connects to the DuckDB database
+        """
+        if self._cursor is None:
+            self._cursor = duckdb.connect(self._database)
+        return self._cursor
+
+    def get_connection_cursor_az_cli_token(self):
+        return self.get_connection_cursor()
+
+    def execute_sql_result(
+        self, sql: str, use_cli_cred: bool = False, params: Sequence = ()
+    ) -> list:
+        sql = self.translate(sql)
+        self.logger.info(f"Execute SQL-Command on {self._database}: {sql}")
+        cursor = self.get_connection_cursor()
+        cursor.execute(sql, list(params))
+        if cursor.description is None:
+            return []
+        # rows expose columns as attributes, like pyodbc.Row
+        row_type = namedtuple(
+            "Row", [column[0] for column in cursor.description], rename=True
+        )
+        return [row_type(*row) for row in cursor.fetchall()]
+
+    def execute_sql(self, sql: str, use_cli_cred: bool = False):
+        sql = self.translate(sql)
+        self.logger.info(f"Execute SQL-Command on {self._database}: {sql}")
+        cursor = self.get_connection_cursor()
+        cursor.execute(sql)
+        return cursor
+
+    def list_views(self) -> List[str]:
+        """
+        Views created in the database, without the DuckDB system views
+        (information_schema, pg_catalog)
+        """
+        self.logger.info(f"Getting views for database {self._database}")
+        rows = self.get_connection_cursor().execute(
+            "SELECT schema_name, view_name FROM duckdb_views() "
+            "WHERE NOT internal ORDER BY schema_name, view_name"
+        ).fetchall()
+        return [f"{schema}.{view}" for schema, view in rows]
+
+    def create_external_data_source(
+        self, container_name: str, path: str, schema: str
+    ) -> str:
+        """
+        Register the local folder of the delta tables as a data source.
+        The container is the data root folder itself.
+        """
+        external_data_source = f"{path}_{schema}"
+        location = os.path.join(self._data_root, path)
+        if not os.path.isdir(location):
+            raise FileNotFoundError(f"Delta tables folder not found: {location}")
+        self._data_sources[external_data_source] = location
+        self.logger.info(f"External Data Source created: {external_data_source}")
+        return external_data_source
+
+    def translate(self, sql: str) -> str:
+        """
+        Translate the T-SQL generated by SqlHelper to DuckDB SQL
+        """
+        sql = self._SCHEMA_PATTERN.sub(r"CREATE SCHEMA IF NOT EXISTS \g<name>", sql)
+        # [quoted] identifiers, before the views introduce DuckDB [lists]
+        sql = re.sub(r"\[([^\]]+)\]", r'"\1"', sql)
+        sql = self._VIEW_PATTERN.sub(self._translate_view, sql)
+        match = self._TOP_PATTERN.search(sql)
+        if match:
+            sql = self._TOP_PATTERN.sub("SELECT", sql) + f" LIMIT {match['rows']}"
+        return sql
+
+    def _translate_view(self, match: re.Match) -> str:
+        location = os.path.join(
+            self._data_sources[match["data_source"]], match["folder"]
+        )
+        return (
+            f"CREATE OR REPLACE VIEW {match['view']} AS SELECT * "
+            f"FROM {self._scan(location)} {match['alias']}"
+        )
+
+    def _scan(self, location: str) -> str:
+        """
+        Table function reading a delta table. delta_scan needs the DuckDB delta
+        extension; without it, the live files listed by the delta log are read
+        with read_parquet (or all the parquet files of the folder, if the log
+        cannot be read).
+        """
+        if self._delta_scan is None:
+            try:
+                self.get_connection_cursor().execute("INSTALL delta; LOAD delta;")
+                self._delta_scan = True
+            except Exception as ex:
+                self.logger.warning(
+                    f"DuckDB delta extension not available, reading parquet files: {ex}"
+                )
+                self._delta_scan = False
+        if self._delta_scan:
+            return f"delta_scan('{location}')"
+        try:
+            snapshot = DeltaLogReader.local(location).snapshot("")
+            files = [
+                f"'{os.path.join(location, unquote(path))}'"
+                for path in snapshot.files["path"].to_pylist()
+            ]
+            if files:
+                return f"read_parquet([{', '.join(files)}])"
+        except Exception as ex:
+            self.logger.warning(f"Unable to read the delta log of {location}: {ex}")
+        return f"read_parquet('{os.path.join(location, '*.parquet')}')"
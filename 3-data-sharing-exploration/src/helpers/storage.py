@@ -1,42 +1,249 @@
+import hashlib
+import json
 import logging
-from typing import List, Union
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Collection, Dict, Iterator, List, Tuple, Union
+from urllib.parse import quote
 
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+from .delta import DELTA_LOG
+from .metadata import Metadata, MetadataFile, MetadataStream
+from .metadata_diff import MetadataDiff, diff_metadata
+from .storage_backend import (
+    DEFAULT_CHUNK_SIZE,
+    AzureBlobBackend,
+    BlobInfo,
+    LocalBackend,
+    StorageBackend,
+)
 
-from .metadata import MetadataFile
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "eds", "blobs")
+DEFAULT_WATERMARK_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "eds", "watermarks"
+)
+
+
+@dataclass
+class MetadataChanges:
+    """Metadata files changed since a watermark"""
+
+    changed: List[MetadataFile]
+    deleted: List[str]
+    # last-modified time and ETag of all the metadata files currently in storage
+    blobs: Dict[str, Dict[str, str]] = field(default_factory=dict)
+
+
+@dataclass
+class UploadResult:
+    """Files of a directory uploaded by `StorageHelper.upload_directory`"""
+
+    uploaded: List[str] = field(default_factory=list)
+    # files with the same size and MD5 as the blob already in the container
+    skipped: List[str] = field(default_factory=list)
+    # files that failed, and delta logs not uploaded because of them
+    failed: Dict[str, str] = field(default_factory=dict)
+    bytes_uploaded: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes uploaded per second"""
+        return self.bytes_uploaded / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.uploaded)} files uploaded, {len(self.skipped)} unchanged, "
+            f"{len(self.failed)} failed: {self.bytes_uploaded / 1024 / 1024:.1f} MB "
+            f"in {self.seconds:.1f} s ({self.throughput / 1024 / 1024:.1f} MB/s)"
+        )
+
+
+class MetadataWatermark:
+    """
+    Last-modified time and ETag of each metadata file processed by a stage,
+    persisted as a json file. The content of the files processed is kept next
+    to it, to compute what changed in the following revisions.
+    """
+
+    def __init__(self, path: str):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self._snapshot_dir = f"{os.path.splitext(path)[0]}_metadata"
+        self.blobs: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.blobs = json.load(file)
+
+    @classmethod
+    def for_stage(
+        cls, account_name: str, container_name: str, stage: str
+    ) -> "MetadataWatermark":
+        """
+        Watermark of a stage (e.g. data_ingest) in the default location.
+        Each stage keeps its own watermark, so it processes all the changes
+        made since its own last run.
+        """
+        return cls(
+            os.path.join(
+                DEFAULT_WATERMARK_DIR, account_name, container_name, f"{stage}.json"
+            )
+        )
+
+    def get(self, blob_name: str) -> Union[Dict[str, str], None]:
+        return self.blobs.get(blob_name)
+
+    def previous_metadata(self, blob_name: str) -> Union[Metadata, None]:
+        """
+        The metadata file as it was when last processed, if known
+        """
+        try:
+            with open(self._get_snapshot_path(blob_name), "rb") as file:
+                return Metadata.from_json(file.read())
+        except OSError:
+            return None
+
+    def diff(self, metadata_file: MetadataFile) -> MetadataDiff:
+        """
+        Changes of a metadata file since it was last processed. Everything is
+        reported as added for files processed for the first time.
+        """
+        return diff_metadata(
+            self.previous_metadata(metadata_file.name), metadata_file.metadata
+        )
+
+    def commit(self, changes: MetadataChanges, exclude: Collection[str] = ()):
+        """
+        Moves the watermark to the state of the storage when the changes were read
+
+        Parameters
+        ----------
+        changes: MetadataChanges
+            changes read with `StorageHelper.get_metadata_changes`
+
+        exclude: Collection[str] = ()
+            Optional.
+            changed metadata files that were not fully processed: they keep
+            their previous watermark, so the next run processes them again
+        """
+        blobs = dict(changes.blobs)
+        for blob_name in exclude:
+            previous = self.blobs.get(blob_name)
+            if previous is None:
+                blobs.pop(blob_name, None)
+            else:
+                blobs[blob_name] = previous
+        self.blobs = blobs
+        os.makedirs(self._snapshot_dir, exist_ok=True)
+        for metadata_file in changes.changed:
+            if metadata_file.name in exclude:
+                continue
+            snapshot_path = self._get_snapshot_path(metadata_file.name)
+            with open(f"{snapshot_path}.tmp", "w", encoding="utf-8") as file:
+                file.write(metadata_file.metadata_json)
+            os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        for blob_name in changes.deleted:
+            if os.path.exists(self._get_snapshot_path(blob_name)):
+                os.remove(self._get_snapshot_path(blob_name))
+
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.blobs, file, indent=2)
+        os.replace(temp_path, self._path)
+        self._logger.info(f"Watermark saved to {self._path}")
+
+    def _get_snapshot_path(self, blob_name: str) -> str:
+        return os.path.join(self._snapshot_dir, quote(blob_name, safe=""))
 
 
 class StorageHelper:
     """Contains methods for interacting with Azure Blob Storage"""
 
-    def __init__(self, account_name: str):
+    def __init__(
+        self,
+        account_name: str,
+        cache_dir: Union[str, None] = DEFAULT_CACHE_DIR,
+        max_workers: int = 8,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        backend: StorageBackend = None,
+    ):
         """
         Initialize the StorageHelper instance for a specific Azure Blob Storage account.
 
         Parameters:
             account_name (str): name of the Azure Blob Storage account.
+            cache_dir (str): local folder caching the downloaded blobs by ETag,
+                shared by all the scripts. None disables the cache.
+            max_workers (int): number of concurrent downloads and uploads.
+            chunk_size (int): size of the ranges requested when downloading,
+                which bounds the memory used by `stream_metadata_tables`, and
+                of the blocks staged when uploading.
+            backend (StorageBackend): backend serving the blobs. Default the
+                Azure Blob Storage account.
 
         Raises:
             ValueError: if account_name is empty.
         """
         self._logger = logging.getLogger(__name__)
 
-        credential = DefaultAzureCredential()
-        self._client = BlobServiceClient(
-            f"https://{account_name}.blob.core.windows.net", credential
-        )
+        self._backend = backend or AzureBlobBackend(account_name, chunk_size)
+        self._account_name = account_name
+        self._cache_dir = cache_dir
+        self._max_workers = max_workers
         self._logger.info(
-            f"StorageHelper initialized for Azure Blob Storage account '{account_name}'"
+            f"StorageHelper initialized for storage account '{account_name}' "
+            f"({type(self._backend).__name__})"
+        )
+
+    @classmethod
+    def local(
+        cls, root: str, max_workers: int = 8, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> "StorageHelper":
+        """
+        StorageHelper serving a local folder with the layout of the container,
+        e.g. sample_data, to run and time the stages offline. The blob cache is
+        disabled, as reading the files is as fast as reading the cache.
+        """
+        backend = LocalBackend(root, chunk_size)
+        return cls(
+            backend.account_name,
+            cache_dir=None,
+            max_workers=max_workers,
+            chunk_size=chunk_size,
+            backend=backend,
         )
 
-    def get_metadata_files(self, container_name) -> List[MetadataFile]:
+    @classmethod
+    def from_configuration(cls, config) -> "StorageHelper":
+        """
+        StorageHelper of the storage account of the configuration, or of the
+        local folder set in LOCAL_DATA_ROOT
+        """
+        if config.local_data_root:
+            return cls.local(config.local_data_root)
+        return cls(config.storage_account_name)
+
+    @property
+    def account_name(self) -> str:
+        """Name of the storage account, "local" for a local folder"""
+        return self._account_name
+
+    def get_metadata_files(
+        self, container_name, max_workers: int = None
+    ) -> List[MetadataFile]:
         """
         Gets the metadata files from the storage account.
+        Files are downloaded concurrently, and only if their ETag differs from
+        the one in the local cache.
 
         Parameters
         ----------
         container_name (str): name of the container.
+        max_workers (int): number of concurrent downloads. Default from constructor.
 
         Returns
         -------
@@ -44,48 +251,396 @@ class StorageHelper:
             List of metadata files.
         """
         try:
-            self._logger.info("Retrieving metadata files from storage account...")
-            self._logger.info(
-                f"Searching container {container_name} for metadata files"
+            blobs = self._list_metadata_blobs(container_name)
+            metadata_files = self._download_metadata_files(
+                container_name, blobs, max_workers
             )
-            container_client = self._client.get_container_client(container_name)
-            prefix = "_meta/"
-            blobs = container_client.list_blobs(prefix)
-            metadata_files = []
-            for blob in blobs:
-                if str(blob["name"]).endswith(".json"):
-                    self._logger.info(f"Found metadata file: {blob['name']}")
-                    metadata_json = self._download_blob(container_name, blob["name"])
-                    metadata = MetadataFile(
-                        container=container_name, metadata_json=metadata_json
-                    )
-                    metadata_files.append(metadata)
             self._logger.info(f"Found {len(metadata_files)} metadata files.")
             return metadata_files
         except Exception as e:
             self._logger.error(f"Error: {e}")
             return []
 
-    def _download_blob(self, container_name: str, blob_name: str) -> Union[str, None]:
+    def get_metadata_changes(
+        self,
+        container_name: str,
+        watermark: "MetadataWatermark",
+        max_workers: int = None,
+    ) -> "MetadataChanges":
+        """
+        Gets only the metadata files that are new or changed since the watermark,
+        and the names of the ones that have been deleted.
+        The watermark is not updated: call `watermark.commit(changes)` once the
+        changes have been processed.
+
+        Parameters
+        ----------
+        container_name (str): name of the container.
+        watermark (MetadataWatermark): last-modified time and ETag of each
+            metadata file already processed.
+        max_workers (int): number of concurrent downloads. Default from constructor.
+
+        Returns
+        -------
+        MetadataChanges
+            New or changed metadata files, deleted ones and the new watermark.
+        """
+        blobs = self._list_metadata_blobs(container_name)
+        current = {
+            blob.name: {
+                "last_modified": blob.last_modified.isoformat(),
+                "etag": blob.etag,
+            }
+            for blob in blobs
+        }
+        changed_blobs = [
+            blob for blob in blobs if watermark.get(blob.name) != current[blob.name]
+        ]
+        deleted = sorted(set(watermark.blobs) - set(current))
+        changed = []
+        for metadata_file in self._download_metadata_files(
+            container_name, changed_blobs, max_workers
+        ):
+            if metadata_file.metadata_json is not None:
+                changed.append(metadata_file)
+            elif watermark.get(metadata_file.name) is not None:
+                # failed downloads keep their previous watermark, to be retried
+                current[metadata_file.name] = watermark.get(metadata_file.name)
+            else:
+                del current[metadata_file.name]
+        self._logger.info(
+            f"Metadata changes in {container_name}: {len(changed)} new or changed, "
+            f"{len(deleted)} deleted, {len(blobs) - len(changed)} unchanged"
+        )
+        return MetadataChanges(changed=changed, deleted=deleted, blobs=current)
+
+    def stream_metadata_tables(
+        self, container_name: str, blob_name: str
+    ) -> MetadataStream:
+        """
+        Streams the tables of a metadata file, downloading it in chunks, so that
+        files of hundreds of MB can be processed one table at a time.
+        The blob is neither read from nor written to the local cache.
+
+        Parameters
+        ----------
+        container_name (str): name of the container.
+        blob_name (str): name of the metadata blob, e.g. _meta/domain_1.0.0.json.
+
+        Returns
+        -------
+        MetadataStream
+            Iterable of the tables; `version` and `path` are set once read.
+            Download errors are raised while iterating.
+        """
+        return MetadataStream(self._iter_blob_chunks(container_name, blob_name))
+
+    def upload_directory(
+        self,
+        container_name: str,
+        local_path: str,
+        destination: str = "",
+        max_workers: int = None,
+        max_concurrency: int = 4,
+    ) -> UploadResult:
+        """
+        Uploads a directory tree, e.g. sample_data/v2, to a folder of the
+        container. Files with the same size and MD5 as the existing blob are
+        skipped, and large files are uploaded in blocks of `chunk_size`.
+        The `_delta_log` folders are uploaded after all the data files, in
+        version order with `_last_checkpoint` last, so that readers never see
+        a version whose files are missing. The log of a table is not uploaded
+        if one of the data files of the directory failed.
+
+        Parameters
+        ----------
+        container_name (str): name of the container.
+        local_path (str): local directory to upload.
+        destination (str): folder of the container, e.g. v2. Default the root.
+        max_workers (int): number of files uploaded concurrently.
+            Default from constructor.
+        max_concurrency (int): number of blocks of a file uploaded concurrently.
+
+        Returns
+        -------
+        UploadResult
+            Files uploaded, skipped and failed, and the throughput.
+        """
+        start = time.perf_counter()
+        result = UploadResult()
+        prefix = f"{destination.strip('/')}/" if destination.strip("/") else ""
+        try:
+            existing = {
+                blob.name: blob
+                for blob in self._backend.list_blobs(container_name, prefix)
+            }
+        except Exception as e:
+            self._logger.error(f"Error listing container '{container_name}': {e}")
+            result.failed[prefix] = str(e)
+            return result
+
+        data_files: List[str] = []
+        delta_logs: Dict[str, List[str]] = {}
+        for folder, directories, files in os.walk(local_path):
+            directories.sort()
+            relative_folder = os.path.relpath(folder, local_path)
+            for name in sorted(files):
+                relative = os.path.normpath(os.path.join(relative_folder, name))
+                relative = relative.replace(os.sep, "/")
+                if os.path.basename(folder) == DELTA_LOG:
+                    delta_logs.setdefault(relative_folder, []).append(relative)
+                else:
+                    data_files.append(relative)
+
+        def upload(relative: str) -> Tuple[str, int, Union[str, None]]:
+            blob_name = f"{prefix}{relative}"
+            return self._upload_file(
+                container_name,
+                os.path.join(local_path, relative),
+                blob_name,
+                existing.get(blob_name),
+                max_concurrency,
+            )
+
+        def upload_log(log_files: List[str]) -> list:
+            # stops at the first failure, so that the log has no gap
+            outcomes = []
+            for relative in sorted(log_files, key=self._delta_log_order):
+                if outcomes and outcomes[-1][2] is not None:
+                    outcomes.append((f"{prefix}{relative}", 0, "log file failed"))
+                else:
+                    outcomes.append(upload(relative))
+            return outcomes
+
+        def record(outcomes):
+            for blob_name, size, error in outcomes:
+                if error is not None:
+                    result.failed[blob_name] = error
+                elif size < 0:
+                    result.skipped.append(blob_name)
+                else:
+                    result.uploaded.append(blob_name)
+                    result.bytes_uploaded += size
+
+        with ThreadPoolExecutor(max_workers or self._max_workers) as executor:
+            record(executor.map(upload, data_files))
+            logs = []
+            for log_folder, log_files in delta_logs.items():
+                table_folder = os.path.dirname(log_folder.replace(os.sep, "/"))
+                table_prefix = f"{prefix}{table_folder}/" if table_folder else prefix
+                failed = [
+                    name for name in result.failed if name.startswith(table_prefix)
+                ]
+                if failed:
+                    self._logger.error(
+                        f"Delta log of '{table_prefix}' not uploaded, "
+                        f"{len(failed)} data files failed"
+                    )
+                    for relative in log_files:
+                        result.failed[f"{prefix}{relative}"] = "data files failed"
+                    continue
+                logs.append(log_files)
+            # the logs of different tables are independent
+            for outcomes in executor.map(upload_log, logs):
+                record(outcomes)
+
+        result.seconds = time.perf_counter() - start
+        self._logger.info(f"Upload of '{local_path}' to '{container_name}': {result}")
+        return result
+
+    def _upload_file(
+        self,
+        container_name: str,
+        file_path: str,
+        blob_name: str,
+        blob: Union[BlobInfo, None],
+        max_concurrency: int,
+    ) -> Tuple[str, int, Union[str, None]]:
+        """
+        Uploads a file unless the blob has the same size and MD5. The MD5 is
+        stored in the Content-MD5 of the blob, which block uploads do not set.
+
+        Returns:
+            Tuple[str, int, Union[str, None]]: blob name, bytes uploaded (-1 if
+                skipped) and error message if the upload failed.
+        """
+        try:
+            size = os.path.getsize(file_path)
+            digest = self._file_md5(file_path)
+            if (
+                blob is not None
+                and blob.size == size
+                and blob.content_md5 is not None
+                and blob.content_md5 == digest
+            ):
+                return blob_name, -1, None
+            content_type = mimetypes.guess_type(file_path)[0]
+            with open(file_path, "rb") as file:
+                self._backend.upload(
+                    container_name,
+                    blob_name,
+                    file,
+                    size,
+                    content_type=content_type or "application/octet-stream",
+                    content_md5=digest,
+                    max_concurrency=max_concurrency,
+                )
+            self._logger.info(f"Uploaded {blob_name} ({size} bytes)")
+            return blob_name, size, None
+        except Exception as e:
+            self._logger.error(f"Error uploading '{file_path}' to '{blob_name}': {e}")
+            return blob_name, 0, str(e)
+
+    @staticmethod
+    def _file_md5(file_path: str, block_size: int = 4 * 1024 * 1024) -> bytes:
+        md5 = hashlib.md5(usedforsecurity=False)
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(block_size), b""):
+                md5.update(block)
+        return md5.digest()
+
+    @staticmethod
+    def _delta_log_order(relative: str) -> Tuple[bool, str, bool]:
+        """
+        Commits and checkpoints by version, each commit before its checkpoint,
+        and _last_checkpoint at the end
+        """
+        name = relative.rsplit("/", 1)[-1]
+        return (
+            name == "_last_checkpoint",
+            name.split(".", 1)[0],
+            not name.endswith(".json"),
+        )
+
+    def _iter_blob_chunks(self, container_name: str, blob_name: str) -> Iterator:
+        self._logger.info(f"Streaming blob: {blob_name}")
+        try:
+            yield from self._backend.iter_chunks(container_name, blob_name)
+        except Exception as e:
+            self._logger.error(
+                f"Error streaming blob '{blob_name}'"
+                f" from container '{container_name}': {e}"
+            )
+            raise
+
+    def _list_metadata_blobs(self, container_name: str) -> List[BlobInfo]:
+        """
+        Lists the json blobs in the _meta folder of the container
+        """
+        self._logger.info("Retrieving metadata files from storage account...")
+        self._logger.info(f"Searching container {container_name} for metadata files")
+        prefix = "_meta/"
+        blobs = [
+            blob
+            for blob in self._backend.list_blobs(container_name, prefix)
+            if blob.name.endswith(".json")
+        ]
+        for blob in blobs:
+            self._logger.info(f"Found metadata file: {blob.name}")
+        return blobs
+
+    def _download_metadata_files(
+        self, container_name: str, blobs: List[BlobInfo], max_workers: int = None
+    ) -> List[MetadataFile]:
+        """
+        Downloads the metadata blobs concurrently, keeping the listing order
+        """
+        with ThreadPoolExecutor(max_workers or self._max_workers) as executor:
+            contents = executor.map(
+                lambda blob: self._download_blob(
+                    container_name, blob.name, etag=blob.etag
+                ),
+                blobs,
+            )
+            return [
+                MetadataFile(
+                    container=container_name,
+                    metadata_json=metadata_json,
+                    name=blob.name,
+                )
+                for blob, metadata_json in zip(blobs, contents)
+            ]
+
+    def _download_blob(
+        self, container_name: str, blob_name: str, etag: str = None
+    ) -> Union[str, None]:
         """
         Downloads the content of a blob from the given container.
+        When the blob is in the local cache, it is served from there if the ETag
+        matches the one provided, otherwise it is requested with a conditional
+        GET, which returns the content only if the blob changed.
 
         Parameters:
             container_name (str): name of the container where the blob is located.
             blob_name (str): name of the blob to download.
+            etag (str): current ETag of the blob, if already known (e.g. listing).
 
         Returns:
             Union[str, None]: content of the blob as a string if successful, else None.
         """
         try:
+            cached_etag, cached_content = self._read_cache(container_name, blob_name)
+            if cached_etag is not None and cached_etag == etag:
+                self._logger.info(f"Blob {blob_name} served from cache")
+                return cached_content
+
             self._logger.info(f"Downloading blob: {blob_name}")
-            container = self._client.get_container_client(container_name)
-            blob = container.get_blob_client(blob_name)
-            blob_data = blob.download_blob().readall()
-            return blob_data.decode("utf-8")  # type: ignore
+            downloaded = self._backend.download(
+                container_name, blob_name, if_none_match=cached_etag
+            )
+            if downloaded is None:
+                self._logger.info(f"Blob {blob_name} not modified, using cache")
+                return cached_content
+
+            content, new_etag = downloaded
+            blob_data = content.decode("utf-8")
+            self._write_cache(container_name, blob_name, new_etag, blob_data)
+            return blob_data
         except Exception as e:
             self._logger.error(
                 f"Error downloading blob '{blob_name}'"
                 f" from container '{container_name}': {e}"
             )
             return None
+
+    def _get_cache_path(self, container_name: str, blob_name: str) -> str:
+        return os.path.join(
+            self._cache_dir,
+            self._account_name,
+            container_name,
+            f"{quote(blob_name, safe='')}.json",
+        )
+
+    def _read_cache(
+        self, container_name: str, blob_name: str
+    ) -> Tuple[Union[str, None], Union[str, None]]:
+        """
+        Returns the cached ETag and content of a blob, or (None, None)
+        """
+        if self._cache_dir is None:
+            return None, None
+        try:
+            with open(self._get_cache_path(container_name, blob_name)) as file:
+                entry = json.load(file)
+            return entry["etag"], entry["content"]
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def _write_cache(
+        self, container_name: str, blob_name: str, etag: str, content: str
+    ):
+        """
+        Atomically stores the ETag and content of a blob, so that concurrent
+        scripts never read a partial entry
+        """
+        if self._cache_dir is None:
+            return
+        try:
+            cache_path = self._get_cache_path(container_name, blob_name)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump({"etag": etag, "content": content}, file)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            self._logger.warning(f"Unable to cache blob '{blob_name}': {e}")
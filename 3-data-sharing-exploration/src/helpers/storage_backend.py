@@ -0,0 +1,259 @@
+"""
+Storage backend module
+----------------------
+Blob operations used by the StorageHelper, behind one interface: the Azure Blob
+Storage backend used by the stages, and a local backend serving a folder with
+the layout of the container (e.g. sample_data, with its _meta folder), so that
+the stages can run and be timed offline, deterministically.
+"""
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobServiceClient, ContentSettings
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class BlobInfo:
+    name: str
+    size: int
+    last_modified: datetime
+    etag: str
+    # MD5 of the content, when stored with the blob
+    content_md5: Optional[bytes] = None
+
+
+class StorageBackend(ABC):
+    """
+    Interface of the storage backends. Blob names are relative to the
+    container, with / as separator.
+    """
+
+    account_name: str
+
+    @abstractmethod
+    def list_blobs(self, container_name: str, prefix: str = "") -> Iterator[BlobInfo]:
+        """Blobs whose name starts with the prefix, sorted by name"""
+
+    @abstractmethod
+    def download(
+        self, container_name: str, blob_name: str, if_none_match: str = None
+    ) -> Optional[Tuple[bytes, str]]:
+        """
+        Content and ETag of a blob, or None if its ETag is still if_none_match
+        """
+
+    @abstractmethod
+    def iter_chunks(self, container_name: str, blob_name: str) -> Iterator[bytes]:
+        """Content of a blob, in chunks of the chunk size of the backend"""
+
+    @abstractmethod
+    def upload(
+        self,
+        container_name: str,
+        blob_name: str,
+        file: BinaryIO,
+        length: int,
+        content_type: str = "application/octet-stream",
+        content_md5: bytes = None,
+        max_concurrency: int = 1,
+    ):
+        """Creates or replaces a blob with the content of a file"""
+
+
+class AzureBlobBackend(StorageBackend):
+    """Blobs of an Azure Storage account"""
+
+    def __init__(
+        self,
+        account_name: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        credential=None,
+    ):
+        """
+        Parameters
+        ----------
+        account_name: str
+            name of the storage account
+
+        chunk_size: int = 4 MB
+            size of the ranges downloaded and of the blocks uploaded
+
+        credential = None
+            Optional.
+            credential of the account. Default DefaultAzureCredential.
+        """
+        self.account_name = account_name
+        self._client = BlobServiceClient(
+            f"https://{account_name}.blob.core.windows.net",
+            credential or DefaultAzureCredential(),
+            max_single_get_size=chunk_size,
+            max_chunk_get_size=chunk_size,
+            max_single_put_size=chunk_size,
+            max_block_size=chunk_size,
+        )
+
+    def list_blobs(self, container_name: str, prefix: str = "") -> Iterator[BlobInfo]:
+        container = self._client.get_container_client(container_name)
+        for blob in container.list_blobs(name_starts_with=prefix or None):
+            content_md5 = blob["content_settings"].get("content_md5")
+            yield BlobInfo(
+                name=blob["name"],
+                size=blob["size"],
+                last_modified=blob["last_modified"],
+                etag=blob["etag"],
+                content_md5=bytes(content_md5) if content_md5 else None,
+            )
+
+    def download(
+        self, container_name: str, blob_name: str, if_none_match: str = None
+    ) -> Optional[Tuple[bytes, str]]:
+        container = self._client.get_container_client(container_name)
+        blob = container.get_blob_client(blob_name)
+        if if_none_match is None:
+            downloader = blob.download_blob()
+        else:
+            try:
+                downloader = blob.download_blob(
+                    etag=if_none_match, match_condition=MatchConditions.IfModified
+                )
+            except ResourceNotModifiedError:
+                return None
+        return downloader.readall(), downloader.properties.etag
+
+    def iter_chunks(self, container_name: str, blob_name: str) -> Iterator[bytes]:
+        container = self._client.get_container_client(container_name)
+        yield from container.get_blob_client(blob_name).download_blob().chunks()
+
+    def upload(
+        self,
+        container_name: str,
+        blob_name: str,
+        file: BinaryIO,
+        length: int,
+        content_type: str = "application/octet-stream",
+        content_md5: bytes = None,
+        max_concurrency: int = 1,
+    ):
+        container = self._client.get_container_client(container_name)
+        container.get_blob_client(blob_name).upload_blob(
+            file,
+            length=length,
+            overwrite=True,
+            max_concurrency=max_concurrency,
+            content_settings=ContentSettings(
+                content_type=content_type,
+                content_md5=bytearray(content_md5) if content_md5 else None,
+            ),
+        )
+
+
+class LocalBackend(StorageBackend):
+    """
+    Files of a local folder, served as the blobs of the container: the folder
+    has the layout of the container, e.g. sample_data with its _meta folder.
+    The container name is not used. ETags are derived from the modification
+    time and size of the files. The MD5 of a file is computed when it is listed
+    and kept as long as its ETag does not change.
+    """
+
+    account_name = "local"
+
+    def __init__(self, root: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self._chunk_size = chunk_size
+        # path: (etag, md5)
+        self._md5: Dict[str, Tuple[str, bytes]] = {}
+        self._md5_lock = threading.Lock()
+
+    def _path(self, blob_name: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, blob_name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Blob {blob_name} is outside of {self.root}")
+        return path
+
+    @staticmethod
+    def _etag(stat: os.stat_result) -> str:
+        return f'"0x{stat.st_mtime_ns:X}{stat.st_size:X}"'
+
+    def _content_md5(self, path: str, etag: str) -> bytes:
+        with self._md5_lock:
+            cached = self._md5.get(path)
+        if cached is not None and cached[0] == etag:
+            return cached[1]
+        md5 = hashlib.md5(usedforsecurity=False)
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(self._chunk_size), b""):
+                md5.update(chunk)
+        digest = md5.digest()
+        with self._md5_lock:
+            self._md5[path] = (etag, digest)
+        return digest
+
+    def list_blobs(self, container_name: str, prefix: str = "") -> Iterator[BlobInfo]:
+        # only walk the folder of the prefix
+        folder = self._path(prefix.rsplit("/", 1)[0] if "/" in prefix else "")
+        blobs = []
+        for directory, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(directory, name)
+                blob_name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if not blob_name.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                etag = self._etag(stat)
+                blobs.append(
+                    BlobInfo(
+                        name=blob_name,
+                        size=stat.st_size,
+                        last_modified=datetime.fromtimestamp(
+                            stat.st_mtime, timezone.utc
+                        ),
+                        etag=etag,
+                        content_md5=self._content_md5(path, etag),
+                    )
+                )
+        yield from sorted(blobs, key=lambda blob: blob.name)
+
+    def download(
+        self, container_name: str, blob_name: str, if_none_match: str = None
+    ) -> Optional[Tuple[bytes, str]]:
+        with open(self._path(blob_name), "rb") as file:
+            etag = self._etag(os.fstat(file.fileno()))
+            if etag == if_none_match:
+                return None
+            return file.read(), etag
+
+    def iter_chunks(self, container_name: str, blob_name: str) -> Iterator[bytes]:
+        with open(self._path(blob_name), "rb") as file:
+            yield from iter(lambda: file.read(self._chunk_size), b"")
+
+    def upload(
+        self,
+        container_name: str,
+        blob_name: str,
+        file: BinaryIO,
+        length: int,
+        content_type: str = "application/octet-stream",
+        content_md5: bytes = None,
+        max_concurrency: int = 1,
+    ):
+        path = self._path(blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as target:
+            for chunk in iter(lambda: file.read(self._chunk_size), b""):
+                target.write(chunk)
+        os.replace(temp_path, path)
+        if content_md5 is not None:
+            with self._md5_lock:
+                self._md5[path] = (self._etag(os.stat(path)), bytes(content_md5))
@@ -18,31 +18,28 @@ def main():
     # Create SQL Helper using AZ CLI Credential instead of service principal.
     synapse = SqlHelper(config, database="master", use_cli_credentials=True)
 
-    # Existing Service Principal - using fixed name just for test.
-    synapse.create_login(config.azure_client_name)
     synapse.create_database(config.synapse_database)
-    synapse.create_db_user(user_name=config.azure_client_name, role="db_owner")
-
-    print("Login and DB User for Service Principal have been created.")
-
-    # Purview
-    synapse.create_login(config.purview_account_name)
-    synapse.create_db_user(user_name=config.purview_account_name, role="db_datareader")
-
-    print("Login and DB User for Purview have been created.")
 
-    # Default Security Groups
-    # 'role' is not assigned because permissions are handled by data_security scripts.
-    synapse.create_login(config.data_security_group_low)
-    synapse.create_db_user(config.data_security_group_low)
-
-    synapse.create_login(config.data_security_group_medium)
-    synapse.create_db_user(config.data_security_group_medium)
-
-    synapse.create_login(config.data_security_group_high)
-    synapse.create_db_user(config.data_security_group_high)
-
-    print("Logins and DB Users for Security Groups have been created.")
+    # Existing Service Principal - using fixed name just for test.
+    # Purview needs to read the views in order to perform the scans.
+    # Default Security Groups: 'role' is not assigned because permissions are
+    # handled by data_security scripts.
+    principals = {
+        config.azure_client_name: "db_owner",
+        config.purview_account_name: "db_datareader",
+        config.data_security_group_low: None,
+        config.data_security_group_medium: None,
+        config.data_security_group_high: None,
+    }
+    created = synapse.provision_principals(principals)
+
+    print(f"Logins created: {created['logins']}")
+    print(f"DB Users created: {created['users']}")
+    print(f"Roles assigned: {created['roles']}")
+    print(
+        "Logins and DB Users for Service Principal, Purview and Security Groups "
+        "are in place."
+    )
 
 
 if __name__ == "__main__":
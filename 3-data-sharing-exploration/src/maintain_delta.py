@@ -0,0 +1,111 @@
+import argparse
+import logging
+import sys
+
+from helpers.config import Configuration
+from helpers.delta import DeltaLogReader
+from helpers.delta_clustering import DeltaClustering
+from helpers.delta_maintenance import MB, DeltaMaintenance
+from helpers.storage import StorageHelper
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compact the small files of the delta tables described by the "
+            "metadata files, optionally sort them, and write their checkpoints"
+        )
+    )
+    parser.add_argument(
+        "--data-root",
+        help="local folder with the container layout (e.g. ../sample_data), "
+        "instead of the storage account of the configuration",
+    )
+    parser.add_argument(
+        "--target-size-mb",
+        type=int,
+        default=128,
+        help="size of the files written by the compaction",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the files that would be compacted",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="sort the tables by their cluster_by or key columns first",
+    )
+    parser.add_argument(
+        "--row-group-mb",
+        type=float,
+        default=64,
+        help="uncompressed size of the row groups written by --cluster",
+    )
+    parser.add_argument("--no-compact", action="store_true")
+    parser.add_argument("--no-checkpoint", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    config = Configuration()
+    schema = config.synapse_database_schema or "SalesLT"
+    container = config.adls_container_name
+    if args.data_root:
+        reader = DeltaLogReader.local(args.data_root)
+        storage_helper = StorageHelper.local(args.data_root)
+    else:
+        reader = DeltaLogReader.adls(config.storage_account_name, container)
+        storage_helper = StorageHelper(config.storage_account_name)
+    metadata_files = storage_helper.get_metadata_files(container)
+    maintenance = DeltaMaintenance(
+        reader,
+        target_file_size=args.target_size_mb * MB,
+        max_workers=args.workers,
+    )
+    clustering = DeltaClustering(
+        maintenance,
+        row_group_size=int(args.row_group_mb * MB),
+        max_workers=args.workers,
+    )
+
+    # the same folder can be described by several metadata versions
+    maintained = set()
+    failed = 0
+    for metadata_file in metadata_files:
+        if metadata_file.metadata_json is None:
+            continue
+        metadata = metadata_file.metadata
+        if metadata.path in maintained:
+            continue
+        maintained.add(metadata.path)
+        print(f"{metadata_file.name} ({metadata.version}, {metadata.path})")
+        if args.cluster:
+            # clustered files are written at the target size, so the
+            # compaction that follows only checkpoints them
+            for result in clustering.cluster(metadata, schema, dry_run=args.dry_run):
+                print(f"  {result}")
+                failed += 1 if result.error else 0
+        results = maintenance.maintain(
+            metadata,
+            schema,
+            compact=not args.no_compact,
+            checkpoint=not args.no_checkpoint,
+            dry_run=args.dry_run,
+        )
+        for result in results:
+            print(f"  {result}")
+        failed += sum(1 for result in results if result.error)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import logging
+import os
+
+from helpers.config import Configuration
+from helpers.sql_gateway import SqlGateway, serve
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    # Local gateway shared by the scripts and consumer jobs querying the
+    # serverless SQL endpoint.
+    config = Configuration()
+    gateway = SqlGateway(
+        config,
+        pool_size=int(os.getenv("SQL_GATEWAY_POOL_SIZE", "4")),
+        max_batch_concurrency=int(os.getenv("SQL_GATEWAY_BATCH_CONCURRENCY", "1")),
+    )
+    gateway.start()
+
+    port = int(os.getenv("SQL_GATEWAY_PORT", "8765"))
+    print(f"SQL gateway listening on http://127.0.0.1:{port} (Ctrl+C to stop)")
+    try:
+        serve(gateway, port=port)
+    except KeyboardInterrupt:
+        print(gateway.metrics())
+    finally:
+        gateway.stop()
+
+
+if __name__ == "__main__":
+    main()
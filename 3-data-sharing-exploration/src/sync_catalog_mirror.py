@@ -0,0 +1,52 @@
+import argparse
+import logging
+
+from helpers.config import Configuration
+from helpers.const import CONST
+from helpers.purview.catalog_mirror import CatalogMirror
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Refresh the local mirror of the entities of the Purview collection "
+            "of the configuration and of its child collections"
+        )
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="read all the entities again"
+    )
+    parser.add_argument(
+        "--no-prune",
+        action="store_true",
+        help="only read the updated entities, without listing all of them to "
+        "remove the deleted ones",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    config = Configuration()
+    mirror = CatalogMirror.for_configuration(config)
+    refresh = mirror.refresh_from_purview(
+        config,
+        full=args.full,
+        prune=not args.no_prune,
+        max_workers=args.workers,
+    )
+    print(f"Catalog mirror of {config.purview_collection_name}: {refresh}")
+    print(
+        f"{len(mirror.entities())} entities, "
+        f"{len(mirror.entities(CONST.PURVIEW_SYNAPSE_SQL_VIEW_DATA_TYPE))} views, "
+        f"{len(mirror.entities(CONST.PURVIEW_SYNAPSE_SQL_VIEW_COLUMN_DATA_TYPE))} "
+        "view columns"
+    )
+
+
+if __name__ == "__main__":
+    main()
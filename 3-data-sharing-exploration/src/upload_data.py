@@ -0,0 +1,66 @@
+import argparse
+import logging
+import sys
+
+from helpers.config import Configuration
+from helpers.storage import StorageHelper
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Upload local folders (e.g. ../sample_data/v2) to the container of "
+            "the configuration, skipping the unchanged files"
+        )
+    )
+    parser.add_argument(
+        "folders",
+        nargs="+",
+        metavar="FOLDER=DESTINATION",
+        help="local folder and folder of the container, e.g. ../sample_data/v2=v2",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="number of files uploaded at once"
+    )
+    parser.add_argument(
+        "--block-concurrency",
+        type=int,
+        default=4,
+        help="number of blocks of a large file uploaded at once",
+    )
+    parser.add_argument("--block-size-mb", type=int, default=4)
+    args = parser.parse_args()
+
+    config = Configuration()
+    storage_helper = StorageHelper(
+        config.storage_account_name,
+        max_workers=args.workers,
+        chunk_size=args.block_size_mb * 1024 * 1024,
+    )
+
+    failed = 0
+    for folder in args.folders:
+        local_path, _, destination = folder.partition("=")
+        result = storage_helper.upload_directory(
+            config.adls_container_name,
+            local_path,
+            destination,
+            max_concurrency=args.block_concurrency,
+        )
+        print(f"{local_path} -> {destination or '/'}: {result}")
+        for blob_name, error in result.failed.items():
+            print(f"  {blob_name}: {error}")
+        failed += len(result.failed)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
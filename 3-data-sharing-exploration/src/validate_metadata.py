@@ -0,0 +1,99 @@
+import argparse
+import logging
+import sys
+
+from helpers.config import Configuration
+from helpers.delta import DeltaLogReader
+from helpers.metadata import Metadata
+from helpers.metadata_validation import MetadataValidator
+from helpers.storage import StorageHelper
+
+# setup logging
+log_level = logging.WARNING
+logging.basicConfig(
+    level=log_level, format="[%(asctime)s] %(levelname)s :: %(name)s :: %(message)s"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check the metadata files against the schema of the delta tables, "
+            "or generate a metadata file from them"
+        )
+    )
+    parser.add_argument(
+        "--data-root",
+        help="local folder with the container layout (e.g. ../sample_data), "
+        "instead of the storage account of the configuration",
+    )
+    parser.add_argument(
+        "--generate",
+        metavar="VERSION",
+        help="generate the metadata file of this version instead of validating",
+    )
+    parser.add_argument("--path", help="folder of the tables to generate, e.g. v2")
+    parser.add_argument(
+        "--output", help="file to write the generated metadata to (default stdout)"
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    config = Configuration()
+    schema = config.synapse_database_schema or "SalesLT"
+    container = config.adls_container_name
+    if args.data_root:
+        reader = DeltaLogReader.local(args.data_root)
+        storage_helper = StorageHelper.local(args.data_root)
+    else:
+        reader = DeltaLogReader.adls(config.storage_account_name, container)
+        storage_helper = StorageHelper(config.storage_account_name)
+    metadata_files = storage_helper.get_metadata_files(container)
+    validator = MetadataValidator(reader, max_workers=args.workers)
+
+    if args.generate:
+        if not args.path:
+            parser.error("--path is required with --generate")
+        # keep the descriptions and sensitivity of the latest metadata file
+        # describing the same folder
+        existing = [
+            metadata_file.metadata
+            for metadata_file in metadata_files
+            if metadata_file.metadata_json is not None
+            and metadata_file.metadata.path == args.path
+        ]
+        metadata = validator.generate(
+            args.generate,
+            args.path,
+            schema,
+            existing=existing[-1] if existing else None,
+        )
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                file.write(metadata.to_json())
+            print(f"Metadata {args.generate} written to {args.output}")
+        else:
+            print(metadata.to_json())
+        return
+
+    mismatches_found = 0
+    for metadata_file in metadata_files:
+        if metadata_file.metadata_json is None:
+            continue
+        metadata: Metadata = metadata_file.metadata
+        mismatches = validator.validate(metadata, schema)
+        print(
+            f"{metadata_file.name} ({metadata.version}, {metadata.path}): "
+            f"{len(mismatches)} mismatches"
+        )
+        for mismatch in mismatches:
+            print(f"  {mismatch}")
+        mismatches_found += len(mismatches)
+
+    # non-zero exit code, so that the check can gate the data ingest
+    if mismatches_found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()